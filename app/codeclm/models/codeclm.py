@@ -258,6 +258,8 @@ class CodecLM:
             else:
                 print(f'{generated_tokens: 6d} / {total_gen_len: 6d}', end='\r')
 
+        # the default callback only prints, tqdm in the LM loop already does that
+        callback = _progress_callback if self._progress_callback is not None else None
         if self.duration <= self.max_duration:
             # generate by sampling from LM, simple case.
             with self.autocast:
@@ -265,19 +267,32 @@ class CodecLM:
                                               descriptions=descriptions, 
                                               audio_qt_embs=audio_qt_embs, 
                                               max_gen_len=total_gen_len, 
+                                              callback=callback,
                                               **self.generation_params)
         else:
-            raise NotImplementedError(f"duration {self.duration} < max duration {self.max_duration}")
+            # extended generation: keep a sliding window of max_duration over the audio tokens
+            # (condition prefix and lyrics stay pinned) and drop extend_stride seconds at a time.
+            with self.autocast:
+                gen_tokens = self.lm.generate(texts=texts, 
+                                              descriptions=descriptions, 
+                                              audio_qt_embs=audio_qt_embs, 
+                                              max_gen_len=total_gen_len, 
+                                              context_window=int(self.max_duration * self.frame_rate),
+                                              evict_stride=int(self.extend_stride * self.frame_rate),
+                                              callback=callback,
+                                              **self.generation_params)
         return gen_tokens
 
     @torch.no_grad()
-    def generate_audio(self, gen_tokens: torch.Tensor, prompt=None, vocal_prompt=None, bgm_prompt=None, chunked=False, chunk_size=128, gen_type='mixed'):
+    def generate_audio(self, gen_tokens: torch.Tensor, prompt=None, vocal_prompt=None, bgm_prompt=None, chunked=False, chunk_size=128, gen_type='mixed', num_steps=50):
         """Generate Audio from tokens"""
         assert gen_tokens.dim() == 3
         if self.seperate_tokenizer is not None:
             gen_tokens_song = gen_tokens[:, [0], :]
             gen_tokens_vocal = gen_tokens[:, [1], :]
             gen_tokens_bgm = gen_tokens[:, [2], :]
+            if gen_type == 'separate':
+                return self._generate_audio_separate(gen_tokens_vocal, gen_tokens_bgm, vocal_prompt, bgm_prompt, chunked, chunk_size, num_steps)
             if gen_type == 'bgm':
                 gen_tokens_vocal = torch.full_like(gen_tokens_vocal, 3142)
                 if vocal_prompt is not None:
@@ -288,8 +303,29 @@ class CodecLM:
                     bgm_prompt = torch.zeros_like(bgm_prompt)
             else:
                 assert gen_type == 'mixed', f"gen_type {gen_type} not supported"
-            gen_audio_seperate = self.seperate_tokenizer.decode([gen_tokens_vocal, gen_tokens_bgm], vocal_prompt, bgm_prompt, chunked=chunked, chunk_size=chunk_size)
+            gen_audio_seperate = self.seperate_tokenizer.decode([gen_tokens_vocal, gen_tokens_bgm], vocal_prompt, bgm_prompt, chunked=chunked, chunk_size=chunk_size, num_steps=num_steps)
             return gen_audio_seperate
         else:
             gen_audio = self.audiotokenizer.decode(gen_tokens, prompt)
             return gen_audio
+
+    def _generate_audio_separate(self, gen_tokens_vocal, gen_tokens_bgm, vocal_prompt, bgm_prompt, chunked, chunk_size, num_steps=50):
+        """Decode the mixed, vocal and bgm stems in a single batched diffusion + VAE pass.
+
+        The three variants only differ in which token stream is replaced by the silence
+        token, so they are stacked on the batch dimension and share every window of
+        `code2sound` instead of running it three times.
+        """
+        B = gen_tokens_vocal.shape[0]
+        tokens_vocal = torch.cat([gen_tokens_vocal, gen_tokens_vocal, torch.full_like(gen_tokens_vocal, 3142)], 0)
+        tokens_bgm = torch.cat([gen_tokens_bgm, torch.full_like(gen_tokens_bgm, 9670), gen_tokens_bgm], 0)
+        if vocal_prompt is not None and bgm_prompt is not None:
+            if vocal_prompt.dim() == 2:
+                vocal_prompt = vocal_prompt[None]
+                bgm_prompt = bgm_prompt[None]
+            vocal_prompt = vocal_prompt.expand(B, -1, -1)
+            bgm_prompt = bgm_prompt.expand(B, -1, -1)
+            vocal_prompt = torch.cat([vocal_prompt, vocal_prompt, torch.zeros_like(vocal_prompt)], 0)
+            bgm_prompt = torch.cat([bgm_prompt, torch.zeros_like(bgm_prompt), bgm_prompt], 0)
+        gen_audio = self.seperate_tokenizer.decode([tokens_vocal, tokens_bgm], vocal_prompt, bgm_prompt, chunked=chunked, chunk_size=chunk_size, num_steps=num_steps)
+        return {'mixed': gen_audio[:B], 'vocal': gen_audio[B:2 * B], 'bgm': gen_audio[2 * B:]}
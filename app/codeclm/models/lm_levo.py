@@ -20,9 +20,22 @@ from codeclm.modules.conditioners import (
     AttributeDropout,
 )
 from codeclm.utils.utils import create_norm_fn, init_layer, sample_top_k, sample_top_p, multinomial
+from codeclm.utils.cancellation import check_cancelled
 from codeclm.modules.pattern import CodebooksPatternProvider
 ConditionTensors = tp.Dict[str, ConditionType]
 
+
+def _shift_rotary(key: torch.Tensor, rotary_emb: nn.Module, shift: int) -> torch.Tensor:
+    """Move rotary-embedded keys [B, H, S, D] by `shift` positions."""
+    inv_freq = rotary_emb.inv_freq.to(device=key.device, dtype=torch.float32)
+    angle = shift / getattr(rotary_emb, 'scaling_factor', 1.0) * inv_freq
+    angle = torch.cat([angle, angle], dim=-1)
+    key_float = key.float()
+    half = key_float.shape[-1] // 2
+    rotated_half = torch.cat([-key_float[..., half:], key_float[..., :half]], dim=-1)
+    return (key_float * angle.cos() + rotated_half * angle.sin()).to(key.dtype)
+
+
 @dataclass
 class LMOutput:
     # The logits are already re-aligned with the input codes
@@ -225,7 +238,7 @@ class LmModel(StreamingModule):
                     mask = mask.repeat(1, 1, audio_qt_seq.shape[-1])
                     audio_qt_seq[mask] = 16385
                     attr["audio"]['prompt_audio'] = AudioCondition(
-                        wav=audio_qt_seq.long().cuda(), 
+                        wav=audio_qt_seq.long().to(self.emb[0].weight.device), 
                         length=torch.Tensor([audio_qt_seq.shape[-1]]).long(),
                         sample_rate=[self.cfg.sample_rate],)
                 if 'type_info' in self.condition_provider.conditioners:
@@ -350,7 +363,10 @@ class LmModel(StreamingModule):
                  cfg_coef: tp.Optional[float] = None,
                  check: bool = False,        
                  record_tokens: bool = True,
-                 record_window: int = 150
+                 record_window: int = 150,
+                 context_window: tp.Optional[int] = None,
+                 evict_stride: int = 125,
+                 callback: tp.Optional[tp.Callable[[int, int], None]] = None,
                  ) -> torch.Tensor:
         """Generate tokens sampling from the model given a prompt or unconditionally. Generation can
         be perform in a greedy fashion or using sampling with top K and top P strategies.
@@ -367,6 +383,10 @@ class LmModel(StreamingModule):
             cfg_coeff (float, optional): Classifier-free guidance coefficient.
             check (bool): Whether to apply further checks on generated sequence.
             callback (Callback, optional): Callback function to report generation progress.
+            context_window (int, optional): If set, only the last `context_window` sequence steps are kept
+                in the KV cache next to the pinned condition prefix, so `max_gen_len` may exceed the trained
+                context while memory and per-step cost stay bounded.
+            evict_stride (int): Number of extra steps dropped at once when the context window overflows.
         Returns:
             torch.Tensor: Generated tokens.
         """
@@ -416,7 +436,10 @@ class LmModel(StreamingModule):
         with self.streaming():
             gen_sequence_len = gen_sequence.shape[-1]  # gen_sequence shape is [B, K, S]
             prev_offset = 0
+            num_pinned = None
             for offset in tqdm(range(start_offset_sequence, gen_sequence_len)):
+                # leaving the streaming context on cancel also drops the KV cache
+                check_cancelled()
                 # get current sequence (note that the streaming API is providing the caching over previous offsets)
                 curr_sequence = gen_sequence[..., prev_offset:offset]
                 curr_mask = mask[None, ..., prev_offset:offset].expand(B, -1, -1)
@@ -448,6 +471,17 @@ class LmModel(StreamingModule):
                 # record sampled tokens in a window
                 if record_tokens:
                     record_token_pool.append(next_token.squeeze())
+                    if len(record_token_pool) > record_window:
+                        del record_token_pool[:-record_window]
+                # slide the KV cache, the first step (condition prefix + start token) stays pinned
+                if context_window is not None:
+                    cache_len = self._streaming_cache_length()
+                    if num_pinned is None:
+                        num_pinned = cache_len
+                    elif cache_len - num_pinned > context_window:
+                        self._evict_streaming_cache(num_pinned, cache_len - num_pinned - context_window + evict_stride)
+                if callback is not None:
+                    callback(1 + offset - start_offset_sequence, gen_sequence_len - start_offset_sequence)
                 if torch.all(is_end):
                     gen_sequence = gen_sequence[..., :offset+1]
                     break
@@ -471,6 +505,32 @@ class LmModel(StreamingModule):
         assert (out_codes >= 0).all() and (out_codes <= self.code_size).all()
         return out_codes      
     
+    def _streaming_cache_length(self) -> int:
+        past_key_values = self._streaming_state.get('past_key_values_1', None)
+        if past_key_values is None:
+            return 0
+        return past_key_values[0][0].shape[2]
+
+    def _evict_streaming_cache(self, num_pinned: int, num_evict: int):
+        """Drop `num_evict` cached steps right after the first `num_pinned` ones from both transformers.
+
+        Cached keys already carry their rotary embedding, so the kept tail is rotated back by `num_evict`
+        positions. Positions therefore stay within the trained range however long the generation runs.
+        """
+        for cache_key, transformer in (('past_key_values_1', self.transformer),
+                                       ('past_key_values_2', self.transformer2)):
+            past_key_values = self._streaming_state.get(cache_key, None)
+            if past_key_values is None:
+                continue
+            new_past_key_values = []
+            for layer, (key, value) in zip(transformer.model.layers, past_key_values):
+                kept_key = _shift_rotary(key[:, :, num_pinned + num_evict:], layer.self_attn.rotary_emb, -num_evict)
+                new_past_key_values.append((
+                    torch.cat([key[:, :, :num_pinned], kept_key], dim=2),
+                    torch.cat([value[:, :, :num_pinned], value[:, :, num_pinned + num_evict:]], dim=2),
+                ))
+            self._streaming_state[cache_key] = tuple(new_past_key_values)
+
     def _sample_next_token(self,
                            sequence: torch.Tensor,
                            condition_tensors: ConditionTensors,
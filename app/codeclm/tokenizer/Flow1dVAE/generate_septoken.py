@@ -7,6 +7,8 @@ import torchaudio
 import librosa
 import os
 import math
+import queue
+import threading
 import numpy as np
 # from tools.get_mulan import get_mulan
 from tools.get_1dvae_large import get_model
@@ -14,6 +16,9 @@ import tools.torch_tools as torch_tools
 from safetensors.torch import load_file
 from third_party.demucs.models.pretrained import get_model_from_yaml
 from filelock import FileLock
+from codeclm.utils.cancellation import check_cancelled
+from precision import DEFAULT_PRECISION, apply_precision, get_policy
+from third_party.stable_audio_tools.stable_audio_tools.models.blocks import SnakeBeta
 
 
 class Separator:
@@ -73,11 +78,14 @@ class Tango:
         vae_model,
         layer_vocal=7,\
         layer_bgm=3,\
-        device="cuda:0"):
+        device="cuda:0",\
+        precision=DEFAULT_PRECISION):
         
         self.sample_rate = 48000
         scheduler_name = "configs/scheduler/stable_diffusion_2.1_largenoise_sample.json"
         self.device = device
+        self.model_path = model_path
+        self.vae_model = vae_model
 
         self.vae = get_model(vae_config, vae_model)
         self.vae = self.vae.to(device)
@@ -108,6 +116,41 @@ class Tango:
         # self.scheduler = DDPMScheduler.from_pretrained( \
         #     scheduler_name, subfolder="scheduler")
         print("Successfully loaded inference scheduler from {}".format(scheduler_name))
+        self._progress_callback = None
+        # code2sound default for overlapping the VAE decode with the diffusion (CUDA/CPU only)
+        self.pipeline_decode = False
+        self.precision = None
+        self.set_precision(precision)
+
+    def set_precision(self, precision=DEFAULT_PRECISION):
+        """
+        Cast the diffusion estimator and the VAE decoder to a policy of precision.py ('auto',
+        'fp32', 'bf16', 'fp16'). Leaving a reduced precision policy reloads their fp32 weights.
+        """
+        policy = get_policy(precision)
+        if self.precision is not None and self.precision.dtype not in (None, torch.float32) and policy != self.precision:
+            self._reload_fp32_weights()
+        self.precision = policy
+        apply_precision(self.model.cfm_wrapper.estimator, policy, (torch.nn.LayerNorm,))
+        apply_precision(self.vae.decoder, policy, (SnakeBeta,))
+
+    def _reload_fp32_weights(self):
+        estimator, decoder = self.model.cfm_wrapper.estimator, self.vae.decoder
+        apply_precision(estimator, get_policy('fp32'))
+        apply_precision(decoder, get_policy('fp32'))
+        main_weights = load_file(self.model_path) if self.model_path.endswith(".safetensors") else torch.load(self.model_path, map_location='cpu')
+        prefix = 'cfm_wrapper.estimator.'
+        estimator.load_state_dict({k[len(prefix):]: v for k, v in main_weights.items() if k.startswith(prefix)}, strict=False)
+        vae_weights = torch.load(self.vae_model, map_location='cpu')['state_dict']
+        decoder.load_state_dict({k[len('decoder.'):]: v for k, v in vae_weights.items() if k.startswith('decoder.')}, strict=False)
+
+    def set_progress_callback(self, progress_callback=None):
+        """Report code2sound progress as progress_callback(stage, done, total), stage is 'diffusion' or 'vae'."""
+        self._progress_callback = progress_callback
+
+    def _report_progress(self, stage, done, total):
+        if self._progress_callback is not None:
+            self._progress_callback(stage, done, total)
 
 
     @torch.no_grad()
@@ -172,7 +215,7 @@ class Tango:
         return codes_vocal, codes_bgm
 
     @torch.no_grad()
-    def code2sound(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False, chunk_size=128):
+    def code2sound(self, codes, prompt_vocal=None, prompt_bgm=None, duration=40, guidance_scale=1.5, num_steps=20, disable_progress=False, chunked=False, chunk_size=128, pipeline_decode=None, chain_windows=True):
         codes_vocal,codes_bgm = codes
         codes_vocal = codes_vocal.to(self.device)
         codes_bgm = codes_bgm.to(self.device)
@@ -188,42 +231,37 @@ class Tango:
 
 
         if(isinstance(prompt_vocal, torch.Tensor) and isinstance(prompt_bgm, torch.Tensor)):
-            # prepare prompt
+            # prepare prompt, a [B, C, T] prompt gives one prompt per batch item
             prompt_vocal = prompt_vocal.to(self.device)
             prompt_bgm = prompt_bgm.to(self.device)
             if(prompt_vocal.ndim == 3):
-                assert prompt_vocal.shape[0] == 1, prompt_vocal.shape
-                prompt_vocal = prompt_vocal[0]
-                prompt_bgm = prompt_bgm[0]
-            elif(prompt_vocal.ndim == 1):
-                prompt_vocal = prompt_vocal.unsqueeze(0).repeat(2,1)
-                prompt_bgm = prompt_bgm.unsqueeze(0).repeat(2,1)
-            elif(prompt_vocal.ndim == 2):
-                if(prompt_vocal.shape[0] == 1):
-                    prompt_vocal = prompt_vocal.repeat(2,1)
-                    prompt_bgm = prompt_bgm.repeat(2,1)
-
-            if(prompt_vocal.shape[-1] < int(30 * self.sample_rate)):
-                # if less than 30s, just choose the first 10s
-                prompt_vocal = prompt_vocal[:,:int(10*self.sample_rate)] # limit max length to 10.24
-                prompt_bgm = prompt_bgm[:,:int(10*self.sample_rate)] # limit max length to 10.24
+                assert prompt_vocal.shape[0] in (1, codes_vocal.shape[0]), prompt_vocal.shape
+                prompt_pairs = list(zip(prompt_vocal, prompt_bgm))
             else:
-                # else choose from 20.48s which might includes verse or chorus
-                prompt_vocal = prompt_vocal[:,int(20*self.sample_rate):int(30*self.sample_rate)] # limit max length to 10.24
-                prompt_bgm = prompt_bgm[:,int(20*self.sample_rate):int(30*self.sample_rate)] # limit max length to 10.24
-            
-            true_latent = self.vae.encode_audio(prompt_vocal+prompt_bgm).permute(0,2,1)
-            
+                prompt_pairs = [(prompt_vocal, prompt_bgm)]
+            true_latent_list = []
+            first_latent_codes_vocal_list = []
+            first_latent_codes_bgm_list = []
+            for prompt_vocal_item, prompt_bgm_item in prompt_pairs:
+                true_latent, (first_latent_codes_vocal, first_latent_codes_bgm) = self.encode_prompt(prompt_vocal_item, prompt_bgm_item)
+                true_latent_list.append(true_latent)
+                first_latent_codes_vocal_list.append(first_latent_codes_vocal)
+                first_latent_codes_bgm_list.append(first_latent_codes_bgm)
+            true_latent = torch.cat(true_latent_list, 0)
+            first_latent_codes_vocal = torch.cat(first_latent_codes_vocal_list, 0).expand(codes_vocal.shape[0], -1, -1)
+            first_latent_codes_bgm = torch.cat(first_latent_codes_bgm_list, 0).expand(codes_bgm.shape[0], -1, -1)
+
             first_latent[:,0:true_latent.shape[1],:] = true_latent
             first_latent_length = true_latent.shape[1]
-            first_latent_codes = self.sound2code(prompt_vocal, prompt_bgm)
-            first_latent_codes_vocal = first_latent_codes[0]
-            first_latent_codes_bgm = first_latent_codes[1]
             first_latent_codes_length = first_latent_codes_vocal.shape[-1]
             codes_vocal = torch.cat([first_latent_codes_vocal, codes_vocal], -1)
             codes_bgm = torch.cat([first_latent_codes_bgm, codes_bgm], -1)
             
 
+        if not chain_windows:
+            return self.code2sound_parallel(codes_vocal, codes_bgm, first_latent, first_latent_length, first_latent_codes_length,
+                                            min_samples, num_steps, disable_progress, chunk_size)
+
         codes_len= codes_vocal.shape[-1]
         target_len = int((codes_len - first_latent_codes_length) / 100 * 4 * self.sample_rate)
         # target_len = int(codes_len / 100 * 4 * self.sample_rate)
@@ -244,45 +282,194 @@ class Tango:
             codes_vocal = codes_vocal[:,:,0:len_codes]
             codes_bgm = codes_bgm[:,:,0:len_codes]
         latent_length = min_samples
+        decoded_list = []
         latent_list = []
+        num_windows = len(range(0, codes_vocal.shape[-1]-hop_samples, hop_samples))
+        # Opt-in (self.pipeline_decode unless given): the VAE then runs alongside the diffusion, which
+        # raises peak memory (no cache flush between them). MPS command queues are not safe to drive from two threads.
+        pipeline_decode = (self.pipeline_decode if pipeline_decode is None else pipeline_decode) and not torch.backends.mps.is_available()
+        if pipeline_decode:
+            # The VAE decodes finished windows on a worker while the next window is diffused
+            decode_queue = queue.Queue(maxsize=2)
+            decode_errors = []
+            decode_stream = torch.cuda.Stream(device=codes_vocal.device) if codes_vocal.device.type == 'cuda' else None
+
+            def decode_worker():
+                try:
+                    while True:
+                        item = decode_queue.get()
+                        if item is None:
+                            return
+                        check_cancelled()
+                        latent, ready = item
+                        if decode_stream is not None:
+                            decode_stream.wait_event(ready)
+                            # the allocator must not hand the latent's memory out again before the decode is done
+                            latent.record_stream(decode_stream)
+                            with torch.cuda.stream(decode_stream):
+                                decoded_list.append(self.decode_window(latent, chunked, chunk_size))
+                        else:
+                            decoded_list.append(self.decode_window(latent, chunked, chunk_size))
+                        self._report_progress('vae', len(decoded_list), num_windows)
+                except Exception as e:
+                    decode_errors.append(e)
+                    # keep draining so the producer never blocks on a full queue
+                    while decode_queue.get() is not None:
+                        pass
+
+            decode_thread = threading.Thread(target=decode_worker, daemon=True)
+            decode_thread.start()
+
+        def submit(latent):
+            if pipeline_decode:
+                ready = None
+                if decode_stream is not None:
+                    ready = torch.cuda.Event()
+                    ready.record()
+                decode_queue.put((latent, ready))
+            else:
+                latent_list.append(latent)
+
         spk_embeds = torch.zeros([1, 32, 1, 32], device=codes_vocal.device)
-        with torch.autocast(device_type="cuda", dtype=torch.float16):
-            for sinx in range(0, codes_vocal.shape[-1]-hop_samples, hop_samples):
-                codes_vocal_input=codes_vocal[:,:,sinx:sinx+min_samples]
-                codes_bgm_input=codes_bgm[:,:,sinx:sinx+min_samples]
-                if(sinx == 0):
-                    incontext_length = first_latent_length
-                    latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, first_latent, latent_length, incontext_length=incontext_length, additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
-                    latent_list.append(latents)
-                else:
-                    true_latent = latent_list[-1][:,:,-ovlp_frames:].permute(0,2,1)
-                    len_add_to_1000 = min_samples - true_latent.shape[-2]
-                    incontext_length = true_latent.shape[-2]
-                    true_latent = torch.cat([true_latent, torch.randn(true_latent.shape[0],  len_add_to_1000, true_latent.shape[-1]).to(self.device)], -2)
-                    latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, true_latent, latent_length, incontext_length=incontext_length,  additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
-                    latent_list.append(latents)
-
-        latent_list = [l.float() for l in latent_list]
-        latent_list[0] = latent_list[0][:,:,first_latent_length:]
+        try:
+            with self.precision.autocast():
+                for sinx in range(0, codes_vocal.shape[-1]-hop_samples, hop_samples):
+                    check_cancelled()
+                    if pipeline_decode and decode_errors:
+                        # the decode worker failed, don't diffuse windows nobody will decode (raised below)
+                        break
+                    codes_vocal_input=codes_vocal[:,:,sinx:sinx+min_samples]
+                    codes_bgm_input=codes_bgm[:,:,sinx:sinx+min_samples]
+                    if(sinx == 0):
+                        incontext_length = first_latent_length
+                        latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, first_latent, latent_length, incontext_length=incontext_length, additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
+                    else:
+                        true_latent = prev_latents[:,:,-ovlp_frames:].permute(0,2,1)
+                        len_add_to_1000 = min_samples - true_latent.shape[-2]
+                        incontext_length = true_latent.shape[-2]
+                        true_latent = torch.cat([true_latent, torch.randn(true_latent.shape[0],  len_add_to_1000, true_latent.shape[-1]).to(self.device)], -2)
+                        latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, true_latent, latent_length, incontext_length=incontext_length,  additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
+                    prev_latents = latents
+                    self._report_progress('diffusion', sinx // hop_samples + 1, num_windows)
+                    # the prompt latent in front of the first window is not part of the song
+                    submit(latents[:,:,first_latent_length:] if sinx == 0 else latents)
+        finally:
+            if pipeline_decode:
+                decode_queue.put(None)
+                decode_thread.join()
+        if pipeline_decode and decode_errors:
+            raise decode_errors[0]
+
         min_samples =  int(min_samples * self.sample_rate // 1000 * 40)
         hop_samples = int(hop_samples * self.sample_rate // 1000 * 40)
         ovlp_samples = min_samples - hop_samples
+        if not pipeline_decode:
+            torch.cuda.empty_cache()
+            decoded_list = []
+            for latent in latent_list:
+                check_cancelled()
+                decoded_list.append(self.decode_window(latent, chunked, chunk_size))
+                self._report_progress('vae', len(decoded_list), num_windows)
+
+        output = None
+        for cur_output in decoded_list:
+            if output is None:
+                output = cur_output
+            else:
+                ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
+                ov_win = torch.cat([ov_win, 1 - ov_win], -1)
+                output[..., -ovlp_samples:] = output[..., -ovlp_samples:] * ov_win[:, -ovlp_samples:] + cur_output[..., 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
+                output = torch.cat([output, cur_output[..., ovlp_samples:]], -1)
+        output = output[..., 0:target_len]
+        return output # [B, C, T]
+
+    @torch.no_grad()
+    def code2sound_parallel(self, codes_vocal, codes_bgm, first_latent, first_latent_length, first_latent_codes_length,
+                            min_samples, num_steps, disable_progress, chunk_size=128):
+        """Diffuse every window in one batched solve and crossfade the seams in latent space.
+
+        Windows are not conditioned on each other: each one carries the prompt codes and
+        latent (if any) in front, so all of them share the same in-context length and can
+        be stacked on the batch dimension.
+        """
+        batch_size = codes_vocal.shape[0]
+        prompt_codes_vocal = codes_vocal[:,:,0:first_latent_codes_length]
+        prompt_codes_bgm = codes_bgm[:,:,0:first_latent_codes_length]
+        codes_vocal = codes_vocal[:,:,first_latent_codes_length:]
+        codes_bgm = codes_bgm[:,:,first_latent_codes_length:]
+        target_frames = codes_vocal.shape[-1]
+        target_len = int(target_frames / 100 * 4 * self.sample_rate)
+
+        win_frames = min_samples - first_latent_codes_length
+        hop_frames = win_frames // 4 * 3
+        ovlp_frames = win_frames - hop_frames
+        num_windows = max(1, math.ceil((target_frames - ovlp_frames) / float(hop_frames)))
+        len_codes = (num_windows - 1) * hop_frames + win_frames
+        while(codes_vocal.shape[-1] < len_codes):
+            codes_vocal = torch.cat([codes_vocal, codes_vocal], -1)
+            codes_bgm = torch.cat([codes_bgm, codes_bgm], -1)
+
+        # [num_windows * B, 1, min_samples], window-major
+        codes_vocal_input = torch.cat([torch.cat([prompt_codes_vocal, codes_vocal[:,:,w*hop_frames:w*hop_frames+win_frames]], -1) for w in range(num_windows)], 0)
+        codes_bgm_input = torch.cat([torch.cat([prompt_codes_bgm, codes_bgm[:,:,w*hop_frames:w*hop_frames+win_frames]], -1) for w in range(num_windows)], 0)
+        true_latent = first_latent.repeat(num_windows, 1, 1)
+        spk_embeds = torch.zeros([1, 32, 1, 32], device=codes_vocal.device)
+        self._report_progress('diffusion', 0, 1)
+        with self.precision.autocast():
+            latents = self.model.inference_codes([codes_vocal_input,codes_bgm_input], spk_embeds, true_latent, min_samples, incontext_length=first_latent_length, additional_feats=[], guidance_scale=1.5, num_steps = num_steps, disable_progress=disable_progress, scenario='other_seg')
+        latents = latents.float()
+        # Windows are stitched on the frames of their own codes; like code2sound, the song
+        # then starts at the prompt latent's length, which can differ from the prompt codes'
+        lead = latents[0:batch_size, :, first_latent_length:first_latent_codes_length]
+        latents = latents[:,:,first_latent_codes_length:].reshape(num_windows, batch_size, latents.shape[1], win_frames)
+
+        ov_win = torch.linspace(0, 1, ovlp_frames, device=latents.device)
+        latent = latents[0]
+        for w in range(1, num_windows):
+            cur_latent = latents[w]
+            blend = latent[..., -ovlp_frames:] * (1 - ov_win) + cur_latent[..., 0:ovlp_frames] * ov_win
+            latent = torch.cat([latent[..., :-ovlp_frames], blend, cur_latent[..., ovlp_frames:]], -1)
+        latent = torch.cat([lead, latent], -1)[..., max(0, first_latent_length - first_latent_codes_length):]
+        latent = latent[..., 0:target_frames]
+
+        self._report_progress('diffusion', 1, 1)
+
         torch.cuda.empty_cache()
-        with torch.no_grad():
-            output = None
-            for i in range(len(latent_list)):
-                latent = latent_list[i]
-                cur_output = self.vae.decode_audio(latent, chunked=chunked, chunk_size=chunk_size)[0].detach().cpu()
-
-                if output is None:
-                    output = cur_output
-                else:
-                    ov_win = torch.from_numpy(np.linspace(0, 1, ovlp_samples)[None, :])
-                    ov_win = torch.cat([ov_win, 1 - ov_win], -1)
-                    output[:, -ovlp_samples:] = output[:, -ovlp_samples:] * ov_win[:, -ovlp_samples:] + cur_output[:, 0:ovlp_samples] * ov_win[:, 0:ovlp_samples]
-                    output = torch.cat([output, cur_output[:, ovlp_samples:]], -1)
-            output = output[:, 0:target_len]
-        return output
+        # The whole song is decoded at once, so always decode it in chunks
+        output = self.decode_window(latent, chunked=latent.shape[-1] > chunk_size, chunk_size=chunk_size)
+        self._report_progress('vae', 1, 1)
+        return output[..., 0:target_len] # [B, C, T]
+
+    @torch.no_grad()
+    def decode_window(self, latent, chunked=False, chunk_size=128):
+        """VAE-decode one diffusion window [B, 64, T] to CPU audio [B, C, T]."""
+        dtype = self.precision.dtype or torch.float32
+        return self.vae.decode_audio(latent.to(dtype), chunked=chunked, chunk_size=chunk_size).detach().float().cpu()
+
+    def crop_prompt(self, prompt):
+        """Keep the 10s of a prompt [..., T] that code2sound conditions on."""
+        if(prompt.shape[-1] < int(30 * self.sample_rate)):
+            # if less than 30s, just choose the first 10s
+            return prompt[...,:int(10*self.sample_rate)] # limit max length to 10.24
+        # else choose from 20.48s which might includes verse or chorus
+        return prompt[...,int(20*self.sample_rate):int(30*self.sample_rate)] # limit max length to 10.24
+
+    @torch.no_grad()
+    def encode_prompt(self, prompt_vocal, prompt_bgm):
+        """Crop a prompt to 10s and return its VAE latent [1, T, 64] and its (vocal, bgm) codes."""
+        if(prompt_vocal.ndim == 1):
+            prompt_vocal = prompt_vocal.unsqueeze(0).repeat(2,1)
+            prompt_bgm = prompt_bgm.unsqueeze(0).repeat(2,1)
+        elif(prompt_vocal.ndim == 2):
+            if(prompt_vocal.shape[0] == 1):
+                prompt_vocal = prompt_vocal.repeat(2,1)
+                prompt_bgm = prompt_bgm.repeat(2,1)
+
+        prompt_vocal = self.crop_prompt(prompt_vocal)
+        prompt_bgm = self.crop_prompt(prompt_bgm)
+        
+        true_latent = self.vae.encode_audio(prompt_vocal+prompt_bgm).permute(0,2,1)
+        return true_latent, self.sound2code(prompt_vocal, prompt_bgm)
 
     @torch.no_grad()
     def preprocess_audio(self, input_audios_vocal, threshold=0.8):
@@ -299,12 +486,17 @@ class Tango:
         codes_vocal, codes_bgm = self.sound2code(orig_vocal,orig_bgm)
         codes=[codes_vocal, codes_bgm]
         wave = self.code2sound(codes, prompt_vocal,prompt_bgm, guidance_scale=1.5, num_steps=steps, disable_progress=disable_progress)
-        return wave
+        return wave[0]
     
     def to(self, device=None, dtype=None, non_blocking=False):
+        if isinstance(device, torch.dtype):
+            device, dtype = None, device
         if device is not None:
             self.device = device
             self.model.device = device
         self.vae = self.vae.to(device, dtype, non_blocking)
         self.model = self.model.to(device, dtype, non_blocking)
+        if dtype is not None:
+            # the estimator and VAE decoder dtypes are the precision policy's
+            self.set_precision(self.precision.name)
         return self
@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 from torch.nn.utils import weight_norm
+from .nearest import nearest_decode_latents
 
 def WNConv1d(*args, **kwargs):
     return weight_norm(nn.Conv1d(*args, **kwargs))
@@ -78,6 +79,8 @@ class VectorQuantize(nn.Module):
         return self.embed_code(embed_id).transpose(1, 2)
 
     def decode_latents(self, latents):
+        if not self.training:
+            return nearest_decode_latents(self, latents)
         encodings = rearrange(latents, "b d t -> (b t) d")
         codebook = self.codebook.weight  # codebook: (N x D)
 
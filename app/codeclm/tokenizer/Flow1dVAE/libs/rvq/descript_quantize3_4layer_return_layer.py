@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 from torch.nn.utils import weight_norm
+from .nearest import nearest_decode_latents
 import random
 
 def WNConv1d(*args, **kwargs):
@@ -80,6 +81,8 @@ class VectorQuantize(nn.Module):
         return self.embed_code(embed_id).transpose(1, 2)
 
     def decode_latents(self, latents):
+        if not self.training:
+            return nearest_decode_latents(self, latents)
         encodings = rearrange(latents, "b d t -> (b t) d")
         codebook = self.codebook.weight  # codebook: (N x D)
 
@@ -7,6 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange
 from torch.nn.utils import weight_norm
+from .nearest import nearest_decode_latents
 
 def WNConv1d(*args, **kwargs):
     return weight_norm(nn.Conv1d(*args, **kwargs))
@@ -92,6 +93,8 @@ class VectorQuantize(nn.Module):
         return code
 
     def decode_latents(self, latents):
+        if not self.training:
+            return nearest_decode_latents(self, latents)
         encodings = rearrange(latents, "b d t -> (b t) d")
         codebook = self.codebook.weight  # codebook: (N x D)
 
@@ -0,0 +1,57 @@
+"""
+Inference-time codebook lookup shared by the l2-normalized VQ variants
+(descript_quantize*, musicfm rvq).
+
+With unit-norm encodings and codes, the euclidean distance |e|^2 - 2 e.c + |c|^2
+ranks codes exactly like the dot product e.c, so the nearest code is an argmax
+of dot products. The search runs over row chunks so the (rows x codebook_size)
+score matrix never exceeds MAX_SCORE_BYTES, and the normalized codebook is cached
+on the embedding until its weight changes (new tensor, in-place update, device or
+dtype move). nearest_decode_latents is the eval branch of their decode_latents.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from einops import rearrange
+
+# Upper bound of one chunk of the score matrix (16384 codes -> 1024 rows per chunk in fp32)
+MAX_SCORE_BYTES = 64 * 1024 * 1024
+
+
+@torch.no_grad()
+def normalized_codebook(codebook: nn.Embedding) -> torch.Tensor:
+    weight = codebook.weight
+    key = (weight.data_ptr(), weight._version, weight.device, weight.dtype, tuple(weight.shape))
+    cached = getattr(codebook, "_normalized_cache", None)
+    if cached is None or cached[0] != key:
+        cached = (key, F.normalize(weight.detach()))
+        codebook._normalized_cache = cached
+    return cached[1]
+
+
+@torch.no_grad()
+def nearest_codes(encodings: torch.Tensor, codebook: torch.Tensor, max_score_bytes: int = None) -> torch.Tensor:
+    """
+    Index of the highest dot product code for each row.
+    encodings: (M x D) l2-normalized, codebook: (N x D) l2-normalized -> (M,) long
+    """
+    codebook_t = codebook.to(encodings.dtype).t()
+    rows = max(1, (max_score_bytes or MAX_SCORE_BYTES) // (codebook.shape[0] * encodings.element_size()))
+    if encodings.shape[0] <= rows:
+        return (encodings @ codebook_t).argmax(1)
+    indices = torch.empty(encodings.shape[0], dtype=torch.long, device=encodings.device)
+    for start in range(0, encodings.shape[0], rows):
+        indices[start:start + rows] = (encodings[start:start + rows] @ codebook_t).argmax(1)
+    return indices
+
+
+@torch.no_grad()
+def nearest_decode_latents(quantizer: nn.Module, latents: torch.Tensor):
+    """
+    Inference decode_latents of a VectorQuantize-style module (codebook, decode_code).
+    latents: (B x D x T) -> (quantized latents (B x D x T), indices (B x T))
+    """
+    encodings = rearrange(latents, "b d t -> (b t) d")
+    indices = nearest_codes(F.normalize(encodings), normalized_codebook(quantizer.codebook))
+    indices = rearrange(indices, "(b t) -> b t", b=latents.size(0))
+    return quantizer.decode_code(indices), indices
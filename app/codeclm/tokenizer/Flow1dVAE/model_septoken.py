@@ -23,6 +23,7 @@ from models_gpt.models.gpt2_config import GPT2Config
 from our_MERT_BESTRQ.mert_fairseq.models.musicfm.musicfm_model import MusicFMModel, MusicFMConfig
 
 from torch.cuda.amp import autocast
+from codeclm.utils.cancellation import check_cancelled
 
 class HubertModelWithFinalProj(HubertModel):
     def __init__(self, config):
@@ -155,10 +156,14 @@ class BASECFM(torch.nn.Module, ABC):
                 return torch.cat([z, z], 0) if z is not None else None
             attention_mask = double(attention_mask)
 
-        x_next = x.clone()
-        noise = x.clone()
+        # The ODE state stays fp32 whatever the estimator runs in
+        estimator_dtype = self.estimator.dtype
+        x_next = x.float()
+        noise = x_next.clone()
+        incontext_x = incontext_x.float()
 
         for i in tqdm(range(len(dt))):
+            check_cancelled()
             ti = t[i]
 
             x_next[:, :incontext_length] = (
@@ -180,10 +185,10 @@ class BASECFM(torch.nn.Module, ABC):
                 ], dim=2)
                 timestep = ti.expand(B)
 
-            v = self.estimator(inputs_embeds=model_input,
+            v = self.estimator(inputs_embeds=model_input.to(estimator_dtype),
                             attention_mask=attention_mask,
                             time_step=timestep).last_hidden_state
-            v = v[..., -x.shape[2]:]
+            v = v[..., -x.shape[2]:].float()
 
             if guidance_scale > 1.0:
                 v_uncond, v_cond = v.chunk(2, 0)
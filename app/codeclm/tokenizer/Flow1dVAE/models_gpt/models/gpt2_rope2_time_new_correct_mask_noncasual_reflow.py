@@ -15,6 +15,7 @@
 # limitations under the License.
 """PyTorch OpenAI GPT-2 model."""
 
+import functools
 import math
 import os
 import warnings
@@ -286,7 +287,7 @@ class GPT2Attention(nn.Module):
         
         query = query.transpose(1, 2)
         
-        freqs_cis= precompute_freqs_cis(dim=query.size(-1), end=query.size(1)).to(query.device)
+        freqs_cis= cached_freqs_cis(query.size(-1), query.size(1), query.device)
         query = apply_rotary_emb(query, freqs_cis)
         query = query.transpose(1, 2)
         if query.shape == key.shape:
@@ -482,6 +483,11 @@ def precompute_freqs_cis(dim: int, end: int, constant: float = 10000.0):
     # 其中j为虚数单位， m=0,1,...,length-1
     return freqs_cis # [length, d/2]
 
+@functools.lru_cache(maxsize=16)
+def cached_freqs_cis(dim: int, end: int, device: torch.device):
+    """precompute_freqs_cis on device, built once per (dim, end, device) instead of once per attention call."""
+    return precompute_freqs_cis(dim, end).to(device)
+
 def reshape_for_broadcast(freqs_cis: torch.Tensor, x: torch.Tensor):
     ndim = x.ndim
     assert 0 <= 1 < ndim
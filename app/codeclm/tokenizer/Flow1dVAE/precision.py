@@ -0,0 +1,89 @@
+"""
+Precision policies of Tango's decode path: the diffusion estimator and the VAE decoder.
+
+A reduced precision policy casts both to bf16 or fp16 but keeps fp32 islands where
+the short mantissa / narrow range hurts: LayerNorms of the estimator and SnakeBeta
+activations of the VAE decoder run in fp32 (inputs upcast, outputs cast back), RoPE
+rotates in fp32 complex (apply_rotary_emb) and solve_euler keeps the ODE state and the
+CFG combination in fp32, casting only the estimator input. Everything else of Tango
+(the code embeddings, the prompt encoder) stays fp32.
+
+'auto' is the behaviour from before there were policies: fp32 weights, with fp16
+autocast around the diffusion on CUDA (a no-op on MPS and CPU).
+"""
+from dataclasses import dataclass
+from typing import Optional, Sequence, Type
+
+import torch
+import torch.nn as nn
+
+DEFAULT_PRECISION = 'auto'
+
+
+@dataclass(frozen=True)
+class PrecisionPolicy:
+    name: str
+    dtype: Optional[torch.dtype]  # estimator and VAE decoder weights, None: leave as loaded
+    cuda_autocast: bool = False   # fp16 autocast around the diffusion on CUDA
+
+    def autocast(self):
+        """Context for the diffusion; explicit policies also switch off any enclosing CUDA autocast."""
+        if self.cuda_autocast:
+            return torch.autocast(device_type="cuda", dtype=torch.float16)
+        return torch.autocast(device_type="cuda", enabled=False)
+
+
+PRECISION_POLICIES = {
+    'auto': PrecisionPolicy('auto', None, cuda_autocast=True),
+    'fp32': PrecisionPolicy('fp32', torch.float32),
+    'bf16': PrecisionPolicy('bf16', torch.bfloat16),
+    'fp16': PrecisionPolicy('fp16', torch.float16),
+}
+
+
+def get_policy(name: Optional[str]) -> PrecisionPolicy:
+    if name is None:
+        name = DEFAULT_PRECISION
+    if name not in PRECISION_POLICIES:
+        raise ValueError(f"Unknown decode precision: {name} ({', '.join(PRECISION_POLICIES)})")
+    return PRECISION_POLICIES[name]
+
+
+def _upcast_inputs(module, args):
+    return tuple(a.float() if torch.is_tensor(a) and a.is_floating_point() else a for a in args)
+
+
+def remove_fp32_islands(module: nn.Module):
+    for child in module.modules():
+        for handle in child.__dict__.pop('_fp32_island_hooks', ()):
+            handle.remove()
+
+
+def add_fp32_islands(module: nn.Module, island_types: Sequence[Type[nn.Module]], dtype: torch.dtype) -> int:
+    """
+    Keep the island_types submodules of a module cast to dtype in fp32: their inputs are
+    upcast and their outputs cast back to dtype. Returns the number of islands.
+    """
+    count = 0
+    for child in module.modules():
+        if not isinstance(child, tuple(island_types)):
+            continue
+        child.float()
+        child._fp32_island_hooks = (
+            child.register_forward_pre_hook(_upcast_inputs),
+            child.register_forward_hook(lambda m, args, out: out.to(dtype)),
+        )
+        count += 1
+    return count
+
+
+def apply_precision(module: nn.Module, policy: PrecisionPolicy, island_types: Sequence[Type[nn.Module]] = ()) -> int:
+    """Cast a module to the policy dtype with fp32 islands; returns the number of islands."""
+    remove_fp32_islands(module)
+    if policy.dtype is None:
+        module.float()
+        return 0
+    module.to(policy.dtype)
+    if policy.dtype == torch.float32:
+        return 0
+    return add_fp32_islands(module, island_types, policy.dtype)
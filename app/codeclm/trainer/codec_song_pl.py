@@ -16,6 +16,7 @@ import lightning as pl
 from torchmetrics.classification import MulticlassAccuracy
 import pdb
 from codeclm.models import builders
+from codeclm.utils.weight_quant import prepare_quantized_model
 import math
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
@@ -26,12 +27,14 @@ os.environ['TOKENIZERS_PARALLELISM'] = "false"
 
 
 class CodecLM_PL(pl.LightningModule):
-    def __init__(self, cfg, ckpt_path):
+    def __init__(self, cfg, ckpt_path, progress_callback: tp.Optional[tp.Callable[[str], None]] = None):
         super().__init__()
 
         self.cfg = cfg
+        report = progress_callback if progress_callback is not None else (lambda stage: None)
         
         # 1) Build audio tokenizer (usually None during training)
+        report('tokenizer')
         self.audio_tokenizer = builders.get_audio_tokenizer_model(self.cfg.audio_tokenizer_checkpoint, self.cfg)
         if self.audio_tokenizer is not None:
             for param in self.audio_tokenizer.parameters():
@@ -44,10 +47,15 @@ class CodecLM_PL(pl.LightningModule):
             self.seperate_tokenizer = None
         
         # 2) Build LM
+        report('lm')
         self.audiolm = builders.get_lm_model(self.cfg)
         print(self.audiolm)
         # 3) Load pretrained checkpoint (if any)
+        report('checkpoint')
         checkpoint = torch.load(ckpt_path, map_location='cpu')
+        # Weight-only quantized checkpoints (tools/quantize_lm.py) swap in QuantLinear layers first
+        if prepare_quantized_model(self, checkpoint):
+            print("quantized checkpoint: LM linears stay int8/int4")
         missing, unexpected = self.load_state_dict(checkpoint, strict=False)
         print("successfully load pretrained model {}".format(ckpt_path))
         # 4) Build metrics
@@ -0,0 +1,35 @@
+"""Cooperative cancellation for long-running generation.
+
+A single process-wide flag that the model server sets from its `/cancel` handler while
+the generation runs on another thread. The LM token loop, the diffusion step loop and
+the code2sound window loop call `check_cancelled()` so a cancel takes effect within one
+token or step instead of after the whole song has been decoded.
+"""
+import threading
+
+
+class GenerationCancelled(Exception):
+    """Raised from a cancellation point once a cancel has been requested."""
+
+
+_cancel_event = threading.Event()
+
+
+def request_cancel():
+    """Ask the running generation to stop at its next cancellation point."""
+    _cancel_event.set()
+
+
+def clear_cancel():
+    """Reset the flag before starting a new job."""
+    _cancel_event.clear()
+
+
+def is_cancel_requested() -> bool:
+    return _cancel_event.is_set()
+
+
+def check_cancelled():
+    """Cancellation point: raise `GenerationCancelled` if a cancel has been requested."""
+    if _cancel_event.is_set():
+        raise GenerationCancelled("Generation was cancelled")
@@ -0,0 +1,218 @@
+"""
+Offload planning for the LM: given a device memory budget and per-layer sizes, decide
+which layers stay resident on the device and which are streamed from host memory by
+OffloadProfiler, and at which dtype.
+
+Cost model, per decoding step (every layer runs once):
+    compute_ms = sum over all layers of layer_bytes / device_gbps   (decoding is weight bound)
+    copy_ms    = sum over streamed layers of layer_bytes / h2d_gbps
+    step_ms    = max(compute_ms, copy_ms)                           (copies overlap compute)
+Memory:
+    fixed + resident layers + (pre_copy_step + 1) staging slots of the largest streamed
+    layer + largest layer activation + reserve <= budget
+
+The planner is pure python over LayerProfile lists, so it can be exercised with
+synthetic profiles on CPU; profile_layers() measures them from a real module.
+"""
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import torch
+
+# Streaming units of LmModel: the decoder layers of both transformers (and the other
+# leaves of those sub-models), as in the hand-written offload configs
+DEFAULT_LM_OFFLOAD_LAYERS = {'transformer': 4, 'transformer2': 4}
+# Rough host->device copy and device memory bandwidths when nothing was measured
+DEFAULT_H2D_GBPS = 12.0
+DEFAULT_DEVICE_GBPS = 300.0
+# Device memory kept free for the KV cache and sampling while the LM runs
+LM_RESERVE_GB = 3.0
+DTYPE_BYTES = {'torch.float32': 4, 'torch.float16': 2, 'torch.bfloat16': 2}
+
+
+@dataclass
+class LayerProfile:
+    name: str                     # module path, e.g. "transformer.model.layers.3"
+    float_params: int             # floating point elements, stored at the plan dtype
+    other_bytes: int = 0          # non floating point tensors (dtype independent)
+    activation_elements: int = 0  # largest transient activation of one forward, in elements
+
+    def nbytes(self, dtype: str) -> int:
+        return self.float_params * DTYPE_BYTES[dtype] + self.other_bytes
+
+
+@dataclass
+class OffloadPlan:
+    dtype: str
+    offload_layer_dict: Dict[str, int]
+    resident_layer_list: List[str]
+    streamed_layer_list: List[str]
+    pre_copy_step: int
+    max_pre_copy_step: int
+    resident_bytes: int
+    streamed_bytes: int
+    memory_bytes: int
+    budget_bytes: int
+    expected_step_ms: float
+    extra: dict = field(default_factory=dict)
+
+    @property
+    def streams(self) -> bool:
+        return len(self.streamed_layer_list) > 0
+
+    def to_config(self, offload_module: str = "self") -> dict:
+        """Offload section in the layout OffloadParamParse.parse_config reads (wrap with OmegaConf.create)."""
+        config = {
+            'offload_module': offload_module,
+            'cpu_mem_gb': -1,
+            'dtype': self.dtype,
+            'pre_copy_step': self.pre_copy_step,
+            'max_pre_copy_step': self.max_pre_copy_step,
+            'offload_layer_dict': dict(self.offload_layer_dict),
+            'resident_layer_list': list(self.resident_layer_list),
+            'ignore_layer_list': [],
+        }
+        config.update(self.extra)
+        return config
+
+    def summary(self) -> str:
+        gb = 1024 ** 3
+        return (f"{len(self.resident_layer_list)} resident / {len(self.streamed_layer_list)} streamed layers, "
+                f"{self.dtype}, {self.resident_bytes / gb:.2f}GB resident, {self.streamed_bytes / gb:.2f}GB streamed, "
+                f"{self.memory_bytes / gb:.2f}/{self.budget_bytes / gb:.2f}GB, "
+                f"pre_copy_step {self.pre_copy_step}, ~{self.expected_step_ms:.1f}ms/step")
+
+
+def offload_units(module: torch.nn.Module, offload_layer_dict: Dict[str, int], tag: str = ""):
+    """
+    (name, module, streamable) for the children OffloadProfiler._offload_layer would wrap,
+    walking the tree with the same depth rule. Children outside offload_layer_dict are
+    yielded once as non-streamable.
+    """
+    for name, child in module.named_children():
+        current_tag = f"{tag}.{name}" if tag else name
+        pre_name = current_tag.split('.')[0]
+        if pre_name not in offload_layer_dict:
+            yield current_tag, child, False
+            continue
+        has_children = any(child.named_children()) and current_tag.count('.') + 1 < offload_layer_dict[pre_name]
+        if has_children:
+            yield from offload_units(child, offload_layer_dict, current_tag)
+        else:
+            yield current_tag, child, True
+
+
+def _tensor_sizes(tensors):
+    float_params, other_bytes = 0, 0
+    for t in tensors:
+        if t.is_floating_point():
+            float_params += t.numel()
+        else:
+            other_bytes += t.numel() * t.element_size()
+    return float_params, other_bytes
+
+
+def profile_layers(module: torch.nn.Module, offload_layer_dict: Dict[str, int] = DEFAULT_LM_OFFLOAD_LAYERS,
+                   tokens: int = 2):
+    """
+    Measure a module for the planner. Returns (fixed LayerProfile, streamable LayerProfiles):
+    fixed covers everything that always stays on the device. Activations are bounded by
+    the outputs of the Linear layers inside each unit for `tokens` rows (decoding with
+    CFG runs 2 rows per step).
+    """
+    layers = []
+    for name, child, streamable in offload_units(module, offload_layer_dict):
+        if not streamable:
+            continue
+        float_params, other_bytes = _tensor_sizes(child.parameters())
+        linear_outputs = sum(m.out_features for m in child.modules() if isinstance(m, torch.nn.Linear))
+        layers.append(LayerProfile(name, float_params, other_bytes, linear_outputs * tokens))
+    float_params, other_bytes = _tensor_sizes(list(module.parameters()) + list(module.buffers()))
+    fixed = LayerProfile("fixed", float_params - sum(l.float_params for l in layers),
+                         other_bytes - sum(l.other_bytes for l in layers))
+    return fixed, layers
+
+
+def _plan_for_dtype(fixed, layers, dtype, budget_bytes, reserve_bytes, h2d_gbps, device_gbps, max_pre_copy_step):
+    sizes = [layer.nbytes(dtype) for layer in layers]
+    activation = max([layer.activation_elements for layer in layers] + [0]) * DTYPE_BYTES[dtype]
+    compute_ms = sum(sizes) / (device_gbps * 1e6)
+    # Every resident byte saves the same copy time, so keep the largest layers resident
+    # first, which also shrinks the staging slots (stable sort: earlier layers among equals)
+    order = sorted(range(len(layers)), key=lambda i: -sizes[i])
+
+    best = None
+    resident_bytes = 0
+    for k in range(len(order) + 1):
+        if k:
+            resident_bytes += sizes[order[k - 1]]
+        streamed = order[k:]
+        streamed_bytes = sum(sizes[i] for i in streamed)
+        copy_ms = streamed_bytes / (h2d_gbps * 1e6)
+        if streamed:
+            per_layer_compute = compute_ms / len(layers)
+            per_layer_copy = copy_ms / len(streamed)
+            pre_copy_step = min(max_pre_copy_step, max(1, math.ceil(per_layer_copy / max(per_layer_compute, 1e-9))))
+            staging = (pre_copy_step + 1) * max(sizes[i] for i in streamed)
+        else:
+            pre_copy_step, staging = 1, 0
+        memory = fixed.nbytes(dtype) + resident_bytes + staging + activation + reserve_bytes
+        if memory > budget_bytes:
+            continue
+        step_ms = max(compute_ms, copy_ms)
+        key = (round(step_ms, 6), -resident_bytes)
+        if best is None or key < best[0]:
+            best = (key, k, pre_copy_step, resident_bytes, streamed_bytes, memory, step_ms)
+    if best is None:
+        return None
+    _, k, pre_copy_step, resident_bytes, streamed_bytes, memory, step_ms = best
+    resident = set(order[:k])
+    return dict(
+        dtype=dtype,
+        resident_layer_list=[layers[i].name for i in range(len(layers)) if i in resident],
+        streamed_layer_list=[layers[i].name for i in range(len(layers)) if i not in resident],
+        pre_copy_step=pre_copy_step, resident_bytes=resident_bytes, streamed_bytes=streamed_bytes,
+        memory_bytes=memory, expected_step_ms=step_ms,
+    )
+
+
+def plan_offload(fixed: LayerProfile, layers: Sequence[LayerProfile], budget_bytes: int,
+                 offload_layer_dict: Dict[str, int] = DEFAULT_LM_OFFLOAD_LAYERS,
+                 dtypes: Sequence[str] = ('torch.float16',), reserve_bytes: int = 0,
+                 h2d_gbps: Optional[float] = None, device_gbps: Optional[float] = None,
+                 max_pre_copy_step: int = 4) -> OffloadPlan:
+    """
+    Cheapest plan (expected step time, then most resident bytes) that fits budget_bytes.
+    dtypes are tried in order and the earlier one wins ties. Raises ValueError when even
+    streaming every layer does not fit.
+    """
+    h2d_gbps = h2d_gbps or DEFAULT_H2D_GBPS
+    device_gbps = device_gbps or DEFAULT_DEVICE_GBPS
+    best = None
+    for dtype in dtypes:
+        plan = _plan_for_dtype(fixed, layers, dtype, budget_bytes, reserve_bytes, h2d_gbps, device_gbps, max_pre_copy_step)
+        if plan is not None and (best is None or plan['expected_step_ms'] < best['expected_step_ms']):
+            best = plan
+    if best is None:
+        raise ValueError(f"No offload plan fits in {budget_bytes / 1024 ** 3:.2f}GB")
+    return OffloadPlan(offload_layer_dict=dict(offload_layer_dict), max_pre_copy_step=max_pre_copy_step,
+                       budget_bytes=budget_bytes, **best)
+
+
+def plan_module_offload(module: torch.nn.Module, budget_bytes: int, base_config=None,
+                        offload_layer_dict: Dict[str, int] = DEFAULT_LM_OFFLOAD_LAYERS, tokens: int = 2,
+                        **kwargs) -> OffloadPlan:
+    """
+    Profile module and plan its offload. Settings of a hand-written offload section
+    (base_config) that the planner does not decide, such as clean_cache_wrapper, are
+    carried into the plan's config.
+    """
+    fixed, layers = profile_layers(module, offload_layer_dict, tokens)
+    plan = plan_offload(fixed, layers, budget_bytes, offload_layer_dict, **kwargs)
+    if base_config is not None:
+        for key in ('offload_module', 'clean_cache_wrapper', 'debug'):
+            if key in base_config:
+                value = base_config[key]
+                plan.extra[key] = dict(value) if hasattr(value, 'keys') else value
+    return plan
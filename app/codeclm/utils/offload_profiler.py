@@ -1,7 +1,8 @@
+import collections
+import math
+import threading
 import torch
 from torch.func import functional_call
-import queue
-import threading
 from typing import Dict, List, Any
 import omegaconf
 from pydantic import BaseModel, validator
@@ -27,10 +28,12 @@ class OffloadParam(BaseModel):
     offload_module: Any 
     cpu_mem_gb: float
     pre_copy_step: Optional[int] = None
+    max_pre_copy_step: Optional[int] = None
     clean_cache_after_forward: Optional[bool] = None
     dtype: Optional[str] = None 
     offload_layer_dict: Dict[str, int] = {}
     ignore_layer_list: List[str] = []
+    resident_layer_list: List[str] = []
     clean_cache_wrapper: Optional[OffloadCleanCacheWrapperParam] = None
     debug: Optional[bool] = None
 
@@ -53,6 +56,8 @@ class OffloadParam(BaseModel):
         param_dict['cpu_mem_gb'] = self.cpu_mem_gb
         if self.pre_copy_step is not None:
             param_dict['pre_copy_step'] = self.pre_copy_step
+        if self.max_pre_copy_step is not None:
+            param_dict['max_pre_copy_step'] = self.max_pre_copy_step
         if self.clean_cache_after_forward is not None:
             param_dict['clean_cache_after_forward'] = self.clean_cache_after_forward
         if self.debug is not None:
@@ -65,6 +70,7 @@ class OffloadParam(BaseModel):
         param_dict['module'] = self.offload_module
         param_dict['offload_layer_dict'] = self.offload_layer_dict
         param_dict['ignore_layer_list'] = self.ignore_layer_list
+        param_dict['resident_layer_list'] = self.resident_layer_list
         param_dict['dtype'] = self.dtype
 
         return param_dict
@@ -126,6 +132,9 @@ class OffloadParamParse:
         pre_copy_step = cfg.pre_copy_step \
             if hasattr(cfg, "pre_copy_step") else None
 
+        max_pre_copy_step = cfg.max_pre_copy_step \
+            if hasattr(cfg, "max_pre_copy_step") else None
+
         clean_cache_after_forward = cfg.clean_cache_after_forward \
             if hasattr(cfg, "clean_cache_after_forward") else None
             
@@ -134,6 +143,9 @@ class OffloadParamParse:
 
         ignore_layer_list = cfg.ignore_layer_list \
             if hasattr(cfg, "ignore_layer_list") else []
+
+        resident_layer_list = list(cfg.resident_layer_list) \
+            if hasattr(cfg, "resident_layer_list") else []
         
         debug = cfg.debug if hasattr(cfg, "debug") else None
         
@@ -152,101 +164,232 @@ class OffloadParamParse:
             offload_module=offload_module,
             cpu_mem_gb=cpu_mem_gb,
             pre_copy_step=pre_copy_step,
+            max_pre_copy_step=max_pre_copy_step,
             clean_cache_after_forward=clean_cache_after_forward,
             dtype=dtype,
             offload_layer_dict=offload_layer_dict,
             ignore_layer_list=ignore_layer_list,
+            resident_layer_list=resident_layer_list,
             clean_cache_wrapper=clean_cache_wrapper,
             debug=debug
             )
 
 
-class LayerParamStruct:
-    def __init__(self):
-        self.count = 0
-        self.device_state = None
+# Byte alignment of each parameter inside a packed layer buffer (keeps dtype views valid)
+PACK_ALIGN = 64
+
+
+def _align(offset):
+    return (offset + PACK_ALIGN - 1) // PACK_ALIGN * PACK_ALIGN
+
+
+class OffloadedLayer:
+    """
+    Offloaded parameters of one layer, packed back to back into a single host buffer
+    (pinned when the platform supports it) so a layer moves to the device in one copy.
+    """
+    def __init__(self, module, params, pin_memory):
+        self.module = module
+        self.names = []
+        self.specs = []  # (offset, nbytes, dtype, shape)
+        nbytes = 0
+        for name, param in params:
+            offset = _align(nbytes)
+            size = param.data.numel() * param.data.element_size()
+            self.names.append(name)
+            self.specs.append((offset, size, param.data.dtype, param.data.shape))
+            nbytes = offset + size
+        self.nbytes = nbytes
+        self.host = torch.empty(nbytes, dtype=torch.uint8, device='cpu', pin_memory=pin_memory)
+        for (name, param), spec in zip(params, self.specs):
+            view = self.view(self.host, spec)
+            view.copy_(param.data)
+            param.data = view
+
+    @staticmethod
+    def view(buffer, spec):
+        offset, size, dtype, shape = spec
+        return buffer[offset:offset + size].view(dtype).view(shape)
+
+    def device_state(self, buffer):
+        """Parameter views into a device staging buffer holding a copy of this layer."""
+        return {name: self.view(buffer, spec) for name, spec in zip(self.names, self.specs)}
+
+
+class StagingSlot:
+    """Reusable device buffer one offloaded layer is copied into before its forward."""
+    FREE, LOADED, RUNNING = range(3)
+
+    def __init__(self, nbytes, device):
+        self.buffer = torch.empty(nbytes, dtype=torch.uint8, device=device)
+        self.state = StagingSlot.FREE
+        self.owner = None
+        self.ready_event = torch.cuda.Event()  # copy into the slot finished
+        self.free_event = torch.cuda.Event()   # last forward reading the slot finished
+        self.free_event.record(torch.cuda.current_stream(device))
 
 
 class OffloadProfiler:
-    def __init__(self, device_index=0, cpu_mem_gb=-1, pre_copy_step=1, clean_cache_after_forward=False, debug=False):
-        self.clean_cache_after_forward = clean_cache_after_forward
+    """
+    Streams offloaded layers from host memory through a ring of device staging slots.
+    Each layer's parameters live in one contiguous host buffer; a copy thread moves the
+    next layers into free slots on a side stream while the current layer computes. The
+    ring starts as a double buffer and the prefetch depth (and with it the ring, up to
+    max_pre_copy_step + 1 slots) follows the measured copy / compute time ratio.
+    """
+    def __init__(self, device_index=0, cpu_mem_gb=-1, pre_copy_step=1, clean_cache_after_forward=False, debug=False,
+                 max_pre_copy_step=4):
+        if clean_cache_after_forward:
+            print("clean_cache_after_forward ignored: offloaded weights use persistent staging buffers")
         self.cpu_mem_gb = cpu_mem_gb
         self.cpu_mem_b_count = 0
         self.device_index = device_index
+        self.device = torch.device(f"cuda:{device_index}")
         self.execution_order = []
-        self.execution_order_idx = {} 
+        self.execution_order_idx = {}
         self.pin_memory = False
         test_data = torch.rand(1,1, device='cpu')
         pin_data = test_data.pin_memory()
         self.pin_memory = pin_data.is_pinned()
         print(f"pin:{self.pin_memory}")
-        self.copy_stream = torch.cuda.Stream() 
-        self.copy_queue = queue.Queue() 
-        self.layer_param:Dict[str, LayerParamStruct] = {} 
-        self.model_map = {}
+        self.copy_stream = torch.cuda.Stream()
+        self.copy_queue = collections.deque()
+        self.layers: Dict[str, OffloadedLayer] = {}
+        self.slots: List[StagingSlot] = []
+        self.slot_bytes = 0
+        self.loaded: Dict[str, StagingSlot] = {}  # layer name -> slot holding its copy
+        self.pending = set()                       # queued or being copied
         self.stop_flag = False
         self.copy_condition = threading.Condition()
-        self.queue_condition = threading.Condition()
         self.mem_line_b = 0
 
+        self.cur_copy_idx = 0
+        self.pre_copy_step = max(1, min(pre_copy_step, max_pre_copy_step))
+        self.max_pre_copy_step = max(max_pre_copy_step, self.pre_copy_step)
+        # Moving averages (ms) of one layer copy and one layer forward, and timing events not yet read
+        self.copy_ms = 0.0
+        self.compute_ms = 0.0
+        self.timing_events = collections.deque()
+        # Counters for stats()
+        self.copy_count = 0
+        self.copied_bytes = 0
+        self.miss_count = 0
+        self.evict_count = 0
+
+        self.debug = debug
+
         self.copy_thread = threading.Thread(target=self._copy_thread_fun)
         self.copy_thread.daemon = True
         self.copy_thread.start()
 
-        self.cur_copy_idx = 0 
-        self.execute_over = False
-        self.pre_copy_step = pre_copy_step
-
-        self.tmp_state_list = []
-        self.tmp_state_idx = 0
-        for i in range(pre_copy_step + 2):
-            self.tmp_state_list.append(None)
-
-        self.debug = debug
-
     def stop(self):
-        self.stop_flag = True
-        with self.queue_condition:
-            self.queue_condition.notify()
+        with self.copy_condition:
+            self.stop_flag = True
+            self.copy_condition.notify_all()
         self.copy_thread.join()
 
-        del self.layer_param
-        del self.model_map
+        del self.layers
+        del self.slots
+        del self.loaded
         del self.copy_stream
 
+    def stats(self) -> dict:
+        """Residency and streaming counters since the layers were offloaded."""
+        with self.copy_condition:
+            return {
+                "streamed_layers": len(self.layers),
+                "host_bytes": sum(layer.nbytes for layer in self.layers.values()),
+                "pinned": self.pin_memory,
+                "staging_slots": len(self.slots),
+                "slot_bytes": self.slot_bytes,
+                "pre_copy_step": self.pre_copy_step,
+                "copy_ms": round(self.copy_ms, 3),
+                "compute_ms": round(self.compute_ms, 3),
+                "copies": self.copy_count,
+                "copied_bytes": self.copied_bytes,
+                "prefetch_misses": self.miss_count,
+                "evictions": self.evict_count,
+            }
+
+    def _request_copy(self, layer_name):
+        # Caller holds copy_condition
+        if layer_name in self.loaded or layer_name in self.pending:
+            return
+        self.pending.add(layer_name)
+        self.copy_queue.append(layer_name)
+        self.copy_condition.notify_all()
+
+    def _acquire_slot(self):
+        """
+        Slot for the next copy: a free one, or a new one while the ring is smaller than
+        pre_copy_step + 1. Otherwise waits for the running layer to release its slot
+        rather than evicting a prefetched layer; one is only evicted when nothing is
+        running (the execution order changed). Caller holds copy_condition.
+        """
+        while True:
+            for slot in self.slots:
+                if slot.state == StagingSlot.FREE:
+                    return slot
+            if len(self.slots) < self.pre_copy_step + 1:
+                self.slots.append(StagingSlot(self.slot_bytes, self.device))
+                return self.slots[-1]
+            if not any(slot.state == StagingSlot.RUNNING for slot in self.slots):
+                slot = next(slot for slot in self.slots if slot.state == StagingSlot.LOADED)
+                del self.loaded[slot.owner]
+                self.evict_count += 1
+                if self.debug:
+                    print(f"evict prefetched layer {slot.owner}")
+                return slot
+            self.copy_condition.wait()
+
     def _copy_thread_fun(self):
-        while self.stop_flag == False:
-            layer_name = "--"
-            with self.queue_condition:
-                while self.copy_queue.qsize() == 0 and self.stop_flag == False:
-                    self.queue_condition.wait()
-                if self.stop_flag == True:
+        while True:
+            with self.copy_condition:
+                while not self.copy_queue and not self.stop_flag:
+                    self.copy_condition.wait()
+                if self.stop_flag:
                     break
-                layer_name = self.copy_queue.get()
-            with torch.cuda.stream(self.copy_stream):
-                if layer_name in self.model_map:
-                    model = self.model_map[layer_name]
-                    self.tmp_state_list[self.tmp_state_idx] = {
-                        k: v.to(torch.device(f"cuda:{self.device_index}"), non_blocking=False)
-                        for k, v in model.state_dict().items()
-                    }
-                    self.copy_stream.synchronize()
-
-                    device_state = self.tmp_state_list[self.tmp_state_idx]
-                    self.tmp_state_idx = (self.tmp_state_idx + 1) % len(self.tmp_state_list)
-
-                    with self.copy_condition:
-                        if layer_name in self.layer_param:
-                            self.layer_param[layer_name].count += 1
-                        else:
-                            self.layer_param[layer_name] = LayerParamStruct()
-                            self.layer_param[layer_name].count = 1
-                        self.layer_param[layer_name].device_state = device_state
-                        self.copy_condition.notify()
-                else:
+                layer_name = self.copy_queue.popleft()
+                layer = self.layers.get(layer_name)
+                if layer is None:
                     print(f"get model error! {layer_name}")
+                    self.pending.discard(layer_name)
+                    continue
+                slot = self._acquire_slot()
+                slot.state, slot.owner = StagingSlot.LOADED, layer_name
+            with torch.cuda.stream(self.copy_stream):
+                # The forward that last read this slot must be done before it is overwritten
+                slot.free_event.wait(self.copy_stream)
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record(self.copy_stream)
+                slot.buffer[:layer.nbytes].copy_(layer.host, non_blocking=self.pin_memory)
+                end.record(self.copy_stream)
+                slot.ready_event.record(self.copy_stream)
+            with self.copy_condition:
+                self.timing_events.append(("copy", start, end))
+                self.copy_count += 1
+                self.copied_bytes += layer.nbytes
+                self.pending.discard(layer_name)
+                self.loaded[layer_name] = slot
+                self.copy_condition.notify_all()
         print("copy thread stop..")
 
+    def _update_pre_copy_step(self):
+        """Fold finished copy / forward timings into the averages and retune the prefetch depth."""
+        while self.timing_events and self.timing_events[0][2].query():
+            kind, start, end = self.timing_events.popleft()
+            ms = start.elapsed_time(end)
+            if kind == "copy":
+                self.copy_ms = ms if self.copy_ms == 0 else 0.9 * self.copy_ms + 0.1 * ms
+            else:
+                self.compute_ms = ms if self.compute_ms == 0 else 0.9 * self.compute_ms + 0.1 * ms
+        if self.copy_ms > 0 and self.compute_ms > 0:
+            # Enough layers in flight that the copy engine never waits on a free slot
+            step = min(self.max_pre_copy_step, max(1, math.ceil(self.copy_ms / self.compute_ms)))
+            if step != self.pre_copy_step and self.debug:
+                print(f"pre_copy_step {self.pre_copy_step} -> {step} (copy {self.copy_ms:.2f}ms, compute {self.compute_ms:.2f}ms)")
+            self.pre_copy_step = step
+
     def _get_new_step_copy_begin_end(self, tag_name):
         
         pre_copy_step = self.pre_copy_step
@@ -270,89 +413,74 @@ class OffloadProfiler:
             layer_param_size += param.data.numel() * param.data.element_size() / 1024 / 1024 #MB
         
         taget_cpu_mem_b = self.cpu_mem_gb * 1024 * 1024 * 1024
-        offload = False
+        params = []
         for name, param in module.named_parameters():
             p_name = f"{tag_name}.{name}" if tag_name else name
-            for i_layer in ignore_layer_list:
-                if p_name.startswith(i_layer):
-                    if self.debug:
-                        print(f"ignore layer param: {p_name}")
-                    continue
+            if any(p_name.startswith(i_layer) for i_layer in ignore_layer_list):
+                if self.debug:
+                    print(f"ignore layer param: {p_name}")
+                continue
 
             if taget_cpu_mem_b >= 0 and self.cpu_mem_b_count >= taget_cpu_mem_b:
                 break
-            cpu_data = torch.empty_strided(size=param.data.size(),
-                                        stride=param.data.stride(),
-                                        dtype=param.data.dtype,
-                                        layout=param.data.layout,
-                                        device='cpu',
-                                        pin_memory=self.pin_memory)
-            cpu_data.copy_(param.data)
-            param.data = cpu_data
-
-            param_size = param.data.numel() * param.data.element_size()
-            self.cpu_mem_b_count += param_size
-            offload = True
+            params.append((name, param))
+            self.cpu_mem_b_count += param.data.numel() * param.data.element_size()
+        offload = len(params) > 0
+        # Whatever is not streamed (ignored or over the cpu_mem_gb budget) lives on the device
+        packed = {id(param) for _, param in params}
+        for param in module.parameters():
+            if id(param) not in packed:
+                param.data = param.data.to(self.device)
+        for buffer in module.buffers():
+            buffer.data = buffer.data.to(self.device)
         if self.debug:
             print(f"layer: {tag_name}, type: {module.__class__.__name__}, size(MB): {layer_param_size}, offload: {offload}, sum_offload_size(MB): {self.cpu_mem_b_count/1024/1024}")
         
         if offload:
+            layer = OffloadedLayer(module, params, self.pin_memory)
+            self.layers[tag_name] = layer
+            self.slot_bytes = max(self.slot_bytes, layer.nbytes)
             copy_condition = self.copy_condition
-            queue_condition = self.queue_condition
-            copy_queue = self.copy_queue
-            layer_param = self.layer_param
             def forward_wrapper(*args, **kwargs):
                 module.forward = original_forward
 
-                execute_over = False if tag_name not in self.execution_order_idx else True
-                if execute_over == False:
-                    self.model_map[tag_name] = module
-                    self.execution_order.append(tag_name)
-                    self.execution_order_idx[tag_name] = len(self.execution_order) - 1
-                    copy_queue.put(tag_name)
-                    with queue_condition:
-                        queue_condition.notify()
-                else: 
-                
-                    copy_begin, copy_end = self._get_new_step_copy_begin_end(tag_name=tag_name)
-                    if copy_end > copy_begin:
-                        for idx in range(copy_begin, copy_end):
-                            idx = idx % len(self.execution_order)
-                            copy_tag_name = self.execution_order[idx]
-                            copy_queue.put(copy_tag_name)
-                            with queue_condition:
-                                queue_condition.notify()
-
-                        self.cur_copy_idx = copy_end % len(self.execution_order)
-                
-                run_state = None
-                with self.copy_condition:
-                    while tag_name not in self.layer_param:
+                with copy_condition:
+                    self._update_pre_copy_step()
+                    if tag_name not in self.execution_order_idx:
+                        self.execution_order.append(tag_name)
+                        self.execution_order_idx[tag_name] = len(self.execution_order) - 1
+                    else:
+                        copy_begin, copy_end = self._get_new_step_copy_begin_end(tag_name=tag_name)
+                        if copy_end > copy_begin:
+                            for idx in range(copy_begin, copy_end):
+                                self._request_copy(self.execution_order[idx % len(self.execution_order)])
+                            self.cur_copy_idx = copy_end % len(self.execution_order)
+
+                    if tag_name not in self.loaded and tag_name not in self.pending:
+                        self.miss_count += 1
+                    while tag_name not in self.loaded:
+                        # Not prefetched (first pass, or evicted after an order change)
+                        self._request_copy(tag_name)
                         copy_condition.wait()
-                    run_state = self.layer_param[tag_name].device_state
-                    self.layer_param[tag_name].count -= 1
-                    
+                    slot = self.loaded.pop(tag_name)
+                    slot.state = StagingSlot.RUNNING
+
+                compute_stream = torch.cuda.current_stream()
+                slot.ready_event.wait(compute_stream)
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record(compute_stream)
                 module.eval()
-                with torch.no_grad():
-                    output = functional_call(module, run_state, args=args, kwargs=kwargs)
-                with self.copy_condition:
-                    if self.layer_param[tag_name].count == 0:
-                        del self.layer_param[tag_name]
-                diff_mem_b_thre = 1 * (1024 ** 3)
-                if self.clean_cache_after_forward:
-                    reserved = torch.cuda.memory_reserved()
-                    if reserved > self.mem_line_b:
-                        torch.cuda.empty_cache()
-                        cur_reserved = torch.cuda.memory_reserved()
-                        diff_mem = reserved - cur_reserved
-                        if diff_mem > diff_mem_b_thre:
-                            self.mem_line_b = cur_reserved + (reserved - cur_reserved) / 2 + 10
-                        else:
-                            self.mem_line_b = reserved + 10
-                        if self.debug:
-                            print(f"child mem line update, clean cache:{reserved/1024/1024}, cur mem: {cur_reserved/1024/1024}  new limit: {self.mem_line_b / 1024 / 1024}, child name: {tag_name}")
-                    
-                module.forward = forward_wrapper
+                try:
+                    with torch.no_grad():
+                        output = functional_call(module, layer.device_state(slot.buffer), args=args, kwargs=kwargs)
+                finally:
+                    end.record(compute_stream)
+                    slot.free_event.record(compute_stream)
+                    with copy_condition:
+                        self.timing_events.append(("compute", start, end))
+                        slot.state, slot.owner = StagingSlot.FREE, None
+                        copy_condition.notify_all()
+                    module.forward = forward_wrapper
                 return output
             module.forward = forward_wrapper
         
@@ -394,16 +522,17 @@ class OffloadProfiler:
         return module
     
     @_callable_once
-    def offload_layer(self, module, offload_layer_dict={},  ignore_layer_list=[], dtype:torch.dtype = None):
+    def offload_layer(self, module, offload_layer_dict={},  ignore_layer_list=[], dtype:torch.dtype = None, resident_layer_list=[]):
         return self._offload_layer(
                                     module=module,
                                     tag="",
                                     offload_layer_dict=offload_layer_dict,
                                     ignore_layer_list=ignore_layer_list,
-                                    dtype=dtype
+                                    dtype=dtype,
+                                    resident_layer_list=set(resident_layer_list)
                                     )
     
-    def _offload_layer(self, module, tag="", offload_layer_dict={},  ignore_layer_list=[], dtype:torch.dtype = None):
+    def _offload_layer(self, module, tag="", offload_layer_dict={},  ignore_layer_list=[], dtype:torch.dtype = None, resident_layer_list=set()):
         """
             Offload specific layers of a PyTorch model to a specified depth.
             A model can only be offloaded once.
@@ -434,36 +563,42 @@ class OffloadProfiler:
                 dtype (torch.dtype, optional): 
                     The data type (e.g., `torch.float16`, `torch.float32`) to which the offloaded layers should be converted. 
                     If `None`, the data type of the layers will remain unchanged. Default is `None`.
+                
+                resident_layer_list (set, optional): 
+                    Exact names of layers (at the offload depth) that stay on the device instead of being streamed, 
+                    as chosen by `offload_planner.plan_offload`. Default is an empty set.
 
             Returns:
                 None
         """
         for p in module._parameters.values():
             if p is not None:
-                p.data = p.data.to(torch.device(f"cuda:{self.device_index}"))
+                p.data = p.data.to(self.device)
                 if dtype is not None:
                     p.data = p.data.to(dtype)
         for b in module._buffers.values():
             if b is not None:
-                b.data = b.data.to(torch.device(f"cuda:{self.device_index}"))
+                b.data = b.data.to(self.device)
                 if dtype is not None:
                     b.data = b.data.to(dtype)
         for attr_name, attr in module.__dict__.items():
             if isinstance(attr, torch.Tensor) and not attr_name.startswith('_'):
-                attr.data = attr.data.to(torch.device(f"cuda:{self.device_index}"))
+                attr.data = attr.data.to(self.device)
                 if dtype is not None:
                     attr.data = attr.data.to(dtype)
 
         for name, child in module.named_children():
             current_tag = f"{tag}.{name}" if tag else name
-            child = child.to(torch.device(f"cuda:{self.device_index}"))
+            # Sub-trees that get offloaded stay in host memory until their layers are packed,
+            # so the device never has to hold them whole
             if dtype is not None:
                 child = child.to(dtype)
-
-            torch.cuda.empty_cache()
             setattr(module, name, child)
             pre_name = current_tag.split('.')[0]
             if pre_name not in offload_layer_dict:
+                child = child.to(self.device)
+                setattr(module, name, child)
+                torch.cuda.empty_cache()
                 param_size = 0
                 for p in child.parameters():
                     param_size += p.data.numel() * p.data.element_size()
@@ -484,10 +619,11 @@ class OffloadProfiler:
                                    tag=current_tag, 
                                    offload_layer_dict=offload_layer_dict, 
                                    ignore_layer_list=ignore_layer_list,
-                                   dtype=dtype)
+                                   dtype=dtype,
+                                   resident_layer_list=resident_layer_list)
                 continue
 
-            ignore = False
+            ignore = current_tag in resident_layer_list
             for i_layer in ignore_layer_list:
                 if current_tag.startswith(i_layer):
                     ignore = True
@@ -499,6 +635,8 @@ class OffloadProfiler:
                 child = self.make_forward_wrapper(
                     child, current_tag, ignore_layer_list=ignore_layer_list
                 )
+            else:
+                setattr(module, name, child.to(self.device))
         return module
     
     def get_execution_order(self):
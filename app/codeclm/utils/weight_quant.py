@@ -0,0 +1,193 @@
+"""
+Weight-only quantization of the LM's Llama linears (attention q/k/v/o and MLP
+gate/up/down projections of both transformer stacks).
+
+Symmetric, calibration-free round-to-nearest per output row (int8) or per group of
+group_size input columns (int8 / int4, two int4 values packed per byte). Activations
+stay in floating point: int8 per-row layers run torch's int8 weight-only matmul on CPU
+and MPS, int4 layers its int4 CPU matmul (from a repacked copy of the weight), and
+everything else dequantizes the weight in row chunks on the fly so no full precision
+copy of the layer is ever materialized. The lm_head and the codebook output linears
+stay in full precision.
+
+Quantized checkpoint format: the model.pt state dict with every quantized
+"<layer>.weight" replaced by "<layer>.qweight" (int8, or uint8 packed int4) and
+"<layer>.scale" (float32, [out_features, groups]), plus a QUANT_KEY entry
+{'format', 'bits', 'group_size', 'layers'} listing the quantized layer names.
+"""
+import os
+import re
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+QUANT_KEY = '__weight_quant__'
+QUANT_FORMAT = 'songgen-wq-v1'
+# Llama linears inside the decoder layers of transformer / transformer2
+LLAMA_LINEAR_PATTERN = re.compile(r'(^|.*\.)model\.layers\.\d+\.(self_attn\.[qkvo]_proj|mlp\.(gate|up|down)_proj)$')
+# Upper bound of one dequantized weight chunk in the fallback matmul
+DEQUANT_CHUNK_BYTES = 1024 * 1024
+# Devices with a torch._weight_int8pack_mm kernel and the activation dtype to run it in
+# (None: the input's). On CPU it is an order of magnitude faster in bfloat16 than in fp32/fp16.
+INT8PACK_DTYPES = {'cpu': torch.bfloat16, 'mps': None}
+INT4PACK_GROUP_SIZES = (32, 64, 128, 256)
+# Quantized checkpoint variants: model_<mode>.pt next to model.pt -> (bits, group_size)
+QUANT_MODES = {'int8': (8, None), 'int4': (4, 128)}
+
+
+def quantize_weight(weight: torch.Tensor, bits: int = 8, group_size: Optional[int] = None):
+    """
+    (qweight, scale) of a [out_features, in_features] weight. group_size None quantizes
+    whole rows; 4 bit packs column pairs into one uint8 (low nibble first).
+    """
+    if bits not in (8, 4):
+        raise ValueError(f"Unsupported bits: {bits} (8 or 4)")
+    out_features, in_features = weight.shape
+    group_size = group_size or in_features
+    if in_features % group_size or (bits == 4 and group_size % 2):
+        raise ValueError(f"in_features {in_features} is not a multiple of group_size {group_size}")
+    qmax = 2 ** (bits - 1) - 1
+    w = weight.detach().float().view(out_features, in_features // group_size, group_size)
+    scale = w.abs().amax(-1, keepdim=True).clamp(min=1e-8) / qmax
+    q = torch.round(w / scale).clamp(-qmax - 1, qmax).view(out_features, in_features)
+    if bits == 4:
+        q = (q + 8).to(torch.uint8)
+        q = q[:, 0::2] | (q[:, 1::2] << 4)
+    else:
+        q = q.to(torch.int8)
+    return q.contiguous(), scale.view(out_features, -1).contiguous()
+
+
+class QuantLinear(nn.Module):
+    """Drop-in nn.Linear replacement holding a weight-only quantized weight."""
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, bits: int = 8,
+                 group_size: Optional[int] = None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size or in_features
+        packed = in_features // 2 if bits == 4 else in_features
+        # Parameters (frozen) rather than buffers so the offloader packs and streams them like any weight
+        self.qweight = nn.Parameter(torch.zeros(out_features, packed, dtype=torch.uint8 if bits == 4 else torch.int8),
+                                    requires_grad=False)
+        self.scale = nn.Parameter(torch.ones(out_features, in_features // self.group_size), requires_grad=False)
+        self.bias = nn.Parameter(torch.zeros(out_features), requires_grad=False) if bias else None
+        self.int4pack = (bits == 4 and hasattr(torch, '_weight_int4pack_mm_for_cpu')
+                         and out_features % 16 == 0 and self.group_size in INT4PACK_GROUP_SIZES)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int = 8, group_size: Optional[int] = None):
+        layer = cls(linear.in_features, linear.out_features, linear.bias is not None, bits, group_size)
+        qweight, scale = quantize_weight(linear.weight, bits, group_size)
+        layer.qweight.data = qweight.to(linear.weight.device)
+        layer.scale.data = scale.to(linear.weight.device)
+        if linear.bias is not None:
+            layer.bias.data = linear.bias.detach().clone()
+        return layer
+
+    def dequantize(self, dtype: torch.dtype = torch.float32, start: int = 0, end: Optional[int] = None):
+        """Rows start:end of the weight in dtype."""
+        q = self.qweight[start:end]
+        if self.bits == 4:
+            q = torch.stack((q & 0xF, q >> 4), dim=-1).view(q.shape[0], -1).to(dtype) - 8
+        rows = q.shape[0]
+        w = q.to(dtype).view(rows, -1, self.group_size) * self.scale[start:end, :, None].to(dtype)
+        return w.view(rows, self.in_features)
+
+    def int4pack_weight(self):
+        """Weight and scales in the layout of the int4 CPU kernel, repacked once per weight."""
+        key = (self.qweight.data_ptr(), self.qweight._version, self.scale.data_ptr(), self.scale._version)
+        cached = getattr(self, '_int4pack_cache', None)
+        if cached is None or cached[0] != key:
+            q = torch.stack((self.qweight & 0xF, self.qweight >> 4), dim=-1).view(self.out_features, -1)
+            scale = self.scale.detach().t().float()
+            scale_zeros = torch.stack((scale, torch.zeros_like(scale)), dim=-1).to(torch.bfloat16).contiguous()
+            cached = (key, torch._convert_weight_to_int4pack_for_cpu(q.to(torch.int32), 1), scale_zeros)
+            self._int4pack_cache = cached
+        return cached[1], cached[2]
+
+    def forward(self, x):
+        x2 = x.reshape(-1, self.in_features)
+        device = x.device.type
+        if self.bits == 8 and self.scale.shape[1] == 1 and device in INT8PACK_DTYPES:
+            dtype = INT8PACK_DTYPES[device] or x.dtype
+            out = torch._weight_int8pack_mm(x2.to(dtype), self.qweight, self.scale.view(-1).to(dtype)).to(x.dtype)
+        elif self.int4pack and device == 'cpu':
+            packed, scale_zeros = self.int4pack_weight()
+            out = torch._weight_int4pack_mm_for_cpu(x2.to(torch.bfloat16), packed, self.group_size, scale_zeros).to(x.dtype)
+        else:
+            out = torch.empty(x2.shape[0], self.out_features, dtype=x.dtype, device=x.device)
+            rows = max(1, DEQUANT_CHUNK_BYTES // (self.in_features * x.element_size()))
+            for start in range(0, self.out_features, rows):
+                out[:, start:start + rows] = F.linear(x2, self.dequantize(x.dtype, start, start + rows))
+        if self.bias is not None:
+            out = out + self.bias.to(out.dtype)
+        return out.view(*x.shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return (f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, "
+                f"bits={self.bits}, group_size={self.group_size}")
+
+
+def _replace(module: nn.Module, name: str, layer: nn.Module):
+    parent, _, child = name.rpartition('.')
+    setattr(module.get_submodule(parent) if parent else module, child, layer)
+
+
+def quantize_llama_linears(module: nn.Module, bits: int = 8, group_size: Optional[int] = None) -> List[str]:
+    """Quantize the Llama linears of a loaded model in place; returns their names."""
+    names = [name for name, child in module.named_modules()
+             if isinstance(child, nn.Linear) and LLAMA_LINEAR_PATTERN.match(name)]
+    for name in names:
+        _replace(module, name, QuantLinear.from_linear(module.get_submodule(name), bits, group_size))
+    return names
+
+
+def quantize_state_dict(state_dict: Dict[str, torch.Tensor], bits: int = 8,
+                        group_size: Optional[int] = None) -> Dict[str, torch.Tensor]:
+    """Offline conversion of a model.pt state dict into the quantized checkpoint format."""
+    converted, layers = {}, []
+    for key, value in state_dict.items():
+        name, _, leaf = key.rpartition('.')
+        if leaf == 'weight' and value.dim() == 2 and value.is_floating_point() and LLAMA_LINEAR_PATTERN.match(name):
+            converted[f"{name}.qweight"], converted[f"{name}.scale"] = quantize_weight(value, bits, group_size)
+            layers.append(name)
+        else:
+            converted[key] = value
+    converted[QUANT_KEY] = {'format': QUANT_FORMAT, 'bits': bits, 'group_size': group_size, 'layers': layers}
+    return converted
+
+
+def prepare_quantized_model(module: nn.Module, checkpoint: dict, prefix: str = '') -> bool:
+    """
+    Swap the layers a quantized checkpoint lists (names starting with prefix, which is
+    stripped) for empty QuantLinears so load_state_dict can fill them. Pops QUANT_KEY
+    from the checkpoint; returns False for a regular checkpoint.
+    """
+    meta = checkpoint.pop(QUANT_KEY, None)
+    if meta is None:
+        return False
+    if meta.get('format') != QUANT_FORMAT:
+        raise ValueError(f"Unknown quantized checkpoint format: {meta.get('format')}")
+    for name in meta['layers']:
+        if not name.startswith(prefix):
+            continue
+        linear = module.get_submodule(name[len(prefix):])
+        _replace(module, name[len(prefix):], QuantLinear(linear.in_features, linear.out_features, linear.bias is not None,
+                                                         meta['bits'], meta['group_size']))
+    return True
+
+
+def checkpoint_file(ckpt_dir: str, lm_quant: Optional[str] = None) -> str:
+    """model.pt of a checkpoint directory, or its quantized variant model_<lm_quant>.pt."""
+    if lm_quant is None:
+        return os.path.join(ckpt_dir, 'model.pt')
+    if lm_quant not in QUANT_MODES:
+        raise ValueError(f"Unknown LM quantization: {lm_quant} ({', '.join(QUANT_MODES)})")
+    path = os.path.join(ckpt_dir, f'model_{lm_quant}.pt')
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, create it with: python tools/quantize_lm.py {ckpt_dir} --mode {lm_quant}")
+    return path
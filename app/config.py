@@ -3,6 +3,7 @@ SongGeneration Studio - Configuration
 Directories, constants, and shared state initialization.
 """
 
+import os
 import json
 import sys
 from pathlib import Path
@@ -25,6 +26,9 @@ STATIC_DIR = BASE_DIR / "web" / "static"
 QUEUE_FILE = BASE_DIR / "queue.json"
 VERIFIED_MODELS_FILE = BASE_DIR / "verified_models.json"
 TIMING_FILE = BASE_DIR / "timing_history.json"
+LIBRARY_DB = BASE_DIR / "library.db"
+TIMING_DB = BASE_DIR / "timing.db"
+TRANSCODE_DIR = BASE_DIR / "transcodes"
 
 OUTPUT_DIR.mkdir(exist_ok=True)
 UPLOADS_DIR.mkdir(exist_ok=True)
@@ -32,6 +36,15 @@ STATIC_DIR.mkdir(parents=True, exist_ok=True)
 
 MODEL_SERVER_PORT = 42100
 MODEL_SERVER_URL = f"http://127.0.0.1:{MODEL_SERVER_PORT}"
+# Device memory budget (GB) for the LM in the model server; LM layers that don't fit
+# stay in host RAM and are streamed per step. Unset loads the whole LM on the device.
+LM_MEM_GB = float(os.environ["SONGGEN_LM_MEM_GB"]) if os.environ.get("SONGGEN_LM_MEM_GB") else None
+# Weight-only quantized LM checkpoint to load ("int8" / "int4", see tools/quantize_lm.py); unset loads model.pt
+LM_QUANT = os.environ.get("SONGGEN_LM_QUANT") or None
+# Precision policy of the diffusion and VAE decode ("auto" / "fp32" / "bf16" / "fp16"); unset is "auto"
+DECODE_PRECISION = os.environ.get("SONGGEN_DECODE_PRECISION") or None
+# Decode finished diffusion windows with the VAE while the next one is diffused (CUDA/CPU; more peak memory)
+PIPELINE_DECODE = os.environ.get("SONGGEN_PIPELINE_DECODE") == "1"
 USE_MODEL_SERVER = True
 
 MAX_TIMING_RECORDS = 1000
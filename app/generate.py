@@ -12,6 +12,8 @@ from omegaconf import OmegaConf
 from codeclm.models import builders
 import gc
 from codeclm.trainer.codec_song_pl import CodecLM_PL
+from codeclm.utils.weight_quant import QUANT_MODES, checkpoint_file, prepare_quantized_model
+from precision import DEFAULT_PRECISION, PRECISION_POLICIES
 from codeclm.models import CodecLM
 from third_party.demucs.models.pretrained import get_model_from_yaml
 import re
@@ -52,9 +54,8 @@ class Separator:
         if len(output_paths) == 1:  # 4
             vocal_path = output_paths[0]
         else:
-            drums_path, bass_path, other_path, vocal_path = self.demucs_model.separate(audio_path, output_dir, device=self.device)
-            for path in [drums_path, bass_path, other_path]:
-                os.remove(path)
+            # Only the vocals are needed, the accompaniment is derived below as full minus vocals
+            vocal_path, = self.demucs_model.separate(audio_path, output_dir, stem="vocal", device=self.device, write_rest=False)
         full_audio = self.load_audio(audio_path)
         vocal_audio = self.load_audio(vocal_path)
         bgm_audio = full_audio - vocal_audio
@@ -78,6 +79,14 @@ def parse_args():
                       help='Whether to use flash attention (default: False)')
     parser.add_argument('--low_mem', action='store_true',
                       help='Whether to use low memory mode (default: False)')
+    parser.add_argument('--lm_mem_gb', type=float, default=None,
+                      help='Device memory budget (GB) for the LM in low memory mode; decides which layers are streamed (default: free memory)')
+    parser.add_argument('--lm_quant', type=str, default=None, choices=list(QUANT_MODES),
+                      help='Load the weight-only quantized LM checkpoint written by tools/quantize_lm.py (default: full precision)')
+    parser.add_argument('--decode_precision', type=str, default=DEFAULT_PRECISION, choices=list(PRECISION_POLICIES),
+                      help='Precision policy of the diffusion estimator and VAE decoder (default: auto)')
+    parser.add_argument('--pipeline_decode', action='store_true',
+                      help='Decode finished diffusion windows with the VAE while the next one is diffused; CUDA/CPU only, raises peak memory (default: False)')
     return parser.parse_args()
 
 def generate(args):
@@ -86,7 +95,7 @@ def generate(args):
     input_jsonl = args.input_jsonl
     save_dir = args.save_dir
     cfg_path = os.path.join(ckpt_path, 'config.yaml')
-    ckpt_path = os.path.join(ckpt_path, 'model.pt')
+    ckpt_path = checkpoint_file(ckpt_path, args.lm_quant)
     cfg = OmegaConf.load(cfg_path)
     cfg.lm.use_flash_attn_2 = args.use_flash_attn
     print(f"use_flash_attn: {args.use_flash_attn}")
@@ -175,6 +184,8 @@ def generate(args):
     
     if seperate_tokenizer is not None:
         seperate_tokenizer = seperate_tokenizer.eval().cuda()
+        seperate_tokenizer.model.set_precision(args.decode_precision)
+        seperate_tokenizer.model.pipeline_decode = args.pipeline_decode
 
     for item in new_items:
         if "prompt_audio_path" in item:
@@ -186,6 +197,7 @@ def generate(args):
     torch.cuda.empty_cache()
     audiolm = builders.get_lm_model(cfg)
     checkpoint = torch.load(ckpt_path, map_location='cpu')
+    prepare_quantized_model(audiolm, checkpoint, prefix='audiolm.')
     audiolm_state_dict = {k.replace('audiolm.', ''): v for k, v in checkpoint.items() if k.startswith('audiolm')}
     audiolm.load_state_dict(audiolm_state_dict, strict=False)
     audiolm = audiolm.eval()
@@ -238,9 +250,8 @@ def generate(args):
         with torch.no_grad():
             if 'raw_pmt_wav' in item:
                 if gen_type == 'separate':
-                    wav_seperate = model.generate_audio(tokens, item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'], chunked=True, gen_type='mixed')
-                    wav_vocal = model.generate_audio(tokens, item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'], chunked=True, gen_type='vocal')
-                    wav_bgm = model.generate_audio(tokens, item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'], chunked=True, gen_type='bgm')
+                    wav_stems = model.generate_audio(tokens, item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'], chunked=True, gen_type='separate')
+                    wav_seperate, wav_vocal, wav_bgm = wav_stems['mixed'], wav_stems['vocal'], wav_stems['bgm']
                 elif gen_type == 'mixed':
                     wav_seperate = model.generate_audio(tokens, item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'],chunked=True, gen_type=gen_type)
                 else:
@@ -250,9 +261,8 @@ def generate(args):
                 del item['raw_bgm_wav']
             else:
                 if gen_type == 'separate':
-                    wav_vocal = model.generate_audio(tokens, chunked=True, gen_type='vocal')
-                    wav_bgm = model.generate_audio(tokens, chunked=True, gen_type='bgm')
-                    wav_seperate = model.generate_audio(tokens, chunked=True, gen_type='mixed')
+                    wav_stems = model.generate_audio(tokens, chunked=True, gen_type='separate')
+                    wav_seperate, wav_vocal, wav_bgm = wav_stems['mixed'], wav_stems['vocal'], wav_stems['bgm']
                 else:
                     wav_seperate = model.generate_audio(tokens, chunked=True, gen_type=gen_type)
         del item['pmt_wav']
@@ -282,7 +292,7 @@ def generate_lowmem(args):
     input_jsonl = args.input_jsonl
     save_dir = args.save_dir
     cfg_path = os.path.join(ckpt_path, 'config.yaml')
-    ckpt_path = os.path.join(ckpt_path, 'model.pt')
+    ckpt_path = checkpoint_file(ckpt_path, args.lm_quant)
     cfg = OmegaConf.load(cfg_path)
     cfg.lm.use_flash_attn_2 = args.use_flash_attn
     print(f"use_flash_attn: {args.use_flash_attn}")
@@ -373,6 +383,8 @@ def generate_lowmem(args):
     
     if seperate_tokenizer is not None:
         seperate_tokenizer = seperate_tokenizer.eval().cuda()
+        seperate_tokenizer.model.set_precision(args.decode_precision)
+        seperate_tokenizer.model.pipeline_decode = args.pipeline_decode
 
     for item in new_items:
         if "prompt_audio_path" in item:
@@ -389,13 +401,20 @@ def generate_lowmem(args):
     # Define model or load pretrained model
     audiolm = builders.get_lm_model(cfg)
     checkpoint = torch.load(ckpt_path, map_location='cpu')
+    prepare_quantized_model(audiolm, checkpoint, prefix='audiolm.')
     audiolm_state_dict = {k.replace('audiolm.', ''): v for k, v in checkpoint.items() if k.startswith('audiolm')}
     audiolm.load_state_dict(audiolm_state_dict, strict=False)
     audiolm = audiolm.eval()
 
-    offload_audiolm = True if 'offload' in cfg.keys() and 'audiolm' in cfg.offload else False
+    # Stream only as many LM layers as the free device memory requires
+    offload_base = cfg.offload.audiolm if 'offload' in cfg.keys() and 'audiolm' in cfg.offload else None
+    lm_budget = args.lm_mem_gb * 1024 ** 3 if args.lm_mem_gb else torch.cuda.mem_get_info()[0]
+    audiolm_plan = plan_module_offload(audiolm, int(lm_budget), base_config=offload_base,
+                                       reserve_bytes=int(LM_RESERVE_GB * 1024 ** 3))
+    print(f"offload plan: {audiolm_plan.summary()}")
+    offload_audiolm = audiolm_plan.streams
     if offload_audiolm:
-        audiolm_offload_param = OffloadParamParse.parse_config(audiolm, cfg.offload.audiolm)
+        audiolm_offload_param = OffloadParamParse.parse_config(audiolm, OmegaConf.create(audiolm_plan.to_config()))
         audiolm_offload_param.show()
         offload_profiler = OffloadProfiler(device_index=0, **(audiolm_offload_param.init_param_dict()))
         offload_profiler.offload_layer(**(audiolm_offload_param.offload_layer_param_dict()))
@@ -463,6 +482,8 @@ def generate_lowmem(args):
     seperate_tokenizer.model.device = device
     seperate_tokenizer.model.vae = seperate_tokenizer.model.vae.to(device)
     seperate_tokenizer.model.model.device = torch.device(device)
+    seperate_tokenizer.model.set_precision(args.decode_precision)
+    seperate_tokenizer.model.pipeline_decode = args.pipeline_decode
     seperate_tokenizer = seperate_tokenizer.eval()
 
     # offload_wav_tokenizer_diffusion =  True if 'offload' in cfg.keys() and 'wav_tokenizer_diffusion' in cfg.offload else False
@@ -487,9 +508,8 @@ def generate_lowmem(args):
         with torch.no_grad():
             if 'raw_pmt_wav' in item:
                 if gen_type == 'separate':
-                    wav_seperate = model.generate_audio(item['tokens'], item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'],chunked=True, gen_type='mixed')
-                    wav_vocal = model.generate_audio(item['tokens'],chunked=True, gen_type='vocal')
-                    wav_bgm = model.generate_audio(item['tokens'], chunked=True, gen_type='bgm')
+                    wav_stems = model.generate_audio(item['tokens'], item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'], chunked=True, gen_type='separate')
+                    wav_seperate, wav_vocal, wav_bgm = wav_stems['mixed'], wav_stems['vocal'], wav_stems['bgm']
                 elif gen_type == 'mixed':
                     wav_seperate = model.generate_audio(item['tokens'], item['raw_pmt_wav'], item['raw_vocal_wav'], item['raw_bgm_wav'],chunked=True, gen_type=gen_type)
                 else:
@@ -499,9 +519,8 @@ def generate_lowmem(args):
                 del item['raw_bgm_wav']
             else:
                 if gen_type == 'separate':
-                    wav_vocal = model.generate_audio(item['tokens'], chunked=True, gen_type='vocal')
-                    wav_bgm = model.generate_audio(item['tokens'], chunked=True, gen_type='bgm')
-                    wav_seperate = model.generate_audio(item['tokens'], chunked=True, gen_type='mixed')
+                    wav_stems = model.generate_audio(item['tokens'], chunked=True, gen_type='separate')
+                    wav_seperate, wav_vocal, wav_bgm = wav_stems['mixed'], wav_stems['vocal'], wav_stems['bgm']
                 else:
                     wav_seperate = model.generate_audio(item['tokens'], chunked=True, gen_type=gen_type)
         if gen_type == 'separate':
@@ -551,6 +570,7 @@ if __name__ == "__main__":
                 generate(args)
             else:
                 from codeclm.utils.offload_profiler import OffloadProfiler, OffloadParamParse
+                from codeclm.utils.offload_planner import plan_module_offload, LM_RESERVE_GB
                 print("use generate_lowmem")
                 generate_lowmem(args)
         elif model_name == 'songgeneration_large':
@@ -560,6 +580,7 @@ if __name__ == "__main__":
             else:                
                 print("use generate_lowmem")   
                 from codeclm.utils.offload_profiler import OffloadProfiler, OffloadParamParse
+                from codeclm.utils.offload_planner import plan_module_offload, LM_RESERVE_GB
                 generate_lowmem(args)
             
 
@@ -10,14 +10,22 @@ from pathlib import Path
 from datetime import datetime
 
 from config import BASE_DIR, DEFAULT_MODEL, OUTPUT_DIR, UPLOADS_DIR, USE_MODEL_SERVER
+from schemas import ServerGenerateRequest
+import library_index
+from timing import estimate_generation_time, save_timing_record
 
 generations = {}
 generation_lock = threading.Lock()
 model_server_busy = False
+# The event loop only keeps weak references to tasks, so fire-and-forget ones are held here
+background_tasks = set()
 
 LYRICS_FILTER_REGEX = re.compile(r"[^\w\s\[\]\-\u4e00-\u9fff\u3040-\u309f\u30a0-\u30ff\uac00-\ud7af\u00c0-\u017f]")
 VOCAL_SECTION_TYPES = {"verse", "chorus", "bridge", "prechorus"}
 
+# Overall progress range covered by each model server stage
+STAGE_PROGRESS = {"loading": (5, 30, "Loading model"), "lm": (35, 75, "Generating tokens"), "diffusion": (75, 95, "Diffusing audio"), "vae": (95, 99, "Decoding audio")}
+
 def clean_lyrics_line(line): return LYRICS_FILTER_REGEX.sub("", line).strip()
 def is_generation_active(): return model_server_busy or any(g.get("status") in ("pending", "processing") for g in generations.values())
 def get_active_generation_id():
@@ -44,82 +52,194 @@ def build_description(request):
     return ", ".join(parts) + "." if parts else ""
 
 def restore_library():
-    if not OUTPUT_DIR.exists(): return
-    for subdir in OUTPUT_DIR.iterdir():
-        if not subdir.is_dir(): continue
-        meta_path = subdir / "metadata.json"
-        if meta_path.exists():
-            try:
-                with open(meta_path, 'r') as f: meta = json.load(f)
-                files = list((subdir/"audios").glob("*.flac"))
-                generations[subdir.name] = {
-                    "id": subdir.name, "status": "completed", "progress": 100,
-                    "title": meta.get("title", "Untitled"), "model": meta.get("model", "unknown"),
-                    "output_files": [str(f) for f in files], "metadata": meta
-                }
-            except: pass
+    """Load the library from the index; reconcile_library brings it in line with output/ later."""
+    try: generations.update(library_index.load_generations())
+    except Exception as e: print(f"[LIBRARY] Error loading index: {e}", flush=True)
+
+def apply_library_change(gen_id, gen):
+    # Never clobber a generation that is running or being re-decoded
+    if generations.get(gen_id, {}).get("status", "completed") != "completed": return
+    if gen is None: generations.pop(gen_id, None)
+    else: generations[gen_id] = gen
+
+async def reconcile_library(notify_lib):
+    """Reconcile the index with output/ off the event loop; the changes are applied on it, where generations is read."""
+    loop = asyncio.get_running_loop()
+    def on_change(gen_id, gen): loop.call_soon_threadsafe(apply_library_change, gen_id, gen)
+    try: changed = await asyncio.to_thread(library_index.reconcile, on_change)
+    except Exception as e: print(f"[LIBRARY] Error reconciling index: {e}", flush=True); return
+    # The changes were queued on the loop before this resumes
+    if changed: notify_lib()
+
+async def ensure_model_on_server(model_id):
+    from model_server import is_model_server_running_async, start_model_server, get_model_server_status_async, load_model_on_server_async, wait_for_model_on_server_async
+    if not await is_model_server_running_async(): await start_model_server()
+    status = await get_model_server_status_async()
+    if status.get("loaded") and status.get("model_id") == model_id: return
+    result = await load_model_on_server_async(model_id)
+    if result.get("error") == "Already loading a model":
+        # another model is still loading, let it finish before swapping
+        await wait_for_model_on_server_async()
+        result = await load_model_on_server_async(model_id)
+    if result.get("status") == "loading": result = await wait_for_model_on_server_async()
+    if "error" in result: raise Exception(result['error'])
+
+def apply_server_progress(gen, progress):
+    """Map a model server progress event onto the generation's progress bar, never moving it backwards."""
+    stage = STAGE_PROGRESS.get(progress.get("stage"))
+    if stage is None or not progress.get("total"): return False
+    start, end, message = stage
+    done, total = progress["done"], progress["total"]
+    value = int(start + (end - start) * min(done, total) / total)
+    if value <= gen.get("progress", 0) and gen.get("stage") == progress["stage"]: return False
+    gen.update({"progress": max(value, gen.get("progress", 0)), "stage": progress["stage"], "message": f"{message} ({done}/{total})"})
+    return True
+
+async def watch_server_progress(gen_id, notify_gen):
+    """Forward model server progress for gen_id over SSE until the returned event is set."""
+    from model_server import stream_progress_from_server
+    loop = asyncio.get_running_loop()
+    stop_event = threading.Event()
+
+    def on_progress(progress):
+        def apply():
+            gen = generations.get(gen_id)
+            if gen is not None and gen.get("status") == "processing" and apply_server_progress(gen, progress):
+                notify_gen(gen_id, gen)
+        loop.call_soon_threadsafe(apply)
+
+    loop.run_in_executor(None, stream_progress_from_server, on_progress, stop_event)
+    return stop_event
 
 async def run_generation(gen_id, request, reference_path, notify_gen, notify_lib, notify_models):
     global generations, model_server_busy
-    from model_server import is_model_server_running_async, start_model_server, get_model_server_status_async, load_model_on_server_async, generate_via_server_async
+    from model_server import generate_via_server_async
 
     try:
         generations[gen_id].update({"status": "processing", "started_at": datetime.now().isoformat(), "message": "Initializing...", "progress": 0})
         await notify_models()
 
         model_id = request.model or DEFAULT_MODEL
-        input_file = UPLOADS_DIR / f"{gen_id}_input.jsonl"
+        num_sections, lyrics_length = len(request.sections), sum(len(section.lyrics or "") for section in request.sections)
+        generations[gen_id]["estimated_seconds"] = await asyncio.to_thread(estimate_generation_time, model_id, num_sections, lyrics_length, request.duration or 240)
+        # Weights stream in on the model server while the request is prepared here
+        load_task = asyncio.create_task(ensure_model_on_server(model_id)) if USE_MODEL_SERVER else None
         output_subdir = OUTPUT_DIR / gen_id
         output_subdir.mkdir(exist_ok=True)
 
-        input_data = {"idx": gen_id, "gt_lyric": build_lyrics_string(request.sections)}
-        if reference_path: input_data["prompt_audio_path"] = reference_path
+        payload = ServerGenerateRequest(
+            idx=gen_id, save_dir=str(output_subdir), gen_type=request.output_mode,
+            lyric=build_lyrics_string(request.sections),
+            cfg_coef=request.cfg_coef, temperature=request.temperature,
+            top_k=request.top_k, top_p=request.top_p, extend_stride=request.extend_stride,
+            duration=request.duration or 240, previews=request.previews,
+        )
+        if reference_path: payload.prompt_audio_path = reference_path
         else:
-            input_data["auto_prompt_audio_type"] = "Auto"
-            input_data["descriptions"] = build_description(request)
-
-        input_data.update({
-            "cfg_coef": request.cfg_coef, "temperature": request.temperature,
-            "top_k": request.top_k, "top_p": request.top_p, "extend_stride": request.extend_stride,
-            
-            # --- FIX: Write duration to file ---
-            "duration": request.duration or 240
-        })
-
-        with open(input_file, 'w', encoding='utf-8') as f:
-            json.dump(input_data, f, ensure_ascii=False); f.write('\n')
+            payload.auto_prompt_audio_type = "Auto"
+            payload.description = build_description(request)
 
         generations[gen_id]["message"] = "Loading Model..."
         notify_gen(gen_id, generations[gen_id])
 
         if USE_MODEL_SERVER:
-            if not await is_model_server_running_async(): await start_model_server()
-            status = await get_model_server_status_async()
-            if not status.get("loaded") or status.get("model_id") != model_id:
-                await load_model_on_server_async(model_id)
-                for i in range(600):
-                    await asyncio.sleep(1)
-                    s = await get_model_server_status_async()
-                    if s.get("loaded"): break
-
-            generations[gen_id].update({"message": "Generating...", "progress": 35})
-            notify_gen(gen_id, generations[gen_id])
-            
-            model_server_busy = True
-            try: result = await generate_via_server_async(str(input_file), str(output_subdir), request.output_mode)
-            finally: model_server_busy = False
+            progress_watch = await watch_server_progress(gen_id, notify_gen)
+            try:
+                await load_task
 
-            if "error" in result: raise Exception(result['error'])
+                generations[gen_id].update({"message": "Generating...", "progress": 35})
+                notify_gen(gen_id, generations[gen_id])
 
-            output_files = list((output_subdir / "audios").glob("*.flac"))
-            generations[gen_id].update({
-                "status": "completed", "progress": 100, "message": "Done",
-                "output_files": [str(f) for f in output_files]
+                model_server_busy = True
+                try: result = await generate_via_server_async(payload)
+                finally: model_server_busy = False
+            finally: progress_watch.set()
+
+            if "error" in result: raise Exception(result['error'])
+            if result.get("status") == "cancelled":
+                generations[gen_id].update({"status": "cancelled", "message": "Cancelled"})
+                notify_gen(gen_id, generations[gen_id])
+                await notify_models()
+                return
+
+            await asyncio.to_thread(save_timing_record, {
+                "model": model_id, "num_sections": num_sections, "total_lyrics_length": lyrics_length,
+                "has_lyrics": lyrics_length > 0, "output_mode": request.output_mode, "reference_audio_id": request.reference_audio_id,
+                "generation_time_seconds": result.get("generation_time", 0), "completed_at": datetime.now().isoformat(),
+                **(result.get("stage_rates") or {}),
             })
-            
+
+            # The model server frees up once the audio exists and writes the files in the background,
+            # so the queue can move on while this generation finishes encoding
+            generations[gen_id].update({"status": "encoding", "progress": 99, "message": "Encoding...", "output_files": result.get("output_files", [])})
             notify_gen(gen_id, generations[gen_id])
-            notify_lib(generations)
+            task = asyncio.create_task(finish_encoding(gen_id, str(output_subdir), notify_gen, notify_lib))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
 
     except Exception as e:
         generations[gen_id].update({"status": "failed", "message": str(e)})
         notify_gen(gen_id, generations[gen_id])
+
+async def finish_encoding(gen_id, save_dir, notify_gen, notify_lib):
+    """Mark a generation completed once the model server has written its output files."""
+    from model_server import wait_for_outputs_on_server_async
+
+    result = await wait_for_outputs_on_server_async(save_dir)
+    while result.get("status") == "encoding": result = await wait_for_outputs_on_server_async(save_dir)
+    # Deleted meanwhile, don't bring its index row back
+    if gen_id not in generations: return
+    if "error" in result:
+        generations[gen_id].update({"status": "failed", "message": result['error']})
+        notify_gen(gen_id, generations[gen_id])
+        return
+
+    generations[gen_id].update({
+        "status": "completed", "progress": 100, "message": "Done",
+        # a job the server no longer tracks has already been written to the planned paths
+        "output_files": result.get("output_files") or generations[gen_id].get("output_files", []),
+        "preview_files": result.get("preview_files", [])
+    })
+    library_index.upsert_generation(generations[gen_id])
+    notify_gen(gen_id, generations[gen_id])
+    notify_lib(generations)
+
+async def run_redecode(gen_id, request, notify_gen, notify_lib):
+    """Re-decode a finished generation from its cached tokens, skipping the LM."""
+    global model_server_busy
+    from model_server import redecode_via_server_async
+
+    gen = generations[gen_id]
+    output_subdir = OUTPUT_DIR / gen_id
+    try:
+        if not (output_subdir / "tokens.pt").exists(): raise Exception("No cached tokens for this generation")
+
+        gen.update({"status": "processing", "progress": 0, "message": "Loading Model..."})
+        notify_gen(gen_id, gen)
+        await ensure_model_on_server(gen.get("model") or DEFAULT_MODEL)
+
+        gen.update({"message": "Re-decoding...", "progress": 50})
+        notify_gen(gen_id, gen)
+
+        model_server_busy = True
+        progress_watch = await watch_server_progress(gen_id, notify_gen)
+        try: result = await redecode_via_server_async(str(output_subdir), request.output_mode, request.num_steps, request.sample_rate)
+        finally:
+            progress_watch.set()
+            model_server_busy = False
+
+        if "error" in result: raise Exception(result['error'])
+        if result.get("status") != "completed": raise Exception(result.get("message") or result.get("status", "Re-decode did not complete"))
+    except BaseException as e:
+        # Only completed generations are re-decoded and their files are untouched, so that is what it stays
+        gen.update({"status": "completed", "progress": 100, "message": f"Re-decode failed: {e or type(e).__name__}"})
+        notify_gen(gen_id, gen)
+        raise
+
+    # Re-decodes are written next to the generation's own files, see submit_outputs in model_server.py
+    gen["output_files"] = gen.get("output_files", []) + [f for f in result.get("output_files", []) if f not in gen.get("output_files", [])]
+    gen.update({"status": "completed", "progress": 100, "message": "Done"})
+    library_index.upsert_generation(gen)
+    notify_gen(gen_id, gen)
+    notify_lib(generations)
+    return gen
@@ -9,6 +9,7 @@ import platform
 import os
 from typing import Optional
 from pathlib import Path
+from peaks import peaks_path, read_duration
 
 # Try to import torch to check for MPS
 try:
@@ -93,7 +94,10 @@ def get_gpu_info() -> dict:
 # ============================================================================
 
 def get_audio_duration(audio_path: Path) -> Optional[float]:
-    """Get audio duration in seconds using ffprobe."""
+    """Get audio duration in seconds, from the waveform peaks sidecar if there is one, else using ffprobe."""
+    duration = read_duration(peaks_path(audio_path))
+    if duration is not None:
+        return duration
     try:
         cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
                '-of', 'default=noprint_wrappers=1:nokey=1', str(audio_path)]
@@ -0,0 +1,182 @@
+"""
+SongGeneration Studio - Library Index
+SQLite index of finished generations, so startup and the library endpoint don't
+have to walk the output directory.
+
+- Rows are written as generations complete (incremental, no rescans)
+- Startup loads the rows, then a background pass reconciles the index with
+  output/: only directories whose mtime (or their audios/ mtime) changed since
+  they were indexed are re-read, vanished directories are dropped
+- Listing is ordered newest first and paginated with an opaque
+  "created_at|id" cursor; `since` limits it to entries created at or after a timestamp,
+  which is how clients pick up new generations without re-reading the pages they hold
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import LIBRARY_DB, OUTPUT_DIR
+
+_lock = threading.Lock()
+PAGE_SIZE = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    title TEXT,
+    model TEXT,
+    dir_mtime REAL NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS generations_order ON generations (created_at DESC, id DESC);
+"""
+
+
+@contextmanager
+def _db():
+    """Serialised connection that commits on success and is always closed."""
+    with _lock:
+        conn = sqlite3.connect(str(LIBRARY_DB), timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            with conn: yield conn
+        finally: conn.close()
+
+
+def _dir_mtime(subdir: Path) -> float:
+    """Latest mtime of a generation directory and its audios/ folder (files land in the latter)."""
+    mtime = subdir.stat().st_mtime
+    try: mtime = max(mtime, (subdir / "audios").stat().st_mtime)
+    except OSError: pass
+    return mtime
+
+
+def _row(gen: dict, dir_mtime: float) -> tuple:
+    return (gen["id"], gen.get("created_at") or datetime.now().isoformat(), gen.get("status", "completed"),
+            gen.get("title"), gen.get("model"), dir_mtime, json.dumps(gen))
+
+
+def upsert_generation(gen: dict):
+    """Index (or re-index) a finished generation."""
+    subdir = OUTPUT_DIR / gen["id"]
+    try: dir_mtime = _dir_mtime(subdir)
+    except OSError: dir_mtime = 0
+    try:
+        with _db() as conn:
+            conn.execute("INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?, ?, ?)", _row(gen, dir_mtime))
+    except Exception as e:
+        print(f"[LIBRARY] Error indexing {gen.get('id')}: {e}", flush=True)
+
+
+def delete_generation(gen_id: str):
+    with _db() as conn:
+        conn.execute("DELETE FROM generations WHERE id = ?", (gen_id,))
+
+
+def load_generations() -> Dict[str, dict]:
+    """All indexed generations by id, newest first."""
+    with _db() as conn:
+        rows = conn.execute("SELECT data FROM generations ORDER BY created_at DESC, id DESC").fetchall()
+    gens = (json.loads(data) for (data,) in rows)
+    return {gen["id"]: gen for gen in gens}
+
+
+def page_cursor(gen: dict) -> str:
+    """Cursor of the page that follows gen."""
+    return f"{gen.get('created_at', '')}|{gen['id']}"
+
+
+def list_generations(cursor: Optional[str] = None, limit: int = PAGE_SIZE, status: Optional[str] = None,
+                     model: Optional[str] = None, search: Optional[str] = None,
+                     since: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """One page of the library, newest first, and the cursor of the next page (None on the last page)."""
+    where, params = [], []
+    if since:
+        where.append("created_at >= ?"); params.append(since)
+    if cursor:
+        created_at, _, gen_id = cursor.partition("|")
+        where.append("(created_at < ? OR (created_at = ? AND id < ?))")
+        params += [created_at, created_at, gen_id]
+    if status:
+        where.append("status = ?"); params.append(status)
+    if model:
+        where.append("model = ?"); params.append(model)
+    if search:
+        where.append("title LIKE ?"); params.append(f"%{search}%")
+    sql = "SELECT id, created_at, data FROM generations"
+    if where: sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    with _db() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    next_cursor = page_cursor({"id": rows[limit - 1][0], "created_at": rows[limit - 1][1]}) if len(rows) > limit else None
+    return [json.loads(data) for _, _, data in rows[:limit]], next_cursor
+
+
+def _read_generation_dir(subdir: Path, indexed: Optional[dict]) -> Optional[dict]:
+    """Rebuild the entry of a changed directory; None if it isn't a finished generation."""
+    meta_path = subdir / "metadata.json"
+    if indexed is None and not meta_path.exists(): return None
+    # mixed track first, then the stems
+    files = sorted((subdir / "audios").glob("*.flac"), key=lambda f: (f.stem != subdir.name, f.name))
+    if indexed is not None:
+        # Known generation whose files changed on disk (e.g. a re-decode added stems)
+        return dict(indexed, output_files=[str(f) for f in files])
+    with open(meta_path, 'r') as f: meta = json.load(f)
+    return {
+        "id": subdir.name, "status": "completed", "progress": 100,
+        "title": meta.get("title", "Untitled"), "model": meta.get("model", "unknown"),
+        "created_at": meta.get("created_at") or datetime.fromtimestamp(subdir.stat().st_mtime).isoformat(),
+        "output_files": [str(f) for f in files], "metadata": meta
+    }
+
+
+def reconcile(on_change=None) -> int:
+    """
+    Bring the index in line with output/, re-reading only directories that changed since
+    they were indexed. on_change(gen_id, gen_or_None) is called for every added, updated
+    or removed entry. Returns the number of changes.
+    """
+    if not OUTPUT_DIR.exists(): return 0
+    with _db() as conn:
+        indexed = {gen_id: mtime for gen_id, mtime in conn.execute("SELECT id, dir_mtime FROM generations")}
+
+    changes, seen = [], set()
+    for entry in os.scandir(OUTPUT_DIR):
+        if not entry.is_dir(): continue
+        seen.add(entry.name)
+        subdir = Path(entry.path)
+        try:
+            mtime = _dir_mtime(subdir)
+            if entry.name in indexed and indexed[entry.name] >= mtime: continue
+            previous = None
+            if entry.name in indexed:
+                with _db() as conn:
+                    row = conn.execute("SELECT data FROM generations WHERE id = ?", (entry.name,)).fetchone()
+                previous = json.loads(row[0]) if row else None
+            gen = _read_generation_dir(subdir, previous)
+            if gen is not None: changes.append((gen, mtime))
+        except Exception as e:
+            print(f"[LIBRARY] Skipping {entry.name}: {e}", flush=True)
+    removed = [gen_id for gen_id in indexed if gen_id not in seen]
+
+    with _db() as conn:
+        conn.executemany("INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?, ?, ?, ?)", [_row(gen, mtime) for gen, mtime in changes])
+        conn.executemany("DELETE FROM generations WHERE id = ?", [(gen_id,) for gen_id in removed])
+
+    if on_change:
+        for gen, _ in changes: on_change(gen["id"], gen)
+        for gen_id in removed: on_change(gen_id, None)
+    if changes or removed:
+        print(f"[LIBRARY] Reconciled index: {len(changes)} updated, {len(removed)} removed", flush=True)
+    return len(changes) + len(removed)
@@ -10,11 +10,13 @@ os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
 import uuid
 import json
+import shutil
 import asyncio
 import argparse
 from pathlib import Path
 from datetime import datetime
 from contextlib import asynccontextmanager
+from typing import Optional
 
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Response, Request
 from fastapi.staticfiles import StaticFiles
@@ -23,16 +25,20 @@ from fastapi.middleware.cors import CORSMiddleware
 from sse_starlette.sse import EventSourceResponse # Required for progress bars
 import uvicorn
 
-from config import (BASE_DIR, DEFAULT_MODEL, OUTPUT_DIR, UPLOADS_DIR, STATIC_DIR, load_queue, save_queue, log_startup_info)
+from config import (BASE_DIR, DEFAULT_MODEL, OUTPUT_DIR, UPLOADS_DIR, STATIC_DIR, TRANSCODE_DIR, load_queue, save_queue, log_startup_info)
 from gpu import gpu_info, refresh_gpu_info, log_gpu_info
-from schemas import Section, SongRequest, UpdateGenerationRequest
+from schemas import Section, SongRequest, UpdateGenerationRequest, RedecodeRequest, redecode_error
 from timing import get_timing_stats
+import library_index
+from peaks import ensure_peaks, read_peaks
+from transcode import TRANSCODE_FORMATS, DEFAULT_BITRATES, get_transcode
+from reference import trim_reference
 from models import (MODEL_REGISTRY, get_model_status, get_model_status_quick, get_download_progress, get_recommended_model, get_best_ready_model, get_available_models_sync, start_model_download, cancel_model_download, delete_model, cleanup_download_states, is_model_ready_quick)
-from model_server import (is_model_server_running_async, start_model_server, stop_model_server, get_model_server_status_async, load_model_on_server_async, unload_model_on_server)
+from model_server import (is_model_server_running_async, start_model_server, stop_model_server, get_model_server_status_async, load_model_on_server_async, unload_model_on_server, cancel_generation_on_server_async)
 from sse import (notify_queue_update, notify_generation_update as sse_notify_gen, notify_library_update as sse_notify_lib, notify_models_update, notify_models_update_sync, event_generator)
-from generation import (generations, generation_lock, is_generation_active, get_active_generation_id, restore_library, run_generation)
+from generation import (generations, generation_lock, is_generation_active, get_active_generation_id, restore_library, reconcile_library, run_generation, run_redecode)
 
-log_gpu_info(); log_startup_info(); cleanup_download_states(); restore_library()
+log_gpu_info(); log_startup_info(); cleanup_download_states(); restore_library(); sse_notify_lib(generations)
 
 def notify_gen(gen_id, gen_data): sse_notify_gen(gen_id, gen_data)
 def notify_lib(gens=None): sse_notify_lib(gens or generations)
@@ -114,8 +120,9 @@ async def background_queue_processor():
 @asynccontextmanager
 async def lifespan(app):
     task = asyncio.create_task(background_queue_processor())
+    reconcile_task = asyncio.create_task(reconcile_library(notify_lib))
     yield
-    task.cancel()
+    task.cancel(); reconcile_task.cancel()
 
 app = FastAPI(title="SongGeneration", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
@@ -170,13 +177,86 @@ async def generate_song(request: SongRequest, background_tasks: BackgroundTasks)
     background_tasks.add_task(run_generation, gen_id, request, reference_path, notify_gen, notify_lib, notify_models)
     return {"generation_id": gen_id}
 
+@app.post("/api/upload-and-trim-reference")
+async def upload_and_trim_reference(file: UploadFile = File(...), trim_start: float = Form(0.0), trim_duration: float = Form(10.0)):
+    # Only the trimmed 48 kHz clip is kept, the upload itself is never decoded past the window
+    try: result = await asyncio.to_thread(trim_reference, file.file, file.filename, trim_start, trim_duration)
+    except ValueError as e: raise HTTPException(400, str(e))
+    finally: await file.close()
+    return {"id": result["id"], "duration": result["duration"], "sample_rate": result["sample_rate"], "sha256": result["sha256"]}
+
 @app.get("/api/generations")
-async def list_generations(): return list(generations.values())
+async def list_generations(cursor: Optional[str] = None, limit: int = 100, status: Optional[str] = None, model: Optional[str] = None, q: Optional[str] = None, since: Optional[str] = None):
+    # since: only what was created at or after that timestamp (plus the active ones), for clients syncing the pages they hold
+    limit = max(1, min(limit, 500))
+    items, next_cursor = await asyncio.to_thread(library_index.list_generations, cursor, limit, status, model, q, since)
+    if cursor is None and status in (None, "active"):
+        # Running and unsaved generations live only in memory, they lead the first page
+        active = [g for g in generations.values() if g.get("status") != "completed" and (not model or g.get("model") == model)]
+        items = sorted(active, key=lambda g: g.get("created_at", ""), reverse=True) + (items if status is None else [])
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.get("/api/audio/{gen_id}/{track_idx}")
-async def get_audio_track(gen_id: str, track_idx: int):
+async def get_audio_track(gen_id: str, track_idx: int, request: Request, format: Optional[str] = None, bitrate: Optional[int] = None):
+    if gen_id not in generations: raise HTTPException(404)
+    output_files = generations[gen_id].get("output_files", [])
+    if not 0 <= track_idx < len(output_files): raise HTTPException(404)
+    path, media_type = Path(output_files[track_idx]), "audio/flac"
+    # Planned paths of a generation still encoding, or a track removed on disk
+    if not path.is_file(): raise HTTPException(404, "Track file not found")
+    if format:
+        if format not in TRANSCODE_FORMATS: raise HTTPException(400, f"Unsupported format: {format}")
+        bitrate = bitrate or DEFAULT_BITRATES[format]
+        if bitrate not in TRANSCODE_FORMATS[format][5]: raise HTTPException(400, f"Unsupported bitrate for {format}: {bitrate}")
+        try: path = await asyncio.wrap_future(get_transcode(gen_id, path, format, bitrate))
+        except Exception as e: raise HTTPException(500, f"Transcode failed: {e}")
+        media_type = TRANSCODE_FORMATS[format][3]
+    try: stat = path.stat()
+    except FileNotFoundError: raise HTTPException(404, "Track file not found")
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    if request.headers.get("if-none-match") == etag: return Response(status_code=304, headers={"ETag": etag})
+    # FileResponse answers Range requests with 206 partial content
+    return FileResponse(path, media_type=media_type, headers={"ETag": etag, "Cache-Control": "private, max-age=3600"})
+
+@app.get("/api/audio/{gen_id}/{track_idx}/peaks")
+async def get_audio_peaks(gen_id: str, track_idx: int, width: Optional[int] = None):
+    if gen_id not in generations: raise HTTPException(404)
+    output_files = generations[gen_id].get("output_files", [])
+    if not 0 <= track_idx < len(output_files): raise HTTPException(404)
+    path = await asyncio.to_thread(ensure_peaks, output_files[track_idx])
+    return await asyncio.to_thread(read_peaks, path, width)
+
+@app.post("/api/generation/{gen_id}/redecode")
+async def redecode_generation(gen_id: str, request: RedecodeRequest):
+    if gen_id not in generations: raise HTTPException(404)
+    if generations[gen_id].get("status") != "completed": raise HTTPException(400, "Generation not completed")
+    error = redecode_error(request.output_mode, request.num_steps, request.sample_rate)
+    if error: raise HTTPException(400, error)
+    with generation_lock:
+        if is_generation_active(): raise HTTPException(409, "Busy")
+        generations[gen_id]["status"] = "processing"
+    try: return await run_redecode(gen_id, request, notify_gen, notify_lib)
+    except Exception as e: raise HTTPException(500, str(e))
+
+@app.delete("/api/generation/{gen_id}")
+async def delete_generation_route(gen_id: str):
+    if gen_id not in generations: raise HTTPException(404)
+    # An encoding generation still has the writer pool filling its directory
+    if generations[gen_id].get("status") in ("pending", "processing", "encoding"): raise HTTPException(409, "Generation is running")
+    # Files (and their transcodes) first, so a reconcile pass can't pick the directory up again
+    for path in (OUTPUT_DIR / gen_id, TRANSCODE_DIR / gen_id): await asyncio.to_thread(shutil.rmtree, path, True)
+    await asyncio.to_thread(library_index.delete_generation, gen_id)
+    generations.pop(gen_id, None)
+    notify_lib()
+    return {"status": "deleted", "id": gen_id}
+
+@app.post("/api/generation/{gen_id}/cancel")
+async def cancel_generation(gen_id: str):
     if gen_id not in generations: raise HTTPException(404)
-    return FileResponse(generations[gen_id]["output_files"][track_idx])
+    if generations[gen_id].get("status") not in ("pending", "processing"): return {"status": "not_generating"}
+    generations[gen_id]["message"] = "Cancelling..."
+    notify_gen(gen_id, generations[gen_id])
+    return await cancel_generation_on_server_async()
 
 @app.get("/api/queue")
 async def get_queue(): return load_queue()
@@ -6,15 +6,18 @@ Updated for Mac (MPS) Support + Infinite Timeout.
 
 import os
 import sys
+import json
 import time
 import asyncio
+import threading
 import subprocess
 from typing import Optional
 import gc
 
 import requests
 
-from config import BASE_DIR, MODEL_SERVER_PORT, MODEL_SERVER_URL
+from config import BASE_DIR, MODEL_SERVER_PORT, MODEL_SERVER_URL, LM_MEM_GB, LM_QUANT, DECODE_PRECISION, PIPELINE_DECODE
+from schemas import ServerGenerateRequest, ServerGenerateResponse, redecode_error
 
 # --- MEMORY PATCH: Force macOS to release RAM immediately ---
 os.environ["PYTORCH_MPS_HIGH_WATERMARK_RATIO"] = "0.0"
@@ -26,6 +29,17 @@ os.environ["PYTORCH_MPS_HIGH_WATERMARK_RATIO"] = "0.0"
 
 model_server_process: Optional[subprocess.Popen] = None
 
+# Keep-alive sessions, one per calling thread (asyncio.to_thread reuses its workers)
+_session_local = threading.local()
+
+
+def _session() -> requests.Session:
+    session = getattr(_session_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _session_local.session = session
+    return session
+
 # Cache for model server status to reduce HTTP calls
 _status_cache = {"data": None, "timestamp": 0}
 _STATUS_CACHE_TTL = 2.0  # Cache status for 2 seconds
@@ -40,7 +54,7 @@ def is_model_server_running() -> bool:
     """Check if model server is running and responsive (blocking)."""
     try:
         # Keep a short timeout here just for health checks (2s)
-        resp = requests.get(f"{MODEL_SERVER_URL}/health", timeout=2)
+        resp = _session().get(f"{MODEL_SERVER_URL}/health", timeout=2)
         return resp.status_code == 200
     except:
         return False
@@ -103,7 +117,7 @@ def get_model_server_status() -> dict:
     # Fast path: if server process isn't running, return immediately
     if model_server_process is None or model_server_process.poll() is not None:
         try:
-            resp = requests.get(f"{MODEL_SERVER_URL}/status", timeout=1)
+            resp = _session().get(f"{MODEL_SERVER_URL}/status", timeout=1)
             if resp.status_code == 200:
                 data = resp.json()
                 data["running"] = True
@@ -121,7 +135,7 @@ def get_model_server_status() -> dict:
 
     for attempt in range(max_retries):
         try:
-            resp = requests.get(f"{MODEL_SERVER_URL}/status", timeout=timeout_seconds)
+            resp = _session().get(f"{MODEL_SERVER_URL}/status", timeout=timeout_seconds)
             if resp.status_code == 200:
                 data = resp.json()
                 data["running"] = True
@@ -240,33 +254,77 @@ def stop_model_server():
         print("[MODEL_SERVER] Server stopped")
 
 
-def load_model_on_server(model_id: str) -> dict:
-    """Request model server to load a model (blocking)."""
+def load_model_on_server(model_id: str, lm_mem_gb: Optional[float] = LM_MEM_GB, offload_plan: Optional[dict] = None,
+                         lm_quant: Optional[str] = LM_QUANT, decode_precision: Optional[str] = DECODE_PRECISION) -> dict:
+    """
+    Ask the model server to start loading a model; returns once loading has started.
+    lm_mem_gb / offload_plan make the server stream the LM layers that don't fit,
+    lm_quant loads the int8/int4 weight-only LM checkpoint. A different decode_precision
+    for the loaded model is switched in place.
+    """
     try:
-        # TIMEOUT = NONE (Infinite Wait)
-        resp = requests.post(f"{MODEL_SERVER_URL}/load",
-                           json={"model_id": model_id}, timeout=None)
+        resp = _session().post(f"{MODEL_SERVER_URL}/load",
+                           json={"model_id": model_id, "lm_mem_gb": lm_mem_gb, "offload_plan": offload_plan,
+                                 "lm_quant": lm_quant, "decode_precision": decode_precision}, timeout=30)
         invalidate_status_cache()
         return resp.json()
     except Exception as e:
         return {"error": str(e)}
 
 
-async def load_model_on_server_async(model_id: str) -> dict:
+async def load_model_on_server_async(model_id: str, lm_mem_gb: Optional[float] = LM_MEM_GB, offload_plan: Optional[dict] = None,
+                                     lm_quant: Optional[str] = LM_QUANT, decode_precision: Optional[str] = DECODE_PRECISION) -> dict:
     """Request model server to load a model (non-blocking)."""
-    return await asyncio.to_thread(load_model_on_server, model_id)
+    return await asyncio.to_thread(load_model_on_server, model_id, lm_mem_gb, offload_plan, lm_quant, decode_precision)
+
+
+def wait_for_model_on_server(timeout: float = 600.0) -> dict:
+    """Block until the model server finishes its current load (blocking)."""
+    try:
+        resp = _session().get(f"{MODEL_SERVER_URL}/load/wait",
+                          params={"timeout": timeout}, timeout=timeout + 30)
+        invalidate_status_cache()
+        return resp.json()
+    except Exception as e:
+        invalidate_status_cache()
+        return {"error": str(e)}
+
+
+async def wait_for_model_on_server_async(timeout: float = 600.0) -> dict:
+    """Wait for the model server to finish loading (non-blocking)."""
+    return await asyncio.to_thread(wait_for_model_on_server, timeout)
 
 
-def generate_via_server(input_jsonl: str, save_dir: str, gen_type: str = "mixed") -> dict:
+def generate_via_server(payload: ServerGenerateRequest) -> dict:
     """Send generation request to model server (blocking)."""
     try:
         invalidate_status_cache()
         # TIMEOUT = NONE (Infinite Wait)
-        resp = requests.post(f"{MODEL_SERVER_URL}/generate",
+        resp = _session().post(f"{MODEL_SERVER_URL}/generate",
+                           json=payload.model_dump(), timeout=None)
+        invalidate_status_cache()
+        return resp.json()
+    except Exception as e:
+        invalidate_status_cache()
+        return {"error": str(e)}
+
+
+async def generate_via_server_async(payload: ServerGenerateRequest) -> dict:
+    """Send generation request to model server (non-blocking)."""
+    return await asyncio.to_thread(generate_via_server, payload)
+
+
+def redecode_via_server(save_dir: str, gen_type: str = "mixed", num_steps: int = 50, sample_rate: Optional[int] = None) -> dict:
+    """Re-decode the cached tokens of a finished generation (blocking)."""
+    try:
+        invalidate_status_cache()
+        # TIMEOUT = NONE (Infinite Wait)
+        resp = _session().post(f"{MODEL_SERVER_URL}/redecode",
                            json={
-                               "input_jsonl": input_jsonl,
                                "save_dir": save_dir,
-                               "gen_type": gen_type
+                               "gen_type": gen_type,
+                               "num_steps": num_steps,
+                               "sample_rate": sample_rate
                            }, timeout=None)
         invalidate_status_cache()
         return resp.json()
@@ -275,15 +333,48 @@ def generate_via_server(input_jsonl: str, save_dir: str, gen_type: str = "mixed"
         return {"error": str(e)}
 
 
-async def generate_via_server_async(input_jsonl: str, save_dir: str, gen_type: str = "mixed") -> dict:
-    """Send generation request to model server (non-blocking)."""
-    return await asyncio.to_thread(generate_via_server, input_jsonl, save_dir, gen_type)
+def wait_for_outputs_on_server(save_dir: str, timeout: float = 600.0) -> dict:
+    """Block until the model server has written the output files of a job (blocking)."""
+    try:
+        resp = _session().get(f"{MODEL_SERVER_URL}/outputs/wait",
+                            params={"save_dir": save_dir, "timeout": timeout}, timeout=timeout + 30)
+        return resp.json()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+async def wait_for_outputs_on_server_async(save_dir: str, timeout: float = 600.0) -> dict:
+    """Wait for a job's output files to be written (non-blocking)."""
+    return await asyncio.to_thread(wait_for_outputs_on_server, save_dir, timeout)
+
+
+async def redecode_via_server_async(save_dir: str, gen_type: str = "mixed", num_steps: int = 50, sample_rate: Optional[int] = None) -> dict:
+    """Re-decode the cached tokens of a finished generation (non-blocking)."""
+    return await asyncio.to_thread(redecode_via_server, save_dir, gen_type, num_steps, sample_rate)
+
+
+def stream_progress_from_server(on_progress, stop_event) -> None:
+    """Follow the model server's progress stream until stop_event is set (blocking).
+
+    on_progress is called with {"stage", "done", "total", "generating"} dicts; the
+    server repeats the current state every 5s, so stop_event is seen promptly.
+    """
+    while not stop_event.is_set():
+        try:
+            with _session().get(f"{MODEL_SERVER_URL}/progress/stream", stream=True, timeout=(2, 30)) as resp:
+                for line in resp.iter_lines():
+                    if stop_event.is_set():
+                        return
+                    if line:
+                        on_progress(json.loads(line))
+        except Exception:
+            stop_event.wait(1.0)
 
 
 def cancel_generation_on_server() -> dict:
     """Request cancellation of current generation."""
     try:
-        resp = requests.post(f"{MODEL_SERVER_URL}/cancel", timeout=5)
+        resp = _session().post(f"{MODEL_SERVER_URL}/cancel", timeout=5)
         return resp.json()
     except Exception as e:
         return {"error": str(e)}
@@ -298,7 +389,7 @@ def unload_model_on_server() -> dict:
     """Unload model from VRAM."""
     try:
         # TIMEOUT = NONE (Infinite Wait)
-        resp = requests.post(f"{MODEL_SERVER_URL}/unload", timeout=None)
+        resp = _session().post(f"{MODEL_SERVER_URL}/unload", timeout=None)
         invalidate_status_cache()
         return resp.json()
     except Exception as e:
@@ -510,6 +601,9 @@ if __name__ == "__main__":
     from fastapi import FastAPI
     from pydantic import BaseModel
     import soundfile as sf
+    import torchaudio
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+    from fastapi.responses import StreamingResponse
 
     parser = argparse.ArgumentParser(description="SongGeneration Model Server")
     parser.add_argument("--port", type=int, default=42100, help="Port to run server on")
@@ -525,6 +619,8 @@ if __name__ == "__main__":
 
     # Import inference class AFTER applying monkey patches
     from levo_inference import LeVoInference
+    from codeclm.utils.cancellation import GenerationCancelled, request_cancel, clear_cancel
+    from peaks import write_peaks
 
     server_app = FastAPI(title="SongGeneration Model Server")
 
@@ -532,20 +628,150 @@ if __name__ == "__main__":
         def __init__(self):
             self.model: Optional[LeVoInference] = None
             self.model_id: Optional[str] = None
+            # lm_mem_gb / offload_plan / lm_quant the current model was loaded with
+            self.load_options: dict = {}
             self.loading: bool = False
             self.error: Optional[str] = None
             self.cancel_requested: bool = False
             self.generating: bool = False
+            self.loading_model_id: Optional[str] = None
+            self.progress: dict = {"stage": "idle", "done": 0, "total": 0}
+            self.progress_version: int = 0
+            # stage -> first/last report time and done count of the current job
+            self.stage_timing: dict = {}
 
     state = ModelState()
+    progress_cond = threading.Condition()
+    load_done = threading.Event()
+    load_done.set()
+
+    def publish_progress(stage: str, done: int, total: int):
+        """Record stage progress and wake /progress/stream readers, at most once per percent."""
+        now = time.time()
+        with progress_cond:
+            timing = state.stage_timing.setdefault(stage, {"start": now, "first_done": done})
+            timing.update(end=now, done=done)
+            last = state.progress
+            if stage == last["stage"] and done != total and total > 0 and (done - last["done"]) * 100 < total:
+                return
+            state.progress = {"stage": stage, "done": done, "total": total}
+            state.progress_version += 1
+            progress_cond.notify_all()
+
+    def stage_rates() -> dict:
+        """Throughput of the finished job's stages, for the web app's timing history."""
+        rates = {}
+        for stage, metric in (("lm", "lm_tokens_per_sec"), ("diffusion", "diffusion_windows_per_sec")):
+            timing = state.stage_timing.get(stage)
+            if timing and timing["end"] > timing["start"] and timing["done"] > timing["first_done"]:
+                rates[metric] = (timing["done"] - timing["first_done"]) / (timing["end"] - timing["start"])
+        vae = state.stage_timing.get("vae")
+        if vae:
+            rates["vae_seconds"] = vae["end"] - vae["start"]
+        return rates
 
     class LoadRequest(BaseModel):
         model_id: str
-
-    class GenerateRequest(BaseModel):
-        input_jsonl: str
+        # Device memory budget (GB) for the LM; layers that don't fit are streamed from host RAM
+        lm_mem_gb: Optional[float] = None
+        # Explicit offload section (OffloadPlan.to_config), takes precedence over lm_mem_gb
+        offload_plan: Optional[dict] = None
+        # "int8" / "int4": load the weight-only quantized LM checkpoint (model_<lm_quant>.pt)
+        lm_quant: Optional[str] = None
+        # Precision policy of the diffusion and VAE decode ("auto" / "fp32" / "bf16" / "fp16"), None: "auto"
+        decode_precision: Optional[str] = None
+
+    class RedecodeRequest(BaseModel):
         save_dir: str
         gen_type: str = "mixed"
+        num_steps: int = 50
+        sample_rate: Optional[int] = None
+
+    # soundfile (format, subtype, extension) for the optional compressed previews of the mixed track
+    PREVIEW_FORMATS = {
+        "mp3": ("MP3", "MPEG_LAYER_III", "mp3"),
+        "opus": ("OGG", "OPUS", "opus"),
+    }
+
+    encode_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="encode")
+    encode_jobs: dict = {}
+    # A finished job nobody asked /outputs/wait about is forgotten after this long
+    ENCODE_JOB_TTL = 600.0
+
+    def output_paths(audios_dir: Path, idx: str, stems, previews=(), suffix=None):
+        """
+        FLAC path per stem (mixed first) and the preview paths a job will write. With a
+        suffix (re-decodes) every stem, the mix included, goes to {idx}_{stem}{suffix}.flac.
+        """
+        if suffix is None:
+            flac_files = [audios_dir / (f"{idx}.flac" if stem == 'mixed' else f"{idx}_{stem}.flac") for stem in stems]
+        else:
+            flac_files = [audios_dir / f"{idx}_{stem}{suffix}.flac" for stem in stems]
+        preview_files = [audios_dir / f"{idx}.preview.{PREVIEW_FORMATS[fmt][2]}" for fmt in previews]
+        return flac_files, preview_files
+
+    def encode_outputs(stems: dict, audios_dir: Path, idx: str, sample_rate: int, out_sample_rate: Optional[int] = None,
+                       previews=(), decode_inputs=None, tokens_file: Optional[Path] = None, suffix=None):
+        """Writer pool job: FLAC per stem, optional previews of the mixed track and the token cache."""
+        flac_files, preview_files = output_paths(audios_dir, idx, stems, previews, suffix)
+        out_rate = out_sample_rate or sample_rate
+        for output_file, audio in zip(flac_files, stems.values()):
+            if out_rate != sample_rate:
+                audio = torchaudio.functional.resample(audio, sample_rate, out_rate)
+            sf.write(str(output_file), audio.permute(1, 0).numpy(), out_rate)
+            # Waveform peaks and duration while the samples are still in memory
+            write_peaks(output_file, audio.numpy(), out_rate)
+        mixed = stems.get('mixed')
+        for output_file, fmt in zip(preview_files, previews):
+            file_format, subtype, _ = PREVIEW_FORMATS[fmt]
+            # Opus only runs at 48 kHz
+            preview_rate = 48000 if fmt == "opus" else out_rate
+            audio = mixed if preview_rate == sample_rate else torchaudio.functional.resample(mixed, sample_rate, preview_rate)
+            sf.write(str(output_file), audio.permute(1, 0).numpy(), preview_rate, format=file_format, subtype=subtype)
+        if decode_inputs is not None:
+            # Tokens (and cropped prompts) let /redecode skip the LM later on
+            torch.save(decode_inputs, tokens_file)
+        print(f"[MODEL_SERVER] Saved to: {', '.join(str(f) for f in flac_files + preview_files)}", flush=True)
+        return [str(f) for f in flac_files], [str(f) for f in preview_files]
+
+    def expire_encode_job(save_dir: str, future):
+        # Only drop the entry if a later job hasn't replaced it
+        if encode_jobs.get(save_dir) is future:
+            encode_jobs.pop(save_dir, None)
+
+    def on_encode_done(save_dir: str, future):
+        if future.exception() is not None:
+            print(f"[MODEL_SERVER] Writing outputs failed: {future.exception()}", flush=True)
+        timer = threading.Timer(ENCODE_JOB_TTL, expire_encode_job, (save_dir, future))
+        timer.daemon = True
+        timer.start()
+
+    def submit_outputs(audio_result, save_dir: Path, idx: str, gen_type: str, sample_rate: int, out_sample_rate: Optional[int] = None,
+                       previews=(), decode_inputs=None, redecode=False):
+        """
+        Hand the audio to the writer pool; returns the paths that will be written. A re-decode
+        goes to stem-named files ({idx}_mixed.flac, {idx}_vocal.flac, ...), so it never replaces
+        the generation's mix, with the rate in the name when it is resampled
+        ({idx}_vocal_44100hz.flac) so the files at the model's rate stay.
+        """
+        suffix = None
+        if redecode:
+            suffix = f"_{out_sample_rate}hz" if out_sample_rate and out_sample_rate != sample_rate else ""
+        if gen_type == 'separate' and isinstance(audio_result, dict):
+            stems = audio_result
+        else:
+            stems = {(gen_type if redecode else 'mixed'): audio_result}
+        # Only the device-to-host copy stays on the request thread
+        stems = {stem: audio.detach().cpu().float() for stem, audio in stems.items()}
+        previews = [fmt for fmt in previews if fmt in PREVIEW_FORMATS] if 'mixed' in stems else []
+        audios_dir = save_dir / "audios"
+        audios_dir.mkdir(parents=True, exist_ok=True)
+        future = encode_pool.submit(encode_outputs, stems, audios_dir, idx, sample_rate, out_sample_rate,
+                                    previews, decode_inputs, save_dir / "tokens.pt", suffix)
+        encode_jobs[str(save_dir)] = future
+        future.add_done_callback(lambda done: on_encode_done(str(save_dir), done))
+        flac_files, preview_files = output_paths(audios_dir, idx, stems, previews, suffix)
+        return [str(f) for f in flac_files], [str(f) for f in preview_files]
 
     @server_app.get("/health")
     def health():
@@ -559,86 +785,155 @@ if __name__ == "__main__":
             "loading": state.loading,
             "error": state.error,
             "generating": state.generating,
-            "cancel_requested": state.cancel_requested
+            "cancel_requested": state.cancel_requested,
+            "progress": state.progress,
+            "offload": state.model.offload_stats() if state.model is not None else None,
+            "lm_quant": state.load_options.get("lm_quant"),
+            "decode_precision": state.model.decode_precision if state.model is not None else None
         }
 
+    @server_app.get("/progress/stream")
+    def progress_stream():
+        """NDJSON stream of progress updates, the current state is repeated every 5s as a keep-alive."""
+        def events():
+            version = -1
+            while True:
+                with progress_cond:
+                    progress_cond.wait_for(lambda: state.progress_version != version, timeout=5)
+                    version = state.progress_version
+                    data = dict(state.progress, generating=state.generating)
+                yield json.dumps(data) + "\n"
+        return StreamingResponse(events(), media_type="application/x-ndjson")
+
     @server_app.post("/cancel")
     def cancel():
         if state.generating:
             state.cancel_requested = True
+            request_cancel()
             print("[MODEL_SERVER] Cancel requested", flush=True)
             return {"status": "cancel_requested"}
         return {"status": "not_generating"}
 
-    @server_app.post("/load")
-    def load_model(req: LoadRequest):
-        if state.loading:
-            return {"error": "Already loading a model"}
-
-        if state.model is not None and state.model_id == req.model_id:
-            return {"status": "already_loaded", "model_id": req.model_id}
+    def flush_device_cache():
+        """
+        Free what the previous job left in the device cache. Runs on the request thread before
+        the next job rather than in the writer pool: the MPS command queue can't be driven
+        from two threads, and the slot is freed without waiting for it.
+        """
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def release_model():
+        """Drop the loaded model, stopping its layer streaming first."""
+        if state.model is not None:
+            state.model.release()
+            del state.model
+            state.model = None
+            state.model_id = None
+            state.load_options = {}
+            gc.collect()
+            torch.cuda.empty_cache()
 
+    def load_worker(model_id: str, load_options: dict, decode_precision: Optional[str] = None):
+        """Build LeVoInference off the request thread, reporting staged progress."""
         try:
-            state.loading = True
-            state.error = None
-
-            if state.model is not None:
-                del state.model
-                state.model = None
-                state.model_id = None
-                gc.collect()
-                torch.cuda.empty_cache()
-
-            model_path = APP_DIR / req.model_id
-            if not model_path.exists():
-                state.error = f"Model not found: {req.model_id}"
-                state.loading = False
-                return {"error": state.error}
-
-            print(f"[MODEL_SERVER] Loading model: {req.model_id}", flush=True)
-            state.model = LeVoInference(str(model_path))
-            state.model_id = req.model_id
-            state.loading = False
-            print(f"[MODEL_SERVER] Model loaded: {req.model_id}", flush=True)
-
-            return {"status": "loaded", "model_id": req.model_id}
+            release_model()
+
+            print(f"[MODEL_SERVER] Loading model: {model_id}", flush=True)
+            model = LeVoInference(str(APP_DIR / model_id), progress_callback=publish_progress,
+                                  decode_precision=decode_precision, pipeline_decode=PIPELINE_DECODE, **load_options)
+            model.set_progress_callback(publish_progress)
+            state.model = model
+            state.model_id = model_id
+            state.load_options = load_options
+            print(f"[MODEL_SERVER] Model loaded: {model_id}", flush=True)
+            if model.offload_stats():
+                print(f"[MODEL_SERVER] LM layers streamed from host RAM: {model.offload_stats()}", flush=True)
 
         except Exception as e:
             state.error = str(e)
-            state.loading = False
             print(f"[MODEL_SERVER] Failed to load model: {e}", flush=True)
             traceback.print_exc()
-            return {"error": str(e)}
+        finally:
+            state.loading = False
+            state.loading_model_id = None
+            load_done.set()
+
+    @server_app.post("/load")
+    def load_model(req: LoadRequest):
+        """Start loading a model in the background; use /load/wait to block until it is ready."""
+        if state.loading:
+            if state.loading_model_id == req.model_id:
+                return {"status": "loading", "model_id": req.model_id}
+            return {"error": "Already loading a model"}
+
+        load_options = {"lm_mem_gb": req.lm_mem_gb, "offload_plan": req.offload_plan, "lm_quant": req.lm_quant}
+        if state.model is not None and state.model_id == req.model_id and state.load_options == load_options:
+            # A different decode precision is switched in place, the model stays loaded
+            if (req.decode_precision or "auto") != state.model.decode_precision:
+                if state.generating:
+                    return {"error": "Generation in progress", "status": "busy"}
+                try:
+                    state.model.set_decode_precision(req.decode_precision)
+                except ValueError as e:
+                    return {"error": str(e)}
+            return {"status": "already_loaded", "model_id": req.model_id}
 
-    @server_app.post("/generate")
-    def generate(req: GenerateRequest):
+        if state.generating:
+            return {"error": "Generation in progress", "status": "busy"}
+
+        model_path = APP_DIR / req.model_id
+        if not model_path.exists():
+            state.error = f"Model not found: {req.model_id}"
+            return {"error": state.error}
+
+        state.loading = True
+        state.loading_model_id = req.model_id
+        state.error = None
+        load_done.clear()
+        publish_progress("loading", 0, 1)
+        threading.Thread(target=load_worker, args=(req.model_id, load_options, req.decode_precision), daemon=True).start()
+        return {"status": "loading", "model_id": req.model_id}
+
+    @server_app.get("/load/wait")
+    def wait_for_load(timeout: float = 600.0):
+        """Block until the current load finishes (or timeout seconds pass) and report the outcome."""
+        load_done.wait(timeout)
+        if state.loading:
+            return {"status": "loading", "model_id": state.loading_model_id}
+        if state.error:
+            return {"error": state.error}
+        return {"status": "loaded", "model_id": state.model_id}
+
+    @server_app.post("/generate", response_model=ServerGenerateResponse, response_model_exclude_none=True)
+    def generate(req: ServerGenerateRequest):
         if state.model is None:
-            return {"error": "No model loaded"}
+            return ServerGenerateResponse(status="error", error="No model loaded")
+
+        if state.loading:
+            # load_worker drops the current model before building the next one
+            return ServerGenerateResponse(status="busy", error="Model is loading")
 
         if state.generating:
             print("[MODEL_SERVER] Rejecting request - generation already in progress", flush=True)
-            return {"error": "Generation already in progress", "status": "busy"}
+            return ServerGenerateResponse(status="busy", error="Generation already in progress")
 
         state.cancel_requested = False
+        clear_cancel()
         state.generating = True
+        state.stage_timing = {}
+        publish_progress("preparing", 0, 0)
+        flush_device_cache()
 
         try:
             print(f"[MODEL_SERVER] Starting generation...", flush=True)
 
-            with open(req.input_jsonl, 'r', encoding='utf-8') as f:
-                input_data = json.loads(f.readline())
-
-            lyric = input_data.get("gt_lyric", "")
-            description = input_data.get("descriptions", None)
-            prompt_audio = input_data.get("prompt_audio_path", None)
-            auto_prompt_type = input_data.get("auto_prompt_audio_type", None)
+            lyric = req.lyric
+            description = req.description
+            prompt_audio = req.prompt_audio_path
+            auto_prompt_type = req.auto_prompt_audio_type
 
-            gen_params = {}
-            if "cfg_coef" in input_data: gen_params["cfg_coef"] = input_data["cfg_coef"]
-            if "temperature" in input_data: gen_params["temperature"] = input_data["temperature"]
-            if "top_k" in input_data: gen_params["top_k"] = input_data["top_k"]
-            if "top_p" in input_data: gen_params["top_p"] = input_data["top_p"]
-            if "extend_stride" in input_data: gen_params["extend_stride"] = input_data["extend_stride"]
+            gen_params = req.model_dump(include={"cfg_coef", "temperature", "top_k", "top_p", "extend_stride", "duration"}, exclude_none=True)
 
             auto_prompt_path = None
             if auto_prompt_type and auto_prompt_type != "Auto":
@@ -667,63 +962,131 @@ if __name__ == "__main__":
                 print(f"[MODEL_SERVER] Generation cancelled after {gen_time:.1f}s", flush=True)
                 state.generating = False
                 state.cancel_requested = False
-                return {"status": "cancelled", "message": "Generation was cancelled"}
+                return ServerGenerateResponse(status="cancelled", message="Generation was cancelled")
 
             print(f"[MODEL_SERVER] Generation completed in {gen_time:.1f}s", flush=True)
 
-            save_dir = Path(req.save_dir)
-            audios_dir = save_dir / "audios"
-            audios_dir.mkdir(parents=True, exist_ok=True)
+            output_files, preview_files = submit_outputs(audio_result, Path(req.save_dir), req.idx, req.gen_type,
+                                                         state.model.cfg.sample_rate, previews=req.previews,
+                                                         decode_inputs=state.model.last_decode_inputs)
+            del audio_result
+            state.generating = False
 
-            sample_rate = state.model.cfg.sample_rate
-            idx = input_data.get('idx', 'output')
+            # Files are still being written, /outputs/wait reports when they are on disk
+            return ServerGenerateResponse(
+                status="encoding",
+                output_files=output_files,
+                preview_files=preview_files,
+                generation_time=gen_time,
+                stage_rates=stage_rates()
+            )
 
-            if req.gen_type == 'separate' and isinstance(audio_result, dict):
-                output_file = audios_dir / f"{idx}.flac"
-                output_file_vocal = audios_dir / f"{idx}_vocal.flac"
-                output_file_bgm = audios_dir / f"{idx}_bgm.flac"
+        except GenerationCancelled:
+            print(f"[MODEL_SERVER] Generation cancelled after {time.time() - start_time:.1f}s", flush=True)
+            state.generating = False
+            state.cancel_requested = False
+            gc.collect()
+            torch.cuda.empty_cache()
+            return ServerGenerateResponse(status="cancelled", message="Generation was cancelled")
 
-                audio_np = audio_result['mixed'].cpu().permute(1, 0).float().numpy()
-                sf.write(str(output_file), audio_np, sample_rate)
+        except Exception as e:
+            print(f"[MODEL_SERVER] Generation failed: {e}", flush=True)
+            traceback.print_exc()
+            state.generating = False
+            return ServerGenerateResponse(status="error", error=str(e))
+
+    @server_app.post("/redecode", response_model=ServerGenerateResponse, response_model_exclude_none=True)
+    def redecode(req: RedecodeRequest):
+        if state.model is None:
+            return ServerGenerateResponse(status="error", error="No model loaded")
+
+        if state.loading:
+            return ServerGenerateResponse(status="busy", error="Model is loading")
+
+        if state.generating:
+            print("[MODEL_SERVER] Rejecting redecode - generation already in progress", flush=True)
+            return ServerGenerateResponse(status="busy", error="Generation already in progress")
 
-                audio_np_vocal = audio_result['vocal'].cpu().permute(1, 0).float().numpy()
-                sf.write(str(output_file_vocal), audio_np_vocal, sample_rate)
+        error = redecode_error(req.gen_type, req.num_steps, req.sample_rate)
+        if error:
+            return ServerGenerateResponse(status="error", error=error)
 
-                audio_np_bgm = audio_result['bgm'].cpu().permute(1, 0).float().numpy()
-                sf.write(str(output_file_bgm), audio_np_bgm, sample_rate)
+        save_dir = Path(req.save_dir)
+        tokens_file = save_dir / "tokens.pt"
+        if not tokens_file.exists():
+            return ServerGenerateResponse(status="error", error=f"No cached tokens in {save_dir}")
 
-                print(f"[MODEL_SERVER] Saved to: {output_file}, {output_file_vocal}, {output_file_bgm}", flush=True)
-            else:
-                audio_np = audio_result.cpu().permute(1, 0).float().numpy()
-                output_file = audios_dir / f"{idx}.flac"
-                sf.write(str(output_file), audio_np, sample_rate)
-                print(f"[MODEL_SERVER] Saved to: {output_file}", flush=True)
+        state.cancel_requested = False
+        clear_cancel()
+        state.generating = True
+        publish_progress("preparing", 0, 0)
+        flush_device_cache()
 
+        try:
+            print(f"[MODEL_SERVER] Re-decoding {tokens_file} (gen type: {req.gen_type}, steps: {req.num_steps})", flush=True)
+            start_time = time.time()
+            decode_inputs = torch.load(tokens_file, map_location="cpu")
+
+            with torch.inference_mode():
+                audio_result = state.model.decode(
+                    decode_inputs['tokens'],
+                    decode_inputs.get('vocal_prompt'),
+                    decode_inputs.get('bgm_prompt'),
+                    gen_type=req.gen_type,
+                    num_steps=req.num_steps
+                )
+
+            decode_time = time.time() - start_time
+            print(f"[MODEL_SERVER] Re-decode completed in {decode_time:.1f}s", flush=True)
+
+            output_files, _ = submit_outputs(audio_result, save_dir, save_dir.name, req.gen_type,
+                                             state.model.cfg.sample_rate, req.sample_rate, redecode=True)
+            del audio_result
+            state.generating = False
+            # A re-decode is short, so wait for its files here rather than round-tripping /outputs/wait
+            encode_jobs.pop(str(save_dir)).result()
+
+            return ServerGenerateResponse(
+                status="completed",
+                output_files=output_files,
+                generation_time=decode_time
+            )
+
+        except GenerationCancelled:
+            print("[MODEL_SERVER] Re-decode cancelled", flush=True)
             state.generating = False
+            state.cancel_requested = False
             gc.collect()
             torch.cuda.empty_cache()
-
-            return {
-                "status": "completed",
-                "output_file": str(output_file),
-                "generation_time": gen_time
-            }
+            return ServerGenerateResponse(status="cancelled", message="Generation was cancelled")
 
         except Exception as e:
-            print(f"[MODEL_SERVER] Generation failed: {e}", flush=True)
+            print(f"[MODEL_SERVER] Re-decode failed: {e}", flush=True)
             traceback.print_exc()
             state.generating = False
-            return {"error": str(e)}
+            return ServerGenerateResponse(status="error", error=str(e))
+
+    @server_app.get("/outputs/wait", response_model=ServerGenerateResponse, response_model_exclude_none=True)
+    def wait_for_outputs(save_dir: str, timeout: float = 600.0):
+        """Block until the writer pool has finished the files of the job saved under save_dir."""
+        future = encode_jobs.get(save_dir)
+        if future is None:
+            return ServerGenerateResponse(status="completed")
+        try:
+            output_files, preview_files = future.result(timeout)
+        except FutureTimeoutError:
+            return ServerGenerateResponse(status="encoding")
+        except Exception as e:
+            encode_jobs.pop(save_dir, None)
+            return ServerGenerateResponse(status="error", error=str(e))
+        encode_jobs.pop(save_dir, None)
+        return ServerGenerateResponse(status="completed", output_files=output_files, preview_files=preview_files)
 
     @server_app.post("/unload")
     def unload():
         try:
             if state.model is not None:
-                del state.model
-                state.model = None
-                state.model_id = None
-                gc.collect()
-                torch.cuda.empty_cache()
+                release_model()
                 print("[MODEL_SERVER] Model unloaded", flush=True)
             return {"status": "unloaded"}
         except Exception as e:
@@ -731,7 +1094,7 @@ if __name__ == "__main__":
 
     if args.preload:
         print(f"[MODEL_SERVER] Preloading model: {args.preload}", flush=True)
-        load_model(LoadRequest(model_id=args.preload))
+        load_model(LoadRequest(model_id=args.preload, lm_mem_gb=LM_MEM_GB, lm_quant=LM_QUANT, decode_precision=DECODE_PRECISION))
 
     print(f"[MODEL_SERVER] Starting server on {args.host}:{args.port}", flush=True)
     # CLEAN LOGS (enabled per previous discussion, but user said not needed for main.py - we apply to model server only for tidiness)
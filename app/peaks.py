@@ -0,0 +1,141 @@
+"""
+SongGeneration Studio - Waveform Peaks
+Multi-resolution min/max peaks of an output track, stored next to the FLAC so the
+UI can draw a waveform without downloading and decoding the audio.
+
+Sidecar layout (<track>.flac.peaks, little endian):
+- header: b"PEAK", version (u16), sample_rate (u32), num_samples (u64), num_levels (u16)
+- per level: samples_per_peak (u32), num_peaks (u32)
+- per level, in the same order: num_peaks (min, max) int16 pairs, channels merged
+
+Written to <track>.flac.peaks.part and renamed into place, so readers never see a torn file.
+"""
+
+import os
+import struct
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+MAGIC = b"PEAK"
+VERSION = 1
+HEADER = struct.Struct("<4sHIQH")
+LEVEL = struct.Struct("<II")
+
+# Finest level, each coarser one merges LEVEL_FACTOR peaks of the previous
+BASE_SAMPLES_PER_PEAK = 256
+LEVEL_FACTOR = 4
+NUM_LEVELS = 4
+
+
+def peaks_path(audio_path) -> Path:
+    return Path(f"{audio_path}.peaks")
+
+
+def _merge(mins: np.ndarray, maxs: np.ndarray, factor: int):
+    pad = -len(mins) % factor
+    if pad:
+        mins = np.concatenate([mins, np.full(pad, mins[-1], mins.dtype)])
+        maxs = np.concatenate([maxs, np.full(pad, maxs[-1], maxs.dtype)])
+    return mins.reshape(-1, factor).min(axis=1), maxs.reshape(-1, factor).max(axis=1)
+
+
+def compute_peaks(audio: np.ndarray, sample_rate: int) -> dict:
+    """Peak levels of a [C, T] float waveform, finest first."""
+    audio = np.atleast_2d(audio)
+    num_samples = audio.shape[-1]
+    pad = -num_samples % BASE_SAMPLES_PER_PEAK
+    if pad:
+        audio = np.pad(audio, ((0, 0), (0, pad)))
+    frames = audio.reshape(audio.shape[0], -1, BASE_SAMPLES_PER_PEAK)
+    mins, maxs = frames.min(axis=(0, 2)), frames.max(axis=(0, 2))
+    mins = np.round(np.clip(mins, -1, 1) * 32767).astype("<i2")
+    maxs = np.round(np.clip(maxs, -1, 1) * 32767).astype("<i2")
+
+    levels = [(BASE_SAMPLES_PER_PEAK, mins, maxs)]
+    for _ in range(NUM_LEVELS - 1):
+        if len(mins) <= 1:
+            break
+        mins, maxs = _merge(mins, maxs, LEVEL_FACTOR)
+        levels.append((levels[-1][0] * LEVEL_FACTOR, mins, maxs))
+    return {"sample_rate": sample_rate, "num_samples": num_samples, "levels": levels}
+
+
+def write_peaks(audio_path, audio: np.ndarray, sample_rate: int) -> Path:
+    """Compute the peaks of an in-memory [C, T] waveform and write the sidecar of audio_path."""
+    peaks = compute_peaks(audio, sample_rate)
+    path = peaks_path(audio_path)
+    partial = path.with_name(path.name + ".part")
+    with open(partial, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, sample_rate, peaks["num_samples"], len(peaks["levels"])))
+        for samples_per_peak, mins, _ in peaks["levels"]:
+            f.write(LEVEL.pack(samples_per_peak, len(mins)))
+        for _, mins, maxs in peaks["levels"]:
+            f.write(np.stack([mins, maxs], axis=1).tobytes())
+    os.replace(partial, path)
+    return path
+
+
+def _is_complete(path: Path) -> bool:
+    """Whether the sidecar is as long as its header and level table say (torn or old files aren't)."""
+    try:
+        with open(path, "rb") as f:
+            magic, version, _, _, num_levels = HEADER.unpack(f.read(HEADER.size))
+            levels = [LEVEL.unpack(f.read(LEVEL.size)) for _ in range(num_levels)]
+        expected = HEADER.size + num_levels * LEVEL.size + sum(count * 4 for _, count in levels)
+        return magic == MAGIC and version == VERSION and path.stat().st_size == expected
+    except (OSError, struct.error):
+        return False
+
+
+def ensure_peaks(audio_path) -> Path:
+    """Sidecar of audio_path, computed from the file itself when it is missing or incomplete."""
+    path = peaks_path(audio_path)
+    if not _is_complete(path):
+        import soundfile as sf
+        audio, sample_rate = sf.read(str(audio_path), dtype="float32", always_2d=True)
+        write_peaks(audio_path, audio.T, sample_rate)
+    return path
+
+
+def read_peaks(path, width: Optional[int] = None) -> dict:
+    """
+    Read a sidecar and return one level: the finest with at most `width` peaks, or the
+    coarsest when none fits or no width is given (a full-resolution level is tens of
+    thousands of peaks, more than any waveform is wide).
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, sample_rate, num_samples, num_levels = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a peaks file: {path}")
+    offset = HEADER.size
+    levels = []
+    for i in range(num_levels):
+        levels.append(LEVEL.unpack_from(data, offset + i * LEVEL.size))
+    offset += num_levels * LEVEL.size
+
+    chosen = num_levels - 1
+    if width:
+        fitting = [i for i, (_, count) in enumerate(levels) if count <= width]
+        chosen = fitting[0] if fitting else chosen
+    for i in range(chosen):
+        offset += levels[i][1] * 4
+    samples_per_peak, count = levels[chosen]
+    pairs = np.frombuffer(data, "<i2", count * 2, offset).reshape(count, 2)
+    return {
+        "duration": num_samples / sample_rate, "sample_rate": sample_rate,
+        "samples_per_peak": samples_per_peak,
+        "min": (pairs[:, 0] / 32767).round(4).tolist(), "max": (pairs[:, 1] / 32767).round(4).tolist(),
+    }
+
+
+def read_duration(path) -> Optional[float]:
+    """Track duration from the sidecar header alone."""
+    try:
+        with open(path, "rb") as f:
+            magic, version, sample_rate, num_samples, _ = HEADER.unpack(f.read(HEADER.size))
+        return num_samples / sample_rate if magic == MAGIC and version == VERSION else None
+    except (OSError, struct.error):
+        return None
@@ -0,0 +1,114 @@
+"""
+SongGeneration Studio - Reference Audio
+Trims an uploaded reference track to the window the user picked and stores only that
+clip, so a multi-minute upload never gets decoded, resampled or separated in full.
+
+- Decoded incrementally with soundfile (libsndfile): seek to the window start, read
+  the window's frames, stop. Formats libsndfile can't read (AAC/M4A, ...) go through
+  ffmpeg with input seeking and a duration limit, which also stops after the window
+- Resampled once to REFERENCE_SAMPLE_RATE (48 kHz, the rate Separator and the VAE use),
+  stereo
+- Stored as uploads/<id>_<name>.flac, id being the first 16 hex digits of the SHA-256
+  of the trimmed 48 kHz samples: the same clip uploaded twice is stored once and keeps
+  hitting the Separator's stem cache, which is keyed by file name
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+import numpy as np
+
+from config import UPLOADS_DIR
+
+REFERENCE_SAMPLE_RATE = 48000
+# Separator and Tango.crop_prompt only ever look at the first 10s of a reference
+MAX_REFERENCE_SECONDS = 10.0
+HASH_DIGITS = 16
+
+
+def _read_window(f: BinaryIO, start: float, duration: float):
+    """(frames [T, C] float32, sample rate) of the window, or None when libsndfile can't read f."""
+    import soundfile as sf
+    f.seek(0)
+    try:
+        audio_file = sf.SoundFile(f)
+    except RuntimeError:
+        return None
+    with audio_file:
+        sample_rate = audio_file.samplerate
+        first = int(round(start * sample_rate))
+        if first >= audio_file.frames:
+            return np.zeros((0, audio_file.channels), dtype=np.float32), sample_rate
+        audio_file.seek(first)
+        return audio_file.read(int(round(duration * sample_rate)), dtype="float32", always_2d=True), sample_rate
+
+
+def _read_window_ffmpeg(f: BinaryIO, start: float, duration: float):
+    """Same window through ffmpeg, as stereo resampled to REFERENCE_SAMPLE_RATE on the way."""
+    if shutil.which("ffmpeg") is None:
+        raise ValueError("Unsupported audio format (install ffmpeg to read it)")
+    f.seek(0)
+    with tempfile.NamedTemporaryFile(dir=UPLOADS_DIR, suffix=".part") as spool:
+        # ffmpeg needs a seekable input for formats with the index at the end (M4A)
+        shutil.copyfileobj(f, spool)
+        spool.flush()
+        command = ["ffmpeg", "-v", "error", "-ss", str(start), "-t", str(duration), "-i", spool.name,
+                   "-map", "0:a:0", "-f", "f32le", "-ac", "2", "-ar", str(REFERENCE_SAMPLE_RATE), "pipe:1"]
+        result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        raise ValueError(f"Could not decode audio: {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.float32).reshape(-1, 2), REFERENCE_SAMPLE_RATE
+
+
+def _safe_name(filename: Optional[str]) -> str:
+    name = re.sub(r"[^A-Za-z0-9._-]+", "_", Path(filename or "reference").stem).strip("._")
+    return name[:64] or "reference"
+
+
+def trim_reference(f: BinaryIO, filename: Optional[str], start: float, duration: float) -> dict:
+    """
+    Store the [start, start + duration) window (capped at MAX_REFERENCE_SECONDS) of an
+    uploaded audio file object; returns {"id", "path", "duration", "sample_rate", "sha256"}.
+    Raises ValueError for unreadable files and empty windows.
+    """
+    start = max(0.0, float(start))
+    duration = min(float(duration), MAX_REFERENCE_SECONDS)
+    if duration <= 0:
+        raise ValueError("Empty reference window")
+
+    window = _read_window(f, start, duration)
+    if window is None:
+        window = _read_window_ffmpeg(f, start, duration)
+    audio, sample_rate = window
+    if audio.shape[0] == 0:
+        raise ValueError("Reference window starts after the end of the audio")
+    # The prompt path works on stereo
+    audio = np.repeat(audio, 2, axis=1) if audio.shape[1] == 1 else audio[:, :2]
+    if sample_rate != REFERENCE_SAMPLE_RATE:
+        import torch
+        import torchaudio
+        audio = torchaudio.functional.resample(torch.from_numpy(np.ascontiguousarray(audio.T)), sample_rate,
+                                               REFERENCE_SAMPLE_RATE).T.numpy()
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+
+    digest = hashlib.sha256(audio.tobytes()).hexdigest()
+    ref_id = digest[:HASH_DIGITS]
+    existing = sorted(UPLOADS_DIR.glob(f"{ref_id}_*.flac"))
+    if existing:
+        path = existing[0]
+    else:
+        import soundfile as sf
+        path = UPLOADS_DIR / f"{ref_id}_{_safe_name(filename)}.flac"
+        partial = path.with_name(path.name + ".part")
+        sf.write(str(partial), audio, REFERENCE_SAMPLE_RATE, format="FLAC", subtype="PCM_24")
+        os.replace(partial, path)
+    print(f"[REFERENCE] {filename} [{start:.2f}s +{audio.shape[0] / REFERENCE_SAMPLE_RATE:.2f}s] -> {path.name}"
+          f"{' (already stored)' if existing else ''}", flush=True)
+    return {"id": ref_id, "path": str(path), "duration": audio.shape[0] / REFERENCE_SAMPLE_RATE,
+            "sample_rate": REFERENCE_SAMPLE_RATE, "sha256": digest}
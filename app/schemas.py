@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Optional, List, Dict
 from pydantic import BaseModel
 
 class Section(BaseModel):
@@ -28,6 +28,52 @@ class SongRequest(BaseModel):
     
     # --- ADDED ---
     duration: Optional[int] = None
+    previews: List[str] = []
+
+class RedecodeRequest(BaseModel):
+    output_mode: str = "separate"
+    num_steps: int = 50
+    sample_rate: Optional[int] = None
+
+# Re-decode bounds, checked by the studio and again by the model server
+REDECODE_MODES = ("mixed", "vocal", "bgm", "separate")
+MAX_REDECODE_STEPS = 200
+MIN_REDECODE_SAMPLE_RATE, MAX_REDECODE_SAMPLE_RATE = 8000, 192000
+
+def redecode_error(gen_type: str, num_steps: int, sample_rate: Optional[int] = None) -> Optional[str]:
+    """Why a re-decode request is invalid, None when it is fine."""
+    if gen_type not in REDECODE_MODES: return f"Unknown output mode: {gen_type} ({', '.join(REDECODE_MODES)})"
+    if not 0 < num_steps <= MAX_REDECODE_STEPS: return f"num_steps must be between 1 and {MAX_REDECODE_STEPS}"
+    if sample_rate is not None and not MIN_REDECODE_SAMPLE_RATE <= sample_rate <= MAX_REDECODE_SAMPLE_RATE:
+        return f"sample_rate must be between {MIN_REDECODE_SAMPLE_RATE} and {MAX_REDECODE_SAMPLE_RATE}"
+    return None
 
 class UpdateGenerationRequest(BaseModel):
     title: Optional[str] = None
+
+# --- Model server protocol (main.py <-> model_server.py) ---
+
+class ServerGenerateRequest(BaseModel):
+    idx: str
+    save_dir: str
+    gen_type: str = "mixed"
+    lyric: str = ""
+    description: Optional[str] = None
+    prompt_audio_path: Optional[str] = None
+    auto_prompt_audio_type: Optional[str] = None
+    cfg_coef: Optional[float] = None
+    temperature: Optional[float] = None
+    top_k: Optional[int] = None
+    top_p: Optional[float] = None
+    extend_stride: Optional[int] = None
+    duration: Optional[int] = None
+    previews: List[str] = []
+
+class ServerGenerateResponse(BaseModel):
+    status: str
+    output_files: List[str] = []
+    preview_files: List[str] = []
+    generation_time: Optional[float] = None
+    stage_rates: Optional[Dict[str, float]] = None
+    message: Optional[str] = None
+    error: Optional[str] = None
@@ -1,67 +1,137 @@
 import asyncio
+import copy
+import heapq
 import json
+from collections import OrderedDict
+from itertools import count
 from typing import Dict, Any, List
 from fastapi import Request
 
-# Global list of queues (one per connected browser tab)
-_event_queues: List[asyncio.Queue] = []
+from library_index import PAGE_SIZE, page_cursor
+
+# Pending events per browser tab before a stalled tab is resynced from scratch
+MAX_PENDING_EVENTS = 256
+
+
+class _Subscriber:
+    """
+    Bounded outbox of one browser tab. Events are keyed so a newer event replaces
+    a pending one it supersedes (e.g. the progress of the same generation) instead of
+    queueing behind it.
+    """
+
+    def __init__(self):
+        self.pending: "OrderedDict[Any, dict]" = OrderedDict()
+        self.ready = asyncio.Event()
+
+    def push(self, key, message: dict):
+        if key in self.pending:
+            # Superseded: drop the stale event, the new one goes to the back
+            del self.pending[key]
+        elif len(self.pending) >= MAX_PENDING_EVENTS:
+            # The tab is not reading; rather than grow without limit, start it over
+            self.pending.clear()
+            key, message = "library_page", _library_page_message()
+        self.pending[key] = message
+        self.ready.set()
+
+    async def get(self, timeout: float) -> dict:
+        if not self.pending:
+            self.ready.clear()
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        return self.pending.popitem(last=False)[1]
+
+
+# Global list of subscribers (one per connected browser tab)
+_subscribers: List[_Subscriber] = []
+# Last library state sent to the tabs, by generation id, to compute deltas against (deep copies,
+# so changes inside nested fields such as metadata show up as deltas)
+_library: Dict[str, Dict[str, Any]] = {}
+_seq = count()
 
 async def event_generator(request: Request):
     """
     Generator function that maintains the connection with the browser
     and sends updates (progress bars, status changes) in real-time.
     """
-    queue = asyncio.Queue()
-    _event_queues.append(queue)
-    
+    subscriber = _Subscriber()
+    # Library deltas apply on top of the first page, the tab pages further through /api/generations
+    subscriber.push("library_page", _library_page_message())
+    _subscribers.append(subscriber)
+
     try:
         while True:
             # Check if client disconnected
             if await request.is_disconnected():
                 break
-                
+
             try:
                 # Wait for data (timeout allows sending keep-alive pings)
-                data = await asyncio.wait_for(queue.get(), timeout=1.0)
+                data = await subscriber.get(timeout=1.0)
                 yield data
             except asyncio.TimeoutError:
                 # Send empty comment to keep connection alive
                 yield {"comment": "ping"}
-                
+
     except Exception as e:
         print(f"[SSE] Error in event stream: {e}", flush=True)
     finally:
-        if queue in _event_queues:
-            _event_queues.remove(queue)
-
-def _broadcast(event_name: str, data: Any):
-    """Internal helper to push data to all active clients."""
-    message = {
-        "event": event_name,
-        "data": json.dumps(data)
-    }
-    # Send to all connected queues
-    for q in _event_queues:
-        try:
-            q.put_nowait(message)
-        except:
-            pass # Queue full or closed
+        if subscriber in _subscribers:
+            _subscribers.remove(subscriber)
+
+def _message(event_name: str, data: Any) -> dict:
+    return {"event": event_name, "data": json.dumps(data)}
+
+def _library_page_message() -> dict:
+    """
+    First page of the library as GET /api/generations serves it: the generations not yet
+    saved, then the newest finished ones, and the cursor of the next page.
+    """
+    active = sorted((g for g in _library.values() if g.get("status") != "completed"),
+                    key=lambda g: g.get("created_at", ""), reverse=True)
+    finished = heapq.nlargest(PAGE_SIZE + 1, (g for g in _library.values() if g.get("status") == "completed"),
+                              key=lambda g: (g.get("created_at", ""), g["id"]))
+    next_cursor = page_cursor(finished[PAGE_SIZE - 1]) if len(finished) > PAGE_SIZE else None
+    return _message("library_page", {"items": active + finished[:PAGE_SIZE], "next_cursor": next_cursor})
+
+def _broadcast(event_name: str, data: Any, key=None):
+    """
+    Internal helper to push data to all active clients. The payload is serialised
+    once and the same message is shared by every subscriber. Events with the same
+    key coalesce; without a key every event is delivered.
+    """
+    message = _message(event_name, data)
+    if key is None:
+        key = next(_seq)
+    for subscriber in _subscribers:
+        subscriber.push(key, message)
 
 # --- Public API Functions (Imported by main.py) ---
 
 def notify_queue_update():
     """Tell UI to refresh the queue list."""
-    _broadcast("queue_update", {})
+    _broadcast("queue_update", {}, key="queue_update")
 
 def notify_generation_update(gen_id: str, data: Dict[str, Any]):
     """Send progress bar updates for a specific generation."""
     payload = data.copy()
     payload["id"] = gen_id
-    _broadcast("generation_update", payload)
+    _broadcast("generation_update", payload, key=("generation_update", gen_id))
 
 def notify_library_update(generations: Dict[str, Any]):
-    """Send the full updated list of generations."""
-    _broadcast("library_update", list(generations.values()))
+    """Send what changed in the library since the last update (added, changed, removed)."""
+    added, changed = [], []
+    for gen_id, gen in generations.items():
+        previous = _library.get(gen_id)
+        if previous is None: added.append(gen)
+        elif previous != gen: changed.append(gen)
+        else: continue
+        _library[gen_id] = copy.deepcopy(gen)
+    removed = [gen_id for gen_id in _library if gen_id not in generations]
+    for gen_id in removed:
+        del _library[gen_id]
+    if added or changed or removed:
+        _broadcast("library_delta", {"added": added, "changed": changed, "removed": removed})
 
 async def notify_models_update(get_models_func):
     """
@@ -69,8 +139,8 @@ async def notify_models_update(get_models_func):
     Takes an async function to fetch fresh data.
     """
     data = await get_models_func()
-    _broadcast("models_update", data)
+    _broadcast("models_update", data, key="models_update")
 
 def notify_models_update_sync(data):
     """Sync version of model update notification."""
-    _broadcast("models_update", data)
+    _broadcast("models_update", data, key="models_update")
@@ -26,6 +26,14 @@ from .utils import center_trim, DummyPoolExecutor
 
 Model = tp.Union[HTDemucs]
 
+# Rough upper bound of HTDemucs activation memory per input sample (all channels, one
+# batch item), in bytes. Used to turn a memory budget into a segment batch size.
+SEGMENT_BYTES_PER_SAMPLE = 1024
+# Memory budget used by `BagOfModels.separate` for batched segment inference on
+# accelerators. On CPU the intra-op threads are already busy at batch size 1 and the
+# larger batches measured slower (tools/bench_demucs_batching.py), so it stays off there.
+DEFAULT_SEGMENT_BATCH_MB = 1024.
+
 
 class BagOfModels(nn.Module):
     def __init__(self, models: tp.List[Model],
@@ -78,13 +86,26 @@ class BagOfModels(nn.Module):
     def forward(self, x):
         raise NotImplementedError("Call `apply_model` on this.")
     
-    def separate(self, source_file, output_dir, stem=None, device=None):
+    def separate(self, source_file, output_dir, stem=None, device=None,
+                 segment_batch_mb: tp.Union[float, str, None] = 'auto', write_rest: bool = True):
+        """
+        Separate `source_file` into FLAC stems in `output_dir`. With `stem`, only that
+        source is estimated and the rest of the mix (written as `_no_{stem}` unless
+        `write_rest` is False) is derived as mix minus stem. `segment_batch_mb='auto'`
+        batches segments with DEFAULT_SEGMENT_BATCH_MB off the CPU, None disables batching.
+        """
+        if segment_batch_mb == 'auto':
+            on_cpu = th.device(device).type == 'cpu' if device is not None else True
+            segment_batch_mb = None if on_cpu else DEFAULT_SEGMENT_BATCH_MB
         wav, _ = load_track(source_file, self.audio_channels, self.samplerate)
+        mix = wav.clone()
         ref = wav.mean(0)
         wav -= ref.mean()
         wav /= ref.std()
         sources = apply_model(self, wav[None], device=device, shifts=1, split=True, overlap=0.25, 
-                              progress=True, num_workers=0, segment=None)[0]
+                              progress=True, num_workers=0, segment=None,
+                              segment_batch_mb=segment_batch_mb,
+                              sources=None if stem is None else [stem])[0]
         sources *= ref.std()
         sources += ref.mean()
 
@@ -105,15 +126,13 @@ class BagOfModels(nn.Module):
                 save_audio(source, output_stem_path, **kwargs)
                 output_paths.append(output_stem_path)
         else:
-            sources = list(sources)
             output_stem_path = os.path.join(output_dir, f"{name}_{stem}{ext}")
-            save_audio(sources.pop(self.sources.index(stem)), output_stem_path, **kwargs)
-            other_stem = torch.zeros_like(sources[0])
-            for i in sources:
-                other_stem += i
-            output_no_stem_path = os.path.join(output_dir, f"{name}_no_{stem}{ext}")
-            save_audio(other_stem, output_no_stem_path, **kwargs)
-            output_paths = [output_stem_path, output_no_stem_path]
+            save_audio(sources[0], output_stem_path, **kwargs)
+            output_paths = [output_stem_path]
+            if write_rest:
+                output_no_stem_path = os.path.join(output_dir, f"{name}_no_{stem}{ext}")
+                save_audio(mix.to(sources.device) - sources[0], output_no_stem_path, **kwargs)
+                output_paths.append(output_no_stem_path)
 
         return output_paths
 
@@ -171,13 +190,57 @@ def tensor_chunk(tensor_or_chunk):
         return TensorChunk(tensor_or_chunk)
 
 
+def _valid_length(model, length: int, segment: tp.Optional[float]) -> int:
+    if isinstance(model, HTDemucs) and segment is not None:
+        return int(segment * model.samplerate)
+    elif hasattr(model, 'valid_length'):
+        return model.valid_length(length)  # type: ignore
+    return length
+
+
+def segment_batch_size(segment_length: int, batch: int, segment_batch_mb: float) -> int:
+    """Number of segments that fit in `segment_batch_mb` of activations."""
+    segment_bytes = segment_length * batch * SEGMENT_BYTES_PER_SAMPLE
+    return max(1, int(segment_batch_mb * 2**20 // segment_bytes))
+
+
+def _forward(model: Model, mix: th.Tensor, sources: tp.Optional[tp.List[str]]) -> th.Tensor:
+    with th.no_grad():
+        return model(mix) if sources is None else model(mix, sources=sources)
+
+
+def _apply_batched(model: Model, chunks: tp.List[TensorChunk], device, segment: tp.Optional[float],
+                   segment_batch_mb: float, sources: tp.Optional[tp.List[str]] = None):
+    """
+    Run the segments through the model in micro-batches, yielding each segment's output.
+    Each segment is padded and trimmed exactly as `apply_model(..., split=False)` does,
+    only the forward passes are shared. Consecutive segments with the same padded length
+    (all of them, except possibly the last one) go in one batch.
+    """
+    batch = chunks[0].shape[0]
+    i = 0
+    while i < len(chunks):
+        valid_length = _valid_length(model, chunks[i].length, segment)
+        max_size = segment_batch_size(valid_length, batch, segment_batch_mb)
+        group = [chunks[i]]
+        while (len(group) < max_size and i + len(group) < len(chunks)
+               and _valid_length(model, chunks[i + len(group)].length, segment) == valid_length):
+            group.append(chunks[i + len(group)])
+        padded = th.cat([chunk.padded(valid_length) for chunk in group]).to(device)
+        out = _forward(model, padded, sources)
+        for k, chunk in enumerate(group):
+            yield center_trim(out[k * batch:(k + 1) * batch], chunk.length)
+        i += len(group)
+
+
 def apply_model(model: tp.Union[BagOfModels, Model],
                 mix: tp.Union[th.Tensor, TensorChunk],
                 shifts: int = 1, split: bool = True,
                 overlap: float = 0.25, transition_power: float = 1.,
                 progress: bool = False, device=None,
                 num_workers: int = 0, segment: tp.Optional[float] = None,
-                pool=None) -> th.Tensor:
+                pool=None, segment_batch_mb: tp.Optional[float] = None,
+                sources: tp.Optional[tp.List[str]] = None) -> th.Tensor:
     """
     Apply model to a given mixture.
 
@@ -197,6 +260,12 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         num_workers (int): if non zero, device is 'cpu', how many threads to
             use in parallel.
         segment (float or None): override the model segment parameter.
+        segment_batch_mb (float or None): if set (and split=True), the overlapping segments
+            are gathered into micro-batches sized to this activation memory budget (MB) and
+            each batch runs in a single forward pass, instead of one forward per segment.
+            `num_workers` is ignored in this mode.
+        sources (list[str] or None): only estimate these sources, in this order (see
+            `HTDemucs.forward`). The output then has len(sources) entries on dim 1.
     """
     if device is None:
         device = mix.device
@@ -216,6 +285,8 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         'device': device,
         'pool': pool,
         'segment': segment,
+        'segment_batch_mb': segment_batch_mb,
+        'sources': sources,
     }
     out: tp.Union[float, th.Tensor]
     if isinstance(model, BagOfModels):
@@ -223,14 +294,16 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         # We explicitely apply multiple times `apply_model` so that the random shifts
         # are different for each model.
         estimates: tp.Union[float, th.Tensor] = 0.
-        totals = [0.] * len(model.sources)
+        names = sources or model.sources
+        totals = [0.] * len(names)
         for sub_model, model_weights in zip(model.models, model.weights):
             original_model_device = next(iter(sub_model.parameters())).device
             sub_model.to(device)
 
             out = apply_model(sub_model, mix, **kwargs)
             sub_model.to(original_model_device)
-            for k, inst_weight in enumerate(model_weights):
+            for k, name in enumerate(names):
+                inst_weight = model_weights[model.sources.index(name)]
                 out[:, k, :, :] *= inst_weight
                 totals[k] += inst_weight
             estimates += out
@@ -262,7 +335,7 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         return out
     elif split:
         kwargs['split'] = False
-        out = th.zeros(batch, len(model.sources), channels, length, device=mix.device)
+        out = th.zeros(batch, len(sources or model.sources), channels, length, device=mix.device)
         sum_weight = th.zeros(length, device=mix.device)
         if segment is None:
             segment = model.segment
@@ -280,16 +353,20 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         # If the overlap < 50%, this will translate to linear transition when
         # transition_power is 1.
         weight = (weight / weight.max())**transition_power
-        futures = []
-        for offset in offsets:
-            chunk = TensorChunk(mix, offset, segment_length)
-            future = pool.submit(apply_model, model, chunk, **kwargs)
-            futures.append((future, offset))
-            offset += segment_length
+        if segment_batch_mb is not None:
+            chunks = [TensorChunk(mix, offset, segment_length) for offset in offsets]
+            results = zip(_apply_batched(model, chunks, device, segment, segment_batch_mb, sources), offsets)
+        else:
+            futures = []
+            for offset in offsets:
+                chunk = TensorChunk(mix, offset, segment_length)
+                future = pool.submit(apply_model, model, chunk, **kwargs)
+                futures.append((future, offset))
+                offset += segment_length
+            results = ((future.result(), offset) for future, offset in futures)
         if progress:
-            futures = tqdm.tqdm(futures, unit_scale=scale, ncols=120, unit='seconds')
-        for future, offset in futures:
-            chunk_out = future.result()
+            results = tqdm.tqdm(results, total=len(offsets), unit_scale=scale, ncols=120, unit='seconds')
+        for chunk_out, offset in results:
             chunk_length = chunk_out.shape[-1]
             out[..., offset:offset + segment_length] += (
                 weight[:chunk_length] * chunk_out).to(mix.device)
@@ -299,17 +376,10 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         assert isinstance(out, th.Tensor)
         return out
     else:
-        valid_length: int
-        if isinstance(model, HTDemucs) and segment is not None:
-            valid_length = int(segment * model.samplerate)
-        elif hasattr(model, 'valid_length'):
-            valid_length = model.valid_length(length)  # type: ignore
-        else:
-            valid_length = length
+        valid_length = _valid_length(model, length, segment)
         mix = tensor_chunk(mix)
         assert isinstance(mix, TensorChunk)
         padded_mix = mix.padded(valid_length).to(device)
-        with th.no_grad():
-            out = model(padded_mix)
+        out = _forward(model, padded_mix, sources)
         assert isinstance(out, th.Tensor)
         return center_trim(out, length)
@@ -18,7 +18,6 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from einops import rearrange
-from openunmix.filtering import wiener
 
 from .transformer import CrossTransformerEncoder
 from .demucs import DConv, rescale_module
@@ -29,7 +28,6 @@ from .spec import spectro, ispectro
 def pad1d(x: torch.Tensor, paddings: tp.Tuple[int, int], mode: str = 'constant', value: float = 0.):
     """Tiny wrapper around F.pad, just to allow for reflect padding on small input.
     If this is the case, we insert extra 0 padding to the right before the reflection happen."""
-    x0 = x
     length = x.shape[-1]
     padding_left, padding_right = paddings
     if mode == 'reflect':
@@ -42,7 +40,6 @@ def pad1d(x: torch.Tensor, paddings: tp.Tuple[int, int], mode: str = 'constant',
             x = F.pad(x, (extra_pad_left, extra_pad_right))
     out = F.pad(x, paddings, mode, value)
     assert out.shape[-1] == length + padding_left + padding_right
-    assert (out[..., padding_left: padding_left + length] == x0).all()
     return out
 
 
@@ -318,6 +315,43 @@ class HDecLayer(nn.Module):
         return z, y
 
 
+def batched_wiener(mag: torch.Tensor, mix: torch.Tensor, iterations: int, residual: bool = False,
+                   scale_factor: float = 10.0, eps: float = 1e-10) -> torch.Tensor:
+    """
+    Multichannel Wiener filtering of OpenUnmix (`openunmix.filtering.wiener` with
+    softmask=False) over a batch of independent windows at once.
+
+    Args:
+        mag: source magnitudes [W, T, F, C, S] (windows, frames, bins, channels, sources).
+        mix: complex mixture STFT [W, T, F, C].
+    Returns:
+        complex source STFTs [W, T, F, C, S], or S + 1 sources with `residual`.
+
+    Frames that are all zero (padding of the last window) contribute nothing to
+    the covariance estimates, so zero-padded windows give the same result as
+    shorter ones.
+    """
+    y = mag * torch.exp(1j * torch.angle(mix))[..., None]
+    if residual:
+        y = torch.cat([y, mix[..., None] - y.sum(dim=-1, keepdim=True)], dim=-1)
+    if iterations == 0:
+        return y
+
+    # Scale down for numerical stability, per window as OpenUnmix does per call
+    max_abs = (mix.abs().amax(dim=(1, 2, 3), keepdim=True) / scale_factor).clamp(min=1.0)
+    mix = mix / max_abs
+    y = y / max_abs[..., None]
+    regularization = eps ** 0.5 * torch.eye(mix.shape[-1], dtype=mix.dtype, device=mix.device)
+    for _ in range(iterations):
+        # Power spectral densities and spatial covariances of every source
+        v = (y.abs() ** 2).mean(dim=-2)
+        R = torch.einsum('wtfcs,wtfds->wfscd', y, y.conj()) / (eps + v.sum(dim=1))[..., None, None]
+        Cxx = regularization + torch.einsum('wtfs,wfscd->wtfcd', v.to(R.dtype), R)
+        gain = torch.einsum('wfscd,wtfde->wtfsce', R, torch.linalg.inv(Cxx)) * v[..., None, None]
+        y = torch.einsum('wtfsce,wtfe->wtfcs', gain, mix)
+    return y * max_abs[..., None]
+
+
 class HTDemucs(nn.Module):
     """
     Spectrogram and hybrid Demucs model.
@@ -729,9 +763,10 @@ class HTDemucs(nn.Module):
         pad = hl // 2 * 3
         x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
 
-        z = spectro(x, nfft, hl)[..., :-1, :]
-        assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
-        z = z[..., 2: 2 + le]
+        # The frames a centered STFT would add on each side (and that used to be cut
+        # off here) only see its own padding, so skip it and get exactly `le` frames.
+        z = spectro(x, nfft, hl, center=False)[..., :-1, :]
+        assert z.shape[-1] == le, (z.shape, x.shape, le)
         return z
 
     def _ispec(self, z, length=None, scale=0):
@@ -773,30 +808,24 @@ class HTDemucs(nn.Module):
             return self._wiener(m, z, niters)
 
     def _wiener(self, mag_out, mix_stft, niters):
-        # apply wiener filtering from OpenUnmix.
+        # apply wiener filtering from OpenUnmix, on every sample and window in one go.
         init = mix_stft.dtype
         wiener_win_len = 300
         residual = self.wiener_residual
 
         b, s, c, fq, t = mag_out.shape
-        mag_out = mag_out.permute(0, 4, 3, 2, 1)
-        mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
-
-        outs = []
-        for sample in range(b):
-            pos = 0
-            out = []
-            for pos in range(0, t, wiener_win_len):
-                frame = slice(pos, pos + wiener_win_len)
-                z_out = wiener(
-                    mag_out[sample, frame],
-                    mix_stft[sample, frame],
-                    niters,
-                    residual=residual,
-                )
-                out.append(z_out.transpose(-1, -2))
-            outs.append(torch.cat(out, dim=0))
-        out = torch.view_as_complex(torch.stack(outs, 0))
+        windows = (t + wiener_win_len - 1) // wiener_win_len
+        padded = windows * wiener_win_len
+        # [B, S, C, Fq, T] -> [B * windows, win, Fq, C, S], zero padding the last window
+        mag_out = F.pad(mag_out, (0, padded - t))
+        mag_out = mag_out.view(b, s, c, fq, windows, wiener_win_len).permute(0, 4, 5, 3, 2, 1)
+        mix = mix_stft.new_zeros(b, c, fq, padded)
+        mix[..., :t] = mix_stft
+        mix = mix.view(b, c, fq, windows, wiener_win_len).permute(0, 3, 4, 2, 1)
+
+        out = batched_wiener(mag_out.reshape(b * windows, wiener_win_len, fq, c, s),
+                             mix.reshape(b * windows, wiener_win_len, fq, c), niters, residual=residual)
+        out = out.view(b, padded, fq, c, -1)[:, :t]
         out = out.permute(0, 4, 3, 2, 1).contiguous()
         if residual:
             out = out[:, :-1]
@@ -819,7 +848,12 @@ class HTDemucs(nn.Module):
                     f"training length {training_length}")
         return training_length
 
-    def forward(self, mix):
+    def forward(self, mix, sources: tp.Optional[tp.List[str]] = None):
+        """
+        Separate `mix` into all sources, or only the named `sources` (in that order).
+        The encoder, transformer and decoder stacks produce every source jointly, so a
+        subset only saves the per-source masking and inverse STFT.
+        """
         length = mix.shape[-1]
         length_pre_pad = None
         if self.use_train_segment:
@@ -929,6 +963,10 @@ class HTDemucs(nn.Module):
             x = x.cpu()
 
         zout = self._mask(z, x)
+        if sources is not None:
+            # Masking first: Wiener filtering needs every source's estimate
+            keep = [self.sources.index(source) for source in sources]
+            zout = zout[:, keep]
         if self.use_train_segment:
             if self.training:
                 x = self._ispec(zout, length)
@@ -948,6 +986,8 @@ class HTDemucs(nn.Module):
                 xt = xt.view(b, s, -1, training_length)
         else:
             xt = xt.view(b, s, -1, length)
+        if sources is not None:
+            xt = xt[:, keep]
         xt = xt * stdt[:, None] + meant[:, None]
         x = xt + x
         if length_pre_pad:
@@ -11,8 +11,19 @@
 
 import torch as th
 
+# Hann windows by (length, device, dtype), built once instead of on every call
+_windows = {}
 
-def spectro(x, n_fft=512, hop_length=None, pad=0):
+
+def hann_window(length, like):
+    key = (length, like.device, like.dtype)
+    window = _windows.get(key)
+    if window is None:
+        window = _windows[key] = th.hann_window(length, device=like.device, dtype=like.dtype)
+    return window
+
+
+def spectro(x, n_fft=512, hop_length=None, pad=0, center=True):
     *other, length = x.shape
     x = x.reshape(-1, length)
     is_mps = x.device.type == 'mps'
@@ -21,10 +32,10 @@ def spectro(x, n_fft=512, hop_length=None, pad=0):
     z = th.stft(x,
                 n_fft * (1 + pad),
                 hop_length or n_fft // 4,
-                window=th.hann_window(n_fft).to(x),
+                window=hann_window(n_fft, x),
                 win_length=n_fft,
                 normalized=True,
-                center=True,
+                center=center,
                 return_complex=True,
                 pad_mode='reflect')
     _, freqs, frame = z.shape
@@ -42,7 +53,7 @@ def ispectro(z, hop_length=None, length=None, pad=0):
     x = th.istft(z,
                  n_fft,
                  hop_length,
-                 window=th.hann_window(win_length).to(z.real),
+                 window=hann_window(win_length, z.real),
                  win_length=win_length,
                  normalized=True,
                  length=length,
@@ -8,33 +8,167 @@ Algorithm:
 - After each generation, the estimate is gradually updated using exponential moving average
 - More lyrics and sections = higher complexity = higher estimate
 - Records are grouped by "complexity bucket" for better matching
+
+Storage:
+- Records are appended to a SQLite table (never rewritten), capped at MAX_TIMING_RECORDS
+- Every EMA (per model, per bucket, lyrics/reference split and per stage rates) lives
+  in an aggregates table and is updated in place when a record is saved, so reading
+  stats or an estimate never replays the history
+- An existing timing_history.json is imported once; the import is recorded in a meta
+  table and the file is left where it is
+- With stage throughput EMAs and a target duration, the estimate is the sum of the
+  stage times (LM tokens / tokens per second, diffusion windows / windows per second,
+  VAE seconds); without them it falls back to the bucket and model EMAs
 """
 
 import json
-from config import TIMING_FILE, MAX_TIMING_RECORDS
+import math
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from config import TIMING_DB, TIMING_FILE, MAX_TIMING_RECORDS
+
+# Weight of the newest record in every EMA
+EMA_ALPHA = 0.5
+
+# Fallback estimates (seconds) before a model has any history
+DEFAULT_MODEL_TIMES = {"songgeneration_base": 180, "songgeneration_base_new": 180, "songgeneration_base_full": 240, "songgeneration_large": 360}
+DEFAULT_TIME = 240
+
+# Per-stage measurements the model server reports, stored as their own columns and EMAs
+STAGE_METRICS = ("lm_tokens_per_sec", "diffusion_windows_per_sec", "vae_seconds")
+# LM tokens per second of audio, and code2sound's diffusion windows in frames (40 s, 3/4 hop)
+LM_FRAME_RATE = 25
+DIFFUSION_WINDOW_FRAMES = 40 * LM_FRAME_RATE
+DIFFUSION_HOP_FRAMES = DIFFUSION_WINDOW_FRAMES // 4 * 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS timing_records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model TEXT,
+    num_sections INTEGER,
+    total_lyrics_length INTEGER,
+    complexity_bucket TEXT,
+    has_lyrics INTEGER,
+    output_mode TEXT,
+    has_reference INTEGER,
+    generation_time_seconds REAL,
+    completed_at TEXT,
+    lm_tokens_per_sec REAL,
+    diffusion_windows_per_sec REAL,
+    vae_seconds REAL
+);
+CREATE TABLE IF NOT EXISTS timing_aggregates (
+    model TEXT NOT NULL,
+    key TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    ema REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (model, key)
+);
+CREATE TABLE IF NOT EXISTS timing_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_lock = threading.Lock()
+_initialized = False
 
 # ============================================================================
 # Timing History for Smart Estimates
 # ============================================================================
 
-def load_timing_history() -> list:
-    """Load timing history from file"""
+@contextmanager
+def _db():
+    global _initialized
+    with _lock:
+        conn = sqlite3.connect(str(TIMING_DB), timeout=30)
+        try:
+            if not _initialized:
+                conn.executescript(SCHEMA)
+                _migrate(conn)
+                _import_json_history(conn)
+                _initialized = True
+            with conn: yield conn
+        finally: conn.close()
+
+
+def _migrate(conn):
+    """The diffusion rate was first stored as diffusion_steps_per_sec, though it counts windows."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(timing_records)")]
+    if "diffusion_steps_per_sec" in columns:
+        with conn:
+            conn.execute("ALTER TABLE timing_records RENAME COLUMN diffusion_steps_per_sec TO diffusion_windows_per_sec")
+            conn.execute("UPDATE timing_aggregates SET key = 'stage:diffusion_windows_per_sec' WHERE key = 'stage:diffusion_steps_per_sec'")
+
+
+def diffusion_windows(duration: float) -> int:
+    """Windows code2sound diffuses for duration seconds of codes, padded the way it pads them."""
+    codes_len = max(int(duration * LM_FRAME_RATE), DIFFUSION_WINDOW_FRAMES)
+    overlap = DIFFUSION_WINDOW_FRAMES - DIFFUSION_HOP_FRAMES
+    codes_len = math.ceil((codes_len - overlap) / DIFFUSION_HOP_FRAMES) * DIFFUSION_HOP_FRAMES + overlap
+    return len(range(0, codes_len - DIFFUSION_HOP_FRAMES, DIFFUSION_HOP_FRAMES))
+
+
+def _import_json_history(conn):
+    """One-off import of the old timing_history.json into the tables."""
+    if not TIMING_FILE.exists() or conn.execute("SELECT 1 FROM timing_meta WHERE key = 'json_imported'").fetchone():
+        return
+    if conn.execute("SELECT 1 FROM timing_records LIMIT 1").fetchone():
+        # Imported before the import was recorded
+        with conn: conn.execute("INSERT INTO timing_meta (key, value) VALUES ('json_imported', '')")
+        return
     try:
-        if TIMING_FILE.exists():
-            with open(TIMING_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+        with open(TIMING_FILE, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+        with conn:
+            for record in history:
+                if record.get("generation_time_seconds", 0) > 0:
+                    num_sections, lyrics_length = record.get("num_sections", 0), record.get("total_lyrics_length", 0)
+                    _insert_record(conn, {
+                        "model": record.get("model"), "num_sections": num_sections, "total_lyrics_length": lyrics_length,
+                        "complexity_bucket": record.get("complexity_bucket") or get_complexity_bucket(num_sections, lyrics_length),
+                        "has_lyrics": record.get("has_lyrics", False), "output_mode": record.get("output_mode", "mixed"),
+                        "has_reference": record.get("has_reference", False),
+                        "generation_time_seconds": record["generation_time_seconds"], "completed_at": record.get("completed_at"),
+                    })
+            conn.execute("INSERT INTO timing_meta (key, value) VALUES ('json_imported', ?)", (TIMING_FILE.name,))
+        print(f"[TIMING] Imported {len(history)} records from {TIMING_FILE.name}")
     except Exception as e:
-        print(f"[TIMING] Error loading timing history: {e}")
-    return []
-
-
-def save_timing_history(history: list):
-    """Save timing history to file"""
-    try:
-        with open(TIMING_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=2)
-    except Exception as e:
-        print(f"[TIMING] Error saving timing history: {e}")
+        print(f"[TIMING] Error importing timing history: {e}")
+
+
+def _update_aggregate(conn, model: str, key: str, value: float):
+    conn.execute(
+        """INSERT INTO timing_aggregates (model, key, count, ema, min, max) VALUES (?, ?, 1, ?, ?, ?)
+           ON CONFLICT (model, key) DO UPDATE SET
+               count = count + 1, ema = ? * excluded.ema + (1 - ?) * ema,
+               min = MIN(min, excluded.min), max = MAX(max, excluded.max)""",
+        (model, key, value, value, value, EMA_ALPHA, EMA_ALPHA))
+
+
+def _insert_record(conn, record: dict):
+    conn.execute(
+        f"""INSERT INTO timing_records (model, num_sections, total_lyrics_length, complexity_bucket, has_lyrics,
+                output_mode, has_reference, generation_time_seconds, completed_at, {", ".join(STAGE_METRICS)})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (record["model"], record["num_sections"], record["total_lyrics_length"], record["complexity_bucket"],
+         record["has_lyrics"], record["output_mode"], record["has_reference"], record["generation_time_seconds"],
+         record["completed_at"], *(record.get(metric) for metric in STAGE_METRICS)))
+    conn.execute("DELETE FROM timing_records WHERE id <= (SELECT MAX(id) FROM timing_records) - ?", (MAX_TIMING_RECORDS,))
+
+    model, time_sec = record["model"] or "unknown", record["generation_time_seconds"]
+    _update_aggregate(conn, model, "all", time_sec)
+    _update_aggregate(conn, model, f"bucket:{record['complexity_bucket']}", time_sec)
+    _update_aggregate(conn, model, f"lyrics:{'with' if record['has_lyrics'] else 'without'}", time_sec)
+    _update_aggregate(conn, model, f"reference:{'with' if record['has_reference'] else 'without'}", time_sec)
+    for metric in STAGE_METRICS:
+        if record.get(metric):
+            _update_aggregate(conn, model, f"stage:{metric}", record[metric])
 
 
 def get_complexity_bucket(num_sections: int, lyrics_length: int) -> str:
@@ -87,112 +221,87 @@ def save_timing_record(metadata: dict):
         "has_reference": bool(metadata.get("reference_audio_id")),
         "generation_time_seconds": metadata.get("generation_time_seconds"),
         "completed_at": metadata.get("completed_at"),
+        **{metric: metadata.get(metric) for metric in STAGE_METRICS},
     }
 
-    history = load_timing_history()
-    history.append(record)
-
-    # Keep only last N records
-    if len(history) > MAX_TIMING_RECORDS:
-        history = history[-MAX_TIMING_RECORDS:]
-
-    save_timing_history(history)
+    try:
+        with _db() as conn:
+            _insert_record(conn, record)
+    except Exception as e:
+        print(f"[TIMING] Error saving timing record: {e}")
+        return
     print(f"[TIMING] Saved record: {record['model']}, {record['num_sections']} sections, "
           f"{lyrics_length} chars, bucket={record['complexity_bucket']}, {record['generation_time_seconds']}s")
 
 
 def get_timing_stats() -> dict:
     """
-    Calculate timing statistics from history for smart estimates.
+    Timing statistics for smart estimates, read straight from the maintained aggregates.
     Returns per-model stats with complexity bucket averages for gradual learning.
     """
-    history = load_timing_history()
+    try:
+        with _db() as conn:
+            rows = conn.execute("SELECT model, key, count, ema, min, max FROM timing_aggregates").fetchall()
+    except Exception as e:
+        print(f"[TIMING] Error loading timing stats: {e}")
+        rows = []
 
-    if not history:
+    aggregates = {}
+    for model, key, count, ema, min_value, max_value in rows:
+        aggregates.setdefault(model, {})[key] = (count, ema, min_value, max_value)
+    if not aggregates:
         return {"has_history": False, "models": {}}
 
-    # Group by model
-    model_stats = {}
-    for record in history:
-        model = record.get("model", "unknown")
-        if model not in model_stats:
-            model_stats[model] = {
-                "all_times": [],
-                "by_bucket": {"low": [], "medium": [], "high": [], "very_high": []},
-                "by_lyrics": {"with": [], "without": []},
-                "by_reference": {"with": [], "without": []},
-                # Store raw records for weighted averaging
-                "records": [],
-            }
-
-        time_sec = record.get("generation_time_seconds", 0)
-        if time_sec <= 0:
-            continue
-
-        model_stats[model]["all_times"].append(time_sec)
-        model_stats[model]["records"].append(record)
-
-        # Group by complexity bucket
-        bucket = record.get("complexity_bucket", get_complexity_bucket(
-            record.get("num_sections", 0),
-            record.get("total_lyrics_length", 0)
-        ))
-        if bucket in model_stats[model]["by_bucket"]:
-            model_stats[model]["by_bucket"][bucket].append(time_sec)
-
-        # Track by lyrics presence
-        lyrics_key = "with" if record.get("has_lyrics") else "without"
-        model_stats[model]["by_lyrics"][lyrics_key].append(time_sec)
-
-        # Track by reference presence
-        ref_key = "with" if record.get("has_reference") else "without"
-        model_stats[model]["by_reference"][ref_key].append(time_sec)
-
-    # Calculate statistics with exponential weighting (recent records matter more)
     result = {"has_history": True, "models": {}}
-
-    # Only use last N records for EMA to be more responsive to recent performance
-    RECENT_RECORDS_FOR_EMA = 20
-
-    for model, stats in model_stats.items():
-        if not stats["all_times"]:
+    for model, keys in aggregates.items():
+        if "all" not in keys:
             continue
-
-        # Calculate weighted average using only recent records
-        def weighted_avg(times_list, alpha=0.5):
-            """Exponential moving average - only uses recent records for responsiveness"""
-            if not times_list:
-                return None
-
-            # Only use last N records for more responsive estimates
-            recent = times_list[-RECENT_RECORDS_FOR_EMA:] if len(times_list) > RECENT_RECORDS_FOR_EMA else times_list
-
-            if len(recent) == 1:
-                return int(recent[0])
-
-            # Start with oldest of recent, apply EMA
-            ema = recent[0]
-            for t in recent[1:]:
-                ema = alpha * t + (1 - alpha) * ema
-            return int(ema)
-
+        ema = lambda key: int(keys[key][1]) if key in keys else None
+        count, _, min_time, max_time = keys["all"]
         result["models"][model] = {
-            "count": len(stats["all_times"]),
-            "avg_time": weighted_avg(stats["all_times"]),
-            "min_time": min(stats["all_times"]),
-            "max_time": max(stats["all_times"]),
+            "count": count,
+            "avg_time": ema("all"),
+            "min_time": min_time,
+            "max_time": max_time,
             # Complexity bucket averages (EMA weighted)
-            "by_bucket": {
-                bucket: weighted_avg(times)
-                for bucket, times in stats["by_bucket"].items()
-                if times
-            },
+            "by_bucket": {key.split(":", 1)[1]: ema(key) for key in keys if key.startswith("bucket:")},
             # Lyrics impact
-            "avg_with_lyrics": weighted_avg(stats["by_lyrics"]["with"]),
-            "avg_without_lyrics": weighted_avg(stats["by_lyrics"]["without"]),
+            "avg_with_lyrics": ema("lyrics:with"),
+            "avg_without_lyrics": ema("lyrics:without"),
             # Reference impact
-            "avg_with_reference": weighted_avg(stats["by_reference"]["with"]),
-            "avg_without_reference": weighted_avg(stats["by_reference"]["without"]),
+            "avg_with_reference": ema("reference:with"),
+            "avg_without_reference": ema("reference:without"),
+            # Stage throughput (EMA weighted)
+            "stages": {metric: keys[f"stage:{metric}"][1] for metric in STAGE_METRICS if f"stage:{metric}" in keys},
         }
 
     return result
+
+
+def stage_estimate(stages: dict, duration: float) -> Optional[float]:
+    """Seconds the LM, diffusion and VAE stages take for duration seconds of audio, None without all three EMAs."""
+    if not all(stages.get(metric) for metric in STAGE_METRICS):
+        return None
+    return (duration * LM_FRAME_RATE / stages["lm_tokens_per_sec"]
+            + diffusion_windows(duration) / stages["diffusion_windows_per_sec"] + stages["vae_seconds"])
+
+
+def estimate_generation_time(model: str, num_sections: int, lyrics_length: int, duration: Optional[float] = None) -> int:
+    """
+    Expected generation time in seconds: the stage estimate for duration, else the bucket
+    EMA, else the model EMA, else the model default.
+    """
+    bucket = f"bucket:{get_complexity_bucket(num_sections, lyrics_length)}"
+    try:
+        with _db() as conn:
+            rows = dict(conn.execute(
+                f"SELECT key, ema FROM timing_aggregates WHERE model = ? AND key IN (?, 'all', {', '.join('?' * len(STAGE_METRICS))})",
+                (model, bucket, *(f"stage:{metric}" for metric in STAGE_METRICS))).fetchall())
+    except Exception as e:
+        print(f"[TIMING] Error estimating generation time: {e}")
+        rows = {}
+    stages = {metric: rows.get(f"stage:{metric}") for metric in STAGE_METRICS}
+    estimate = stage_estimate(stages, duration) if duration else None
+    if estimate is None:
+        estimate = rows.get(bucket, rows.get("all"))
+    return int(estimate) if estimate is not None else DEFAULT_MODEL_TIMES.get(model, DEFAULT_TIME)
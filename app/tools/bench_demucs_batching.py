@@ -0,0 +1,70 @@
+"""
+Compare per-segment and batched segment inference in Demucs apply_model on CPU.
+
+Separates the same mixture twice with the reference-upload settings (split=True,
+overlap=0.25, one shift): once with one HTDemucs forward per segment and once with
+the segments gathered into micro-batches sized by --segment_batch_mb. Reports the
+wall time of each mode and the largest difference between the two outputs, which
+should be at float rounding level.
+
+Usage:
+    python tools/bench_demucs_batching.py --audio some_song.flac
+    python tools/bench_demucs_batching.py --seconds 120 --segment_batch_mb 512 2048
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from third_party.demucs.models.apply import apply_model
+from third_party.demucs.models.audio import load_track
+from third_party.demucs.models.pretrained import get_model_from_yaml
+
+CKPT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'third_party', 'demucs', 'ckpt')
+
+
+def separate(model, wav, segment_batch_mb):
+    # Same random shift for both modes so the outputs are comparable
+    random.seed(0)
+    start_time = time.time()
+    out = apply_model(model, wav[None], shifts=1, split=True, overlap=0.25, num_workers=0,
+                      segment_batch_mb=segment_batch_mb)[0]
+    return out, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-segment vs batched Demucs segment inference')
+    parser.add_argument('--audio', type=str, default=None,
+                        help='Mixture to separate (default: --seconds of noise)')
+    parser.add_argument('--seconds', type=float, default=60,
+                        help='Length of the noise mixture when no --audio is given (default: 60)')
+    parser.add_argument('--segment_batch_mb', type=float, nargs='+', default=[1024],
+                        help='Memory budgets (MB) to try for the batched mode (default: 1024)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch intra-op threads (default: torch default)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = get_model_from_yaml(os.path.join(CKPT_DIR, 'htdemucs.yaml'), os.path.join(CKPT_DIR, 'htdemucs.pth')).eval()
+    if args.audio:
+        wav, _ = load_track(args.audio, model.audio_channels, model.samplerate)
+    else:
+        torch.manual_seed(0)
+        wav = 0.1 * torch.randn(model.audio_channels, int(args.seconds * model.samplerate))
+    print(f"Mixture: {wav.shape[-1] / model.samplerate:.1f}s, {torch.get_num_threads()} threads")
+
+    reference, reference_time = separate(model, wav, None)
+    print(f"{'per-segment':>16}: {reference_time:7.1f}s")
+    for budget in args.segment_batch_mb:
+        out, batched_time = separate(model, wav, budget)
+        max_diff = (out - reference).abs().max().item()
+        print(f"{f'batched {budget:g}MB':>16}: {batched_time:7.1f}s ({reference_time / batched_time:.2f}x), max diff {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Tokens/s of LM decoding with full precision and weight-only quantized Llama linears.
+
+Builds the two Llama stacks of LmModel (transformer and transformer2, randomly
+initialized), prefills a context and then times KV-cached single-frame decoding steps
+with a CFG batch of 2, the way LmModel.generate runs them. Sizes come from the
+checkpoint's config.yaml when --ckpt_path is given, otherwise from the flags. Weights
+are random, so this measures speed only; tools/check_lm_quant.py measures quality.
+
+Usage:
+    python tools/bench_lm_quant.py
+    python tools/bench_lm_quant.py --ckpt_path ckpt/songgeneration_base --modes fp32,int8,int4 --threads 8
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codeclm.models.levo import CausalLM, LlamaConfig
+from codeclm.utils.weight_quant import QUANT_MODES, quantize_llama_linears
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def build_stack(dim, intermediate_size, num_heads, num_layers, vocab_size):
+    config = LlamaConfig(hidden_size=dim, intermediate_size=intermediate_size, num_attention_heads=num_heads,
+                         num_hidden_layers=num_layers, num_key_value_heads=num_heads, vocab_size=vocab_size,
+                         use_cache=False, max_position_embeddings=8196, rms_norm_eps=1e-5, _flash_attn_2_enabled=False)
+    return CausalLM(config)
+
+
+def weight_bytes(module):
+    return sum(p.numel() * p.element_size() for p in module.parameters())
+
+
+@torch.no_grad()
+def decode(stacks, dim, context, steps, dtype, device):
+    """Seconds per decoding step after prefilling `context` frames."""
+    past = [None] * len(stacks)
+
+    def step(x):
+        for i, stack in enumerate(stacks):
+            out = stack(inputs_embeds=x, use_cache=True, past_key_values=past[i])
+            past[i] = out.past_key_values
+            x = out.hidden_states
+
+    step(torch.randn(2, context, dim, dtype=dtype, device=device))
+    step(torch.randn(2, 1, dim, dtype=dtype, device=device))
+    if device.type != 'cpu':
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(steps):
+        step(torch.randn(2, 1, dim, dtype=dtype, device=device))
+    if device.type != 'cpu':
+        torch.cuda.synchronize()
+    return (time.time() - start_time) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LM decoding speed with weight-only quantization')
+    parser.add_argument('--ckpt_path', type=str, default=None, help='Take the LM sizes from this config.yaml')
+    parser.add_argument('--dim', type=int, default=1024)
+    parser.add_argument('--intermediate_size', type=int, default=4096)
+    parser.add_argument('--num_heads', type=int, default=16)
+    parser.add_argument('--num_layers', type=int, default=12)
+    parser.add_argument('--num_layers_sub', type=int, default=4)
+    parser.add_argument('--code_size', type=int, default=16384)
+    parser.add_argument('--modes', type=str, default='fp32,int8,int4',
+                        help=f"Comma separated, of {', '.join(list(DTYPES) + list(QUANT_MODES))}")
+    parser.add_argument('--dtype', type=str, default='fp32', choices=list(DTYPES),
+                        help='Activation (and non-quantized weight) dtype of the int modes')
+    parser.add_argument('--context', type=int, default=500, help='Prefilled frames (default: 500, 20s)')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    sizes = dict(dim=args.dim, intermediate_size=args.intermediate_size, num_heads=args.num_heads,
+                 num_layers=args.num_layers, num_layers_sub=args.num_layers_sub, code_size=args.code_size)
+    if args.ckpt_path:
+        lm_cfg = OmegaConf.load(os.path.join(args.ckpt_path, 'config.yaml')).lm
+        sizes.update({key: lm_cfg[key] for key in sizes if key in lm_cfg})
+    device = torch.device(args.device)
+    print(f"LM sizes: {sizes}, {torch.get_num_threads()} threads, {args.context} frames context")
+
+    baseline = None
+    for mode in args.modes.split(','):
+        torch.manual_seed(0)
+        stacks = [build_stack(sizes['dim'], sizes['intermediate_size'], sizes['num_heads'], layers, sizes['code_size'] + 1)
+                  for layers in (sizes['num_layers'], sizes['num_layers_sub'])]
+        dtype = DTYPES.get(mode, DTYPES[args.dtype])
+        for stack in stacks:
+            if mode in QUANT_MODES:
+                quantize_llama_linears(stack, *QUANT_MODES[mode])
+            stack.to(device=device, dtype=dtype).eval()
+        seconds = decode(stacks, sizes['dim'], args.context, args.steps, dtype, device)
+        baseline = baseline or seconds
+        print(f"{mode:>5}: {1 / seconds:6.2f} frames/s ({seconds * 1000:.1f} ms/step, x{baseline / seconds:.2f}), "
+              f"weights {sum(weight_bytes(stack) for stack in stacks) / 1024 ** 3:.2f}GB")
+        del stacks
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure how close OffloadProfiler layer streaming gets to the host->device copy bandwidth.
+
+Builds a stack of fp16 linear layers, offloads all of them through OffloadProfiler and
+times full forward passes after the first (recording) one. Reports the streamed GB/s next
+to a raw pinned host->device copy of one layer, and the prefetch depth the profiler
+settled on. Needs a CUDA device.
+
+Usage:
+    python tools/bench_offload_streaming.py
+    python tools/bench_offload_streaming.py --layers 48 --width 4096 --tokens 16
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codeclm.utils.offload_profiler import OffloadProfiler
+
+
+class Stack(torch.nn.Module):
+    def __init__(self, layers, width):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(width, width) for _ in range(layers)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = torch.relu(layer(x))
+        return x
+
+
+def raw_copy_gbps(nbytes, repeats=20):
+    host = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+    device = torch.empty(nbytes, dtype=torch.uint8, device="cuda")
+    device.copy_(host, non_blocking=True)
+    torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(repeats):
+        device.copy_(host, non_blocking=True)
+    torch.cuda.synchronize()
+    return nbytes * repeats / (time.time() - start_time) / 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OffloadProfiler streaming bandwidth')
+    parser.add_argument('--layers', type=int, default=32)
+    parser.add_argument('--width', type=int, default=4096)
+    parser.add_argument('--tokens', type=int, default=2, help='Rows per forward (default: 2, like CFG decoding)')
+    parser.add_argument('--passes', type=int, default=10)
+    parser.add_argument('--max_pre_copy_step', type=int, default=4)
+    args = parser.parse_args()
+
+    model = Stack(args.layers, args.width).half().eval()
+    profiler = OffloadProfiler(device_index=0, max_pre_copy_step=args.max_pre_copy_step)
+    profiler.offload_layer(module=model, offload_layer_dict={'layers': 2}, dtype=torch.float16)
+    streamed = sum(layer.nbytes for layer in profiler.layers.values())
+    x = torch.randn(args.tokens, args.width, device="cuda", dtype=torch.float16)
+
+    with torch.no_grad():
+        model(x)
+        torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(args.passes):
+            model(x)
+        torch.cuda.synchronize()
+    elapsed = (time.time() - start_time) / args.passes
+
+    layer_bytes = max(layer.nbytes for layer in profiler.layers.values())
+    print(f"{args.layers} layers, {streamed / 1e9:.2f} GB streamed per pass, {elapsed * 1000:.1f} ms per pass")
+    print(f"streamed: {streamed / elapsed / 1e9:.2f} GB/s, raw pinned copy: {raw_copy_gbps(layer_bytes):.2f} GB/s")
+    print(f"pre_copy_step {profiler.pre_copy_step}, {len(profiler.slots)} staging slots, "
+          f"copy {profiler.copy_ms:.2f} ms / compute {profiler.compute_ms:.2f} ms per layer")
+    profiler.stop()
+
+
+if __name__ == "__main__":
+    main()
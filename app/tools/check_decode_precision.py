@@ -0,0 +1,111 @@
+"""
+SNR of the reduced precision decode policies against the fp32 decode.
+
+Decodes a clip of the cached tokens of a finished generation (the tokens.pt the model
+server writes next to each song) with Tango once per precision policy (see
+codeclm/tokenizer/Flow1dVAE/precision.py), from the same noise, and reports for each
+policy against fp32:
+    latent  SNR of the diffused latents (estimator and ODE solve)
+    vae     SNR of the fp32 latents decoded by the policy's VAE decoder (VAE alone)
+    audio   SNR of the end-to-end decode
+Runs on CPU by default. Exits non-zero when a policy's end-to-end audio SNR is below
+its limit.
+
+Usage:
+    python tools/check_decode_precision.py --ckpt_path ckpt/songgeneration_base --tokens output/<id>/tokens.pt
+    python tools/check_decode_precision.py --ckpt_path ckpt/songgeneration_base --tokens tokens.pt --policies bf16 --seconds 20
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codeclm', 'tokenizer', 'Flow1dVAE'))
+from codeclm.models import builders
+from precision import PRECISION_POLICIES
+
+FRAME_RATE = 25
+# Lowest end-to-end audio SNR (dB) against the fp32 decode
+MIN_SNR_DB = {'auto': 60.0, 'fp32': 60.0, 'bf16': 12.0, 'fp16': 20.0}
+
+
+def snr_db(reference, estimate):
+    noise = (reference - estimate).pow(2).sum()
+    return (10 * torch.log10(reference.pow(2).sum() / noise.clamp(min=1e-20))).item()
+
+
+def decode(tango, codes, vocal_prompt, bgm_prompt, num_steps):
+    """(audio [B, C, T], diffused latents [B, 64, T]) of one code2sound call."""
+    latents = []
+    decode_window = tango.decode_window
+    tango.decode_window = lambda latent, *args, **kwargs: (latents.append(latent.float().cpu()),
+                                                           decode_window(latent, *args, **kwargs))[1]
+    try:
+        torch.manual_seed(0)
+        audio = tango.code2sound(codes, vocal_prompt, bgm_prompt, guidance_scale=1.5, num_steps=num_steps,
+                                 disable_progress=True, chunked=True, pipeline_decode=False)
+    finally:
+        del tango.decode_window
+    return audio.float(), torch.cat(latents, -1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode precision policies vs fp32')
+    parser.add_argument('--ckpt_path', type=str, required=True,
+                        help='Checkpoint directory containing config.yaml')
+    parser.add_argument('--tokens', type=str, required=True,
+                        help='tokens.pt written by the model server for a finished generation')
+    parser.add_argument('--policies', type=str, default='bf16,fp16',
+                        help=f"Comma separated, of {', '.join(PRECISION_POLICIES)}")
+    parser.add_argument('--seconds', type=float, default=10.0, help='Length of the decoded clip (default: 10)')
+    parser.add_argument('--num_steps', type=int, default=20, help='Euler steps per diffusion solve (default: 20)')
+    parser.add_argument('--min_snr', type=float, default=None,
+                        help='Audio SNR (dB) that fails a policy (default: 12 bf16, 20 fp16)')
+    args = parser.parse_args()
+
+    OmegaConf.register_new_resolver("eval", lambda x: eval(x))
+    OmegaConf.register_new_resolver("concat", lambda *x: [xxx for xx in x for xxx in xx])
+    OmegaConf.register_new_resolver("get_fname", lambda: 'default')
+    OmegaConf.register_new_resolver("load_yaml", lambda x: list(OmegaConf.load(x)))
+    cfg = OmegaConf.load(os.path.join(args.ckpt_path, 'config.yaml'))
+    cfg.mode = 'inference'
+
+    tango = builders.get_audio_tokenizer_model_cpu(cfg.audio_tokenizer_checkpoint_sep, cfg).eval().model
+    decode_inputs = torch.load(args.tokens, map_location='cpu')
+    tokens = decode_inputs['tokens'][..., :int(args.seconds * FRAME_RATE)]
+    codes = [tokens[:, [1], :], tokens[:, [2], :]]
+    vocal_prompt, bgm_prompt = decode_inputs.get('vocal_prompt'), decode_inputs.get('bgm_prompt')
+    print(f"Decoding {tokens.shape[-1]} frames ({tokens.shape[-1] / FRAME_RATE:.1f}s), {args.num_steps} steps, "
+          f"{torch.get_num_threads()} threads")
+
+    failures = 0
+    reference = None
+    for policy in ['fp32'] + args.policies.split(','):
+        tango.set_precision(policy)
+        start_time = time.time()
+        with torch.no_grad():
+            audio, latents = decode(tango, codes, vocal_prompt, bgm_prompt, args.num_steps)
+        elapsed = time.time() - start_time
+        with torch.no_grad():
+            vae_audio = tango.decode_window((latents if reference is None else reference[1]), chunked=True)
+        if reference is None:
+            reference = (audio, latents, vae_audio)
+            print(f" fp32: {elapsed:.1f}s")
+            continue
+        audio_snr = snr_db(reference[0], audio)
+        limit = args.min_snr if args.min_snr is not None else MIN_SNR_DB[policy]
+        ok = audio_snr >= limit
+        failures += not ok
+        print(f"{policy:>5}: latent {snr_db(reference[1], latents):5.1f}dB, "
+              f"vae {snr_db(reference[2], vae_audio):5.1f}dB, "
+              f"audio {audio_snr:5.1f}dB (limit {limit:.0f}dB), {elapsed:.1f}s {'ok' if ok else 'FAILED'}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
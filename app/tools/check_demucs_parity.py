@@ -0,0 +1,85 @@
+"""
+Parity check of the batched Wiener filter and the uncentered STFT in HTDemucs.
+
+Compares `HTDemucs._wiener` (all samples and windows in one batched solve) with the
+per-sample, per-window loop over `openunmix.filtering.wiener` it replaces, and
+`HTDemucs._spec` (uncentered STFT) with the centered STFT whose edge frames were
+sliced off. Random inputs, with a frame count that is not a multiple of the Wiener
+window so the zero-padded last window is covered. Exits non-zero on a mismatch.
+
+Usage:
+    python tools/check_demucs_parity.py
+"""
+import os
+import sys
+import math
+from types import SimpleNamespace
+
+import torch
+from openunmix.filtering import wiener
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from third_party.demucs.models.htdemucs import HTDemucs, pad1d
+from third_party.demucs.models.spec import spectro
+
+WIENER_WIN_LEN = 300
+TOLERANCE = 1e-4
+
+
+def reference_wiener(mag_out, mix_stft, niters, residual):
+    """The previous HTDemucs._wiener: one openunmix call per sample and window."""
+    b, s, c, fq, t = mag_out.shape
+    mag_out = mag_out.permute(0, 4, 3, 2, 1)
+    mix_stft = torch.view_as_real(mix_stft.permute(0, 3, 2, 1))
+    outs = []
+    for sample in range(b):
+        out = []
+        for pos in range(0, t, WIENER_WIN_LEN):
+            frame = slice(pos, pos + WIENER_WIN_LEN)
+            z_out = wiener(mag_out[sample, frame], mix_stft[sample, frame], niters, residual=residual)
+            out.append(z_out.transpose(-1, -2))
+        outs.append(torch.cat(out, dim=0))
+    out = torch.view_as_complex(torch.stack(outs, 0)).permute(0, 4, 3, 2, 1).contiguous()
+    return out[:, :-1] if residual else out
+
+
+def reference_spec(x, nfft, hl):
+    """The previous HTDemucs._spec: centered STFT, first and last two frames dropped."""
+    le = int(math.ceil(x.shape[-1] / hl))
+    pad = hl // 2 * 3
+    x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
+    return spectro(x, nfft, hl)[..., :-1, :][..., 2: 2 + le]
+
+
+def relative_error(a, b):
+    return ((a - b).abs().max() / b.abs().max()).item()
+
+
+def main():
+    torch.manual_seed(0)
+    failures = 0
+
+    b, s, c, fq, t = 2, 4, 2, 65, 2 * WIENER_WIN_LEN + 47
+    mag = torch.rand(b, s, c, fq, t)
+    mix = torch.randn(b, c, fq, t, dtype=torch.complex64)
+    for niters in (0, 1, 2):
+        for residual in (False, True):
+            model = SimpleNamespace(wiener_residual=residual)
+            error = relative_error(HTDemucs._wiener(model, mag, mix, niters), reference_wiener(mag, mix, niters, residual))
+            ok = error < TOLERANCE
+            failures += not ok
+            print(f"wiener iters={niters} residual={residual!s:<5}: rel. error {error:.2e} {'ok' if ok else 'MISMATCH'}")
+
+    for nfft, length in ((4096, 44100 * 7 + 123), (512, 3000)):
+        model = SimpleNamespace(hop_length=nfft // 4, nfft=nfft)
+        x = torch.randn(b, c, length)
+        error = relative_error(HTDemucs._spec(model, x), reference_spec(x, nfft, nfft // 4))
+        ok = error < TOLERANCE
+        failures += not ok
+        print(f"spec nfft={nfft} length={length}: rel. error {error:.2e} {'ok' if ok else 'MISMATCH'}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Perplexity of the weight-only quantized LM on held-out tokens.
+
+Teacher-forces a code sequence through the full precision LM and through its int8 /
+int4 versions (converted with the same quantize_state_dict as tools/quantize_lm.py)
+and compares per-codebook perplexity and top-1 agreement with the full precision
+predictions. Any [1, K, T] code tensor works as held-out data: the tokens.pt the model
+server writes next to each song, or a real song encoded with the tokenizer. The LM
+sees the null (unconditional) conditions, so only the ratio between precisions is
+meaningful. Exits non-zero when a mode raises perplexity by more than its limit.
+
+Usage:
+    python tools/check_lm_quant.py --ckpt_path ckpt/songgeneration_base --tokens output/<id>/tokens.pt
+    python tools/check_lm_quant.py --ckpt_path ckpt/songgeneration_base --tokens codes.pt --modes int8 --frames 3000
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+from omegaconf import OmegaConf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codeclm.models import builders
+from codeclm.utils.weight_quant import QUANT_MODES, prepare_quantized_model, quantize_state_dict
+
+FRAME_RATE = 25
+# Allowed relative perplexity increase over full precision
+MAX_PPL_INCREASE = {'int8': 0.02, 'int4': 0.10}
+
+
+def load_lm(cfg, state_dict, mode, device):
+    lm = builders.get_lm_model(cfg)
+    if mode in QUANT_MODES:
+        state_dict = quantize_state_dict(state_dict, *QUANT_MODES[mode])
+        prepare_quantized_model(lm, state_dict)
+    lm.load_state_dict(state_dict, strict=False)
+    lm.cfg = cfg
+    return lm.eval().to(device)
+
+
+@torch.no_grad()
+def evaluate(lm, codes, condition_tensors):
+    """(per codebook perplexity, top-1 predictions, valid mask) of teacher-forced codes [1, K, T]."""
+    out = lm.compute_predictions(codes, condition_tensors)
+    logits = out.logits.float()
+    valid = out.mask.bool() & (codes < logits.shape[-1])
+    nll = F.cross_entropy(logits.permute(0, 3, 1, 2), codes.clamp(max=logits.shape[-1] - 1), reduction='none')
+    ppl = [(nll[:, k][valid[:, k]].mean()).exp().item() for k in range(codes.shape[1])]
+    return ppl, logits.argmax(-1), valid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantized LM perplexity on held-out tokens')
+    parser.add_argument('--ckpt_path', type=str, required=True,
+                        help='Checkpoint directory containing config.yaml and model.pt')
+    parser.add_argument('--tokens', type=str, required=True,
+                        help='tokens.pt of a finished generation, or a saved [1, K, T] code tensor')
+    parser.add_argument('--modes', type=str, default='int8,int4', help=f"Comma separated, of {', '.join(QUANT_MODES)}")
+    parser.add_argument('--frames', type=int, default=1500, help='Frames scored (default: 1500, one minute)')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--max_ppl_increase', type=float, default=None,
+                        help='Relative perplexity increase that fails a mode (default: 2%% int8, 10%% int4)')
+    args = parser.parse_args()
+
+    OmegaConf.register_new_resolver("eval", lambda x: eval(x))
+    OmegaConf.register_new_resolver("concat", lambda *x: [xxx for xx in x for xxx in xx])
+    OmegaConf.register_new_resolver("get_fname", lambda: 'default')
+    OmegaConf.register_new_resolver("load_yaml", lambda x: list(OmegaConf.load(x)))
+    cfg = OmegaConf.load(os.path.join(args.ckpt_path, 'config.yaml'))
+    cfg.mode = 'inference'
+    cfg.lm.use_flash_attn_2 = False
+    device = torch.device(args.device)
+
+    tokens = torch.load(args.tokens, map_location='cpu')
+    tokens = tokens['tokens'] if isinstance(tokens, dict) else tokens
+    codes = tokens[..., :args.frames].long().to(device)
+    checkpoint = torch.load(os.path.join(args.ckpt_path, 'model.pt'), map_location='cpu')
+    state_dict = {k[len('audiolm.'):]: v for k, v in checkpoint.items() if k.startswith('audiolm.')}
+    del checkpoint
+    null_prompt = torch.full((1, codes.shape[1], cfg.prompt_len * FRAME_RATE), 16385, dtype=torch.long)
+    print(f"Scoring {codes.shape[-1]} frames x {codes.shape[1]} codebooks on {device}")
+
+    failures = 0
+    reference = None
+    for mode in ['fp32'] + args.modes.split(','):
+        lm = load_lm(cfg, state_dict, mode, device)
+        condition_tensors = lm.prepare_condition_tensors(batch_size=1, audio_qt_emb=null_prompt.to(device))
+        start_time = time.time()
+        ppl, top1, valid = evaluate(lm, codes, condition_tensors)
+        elapsed = time.time() - start_time
+        del lm
+        if reference is None:
+            reference = (ppl, top1)
+            print(f" fp32: ppl {' / '.join(f'{p:.3f}' for p in ppl)}, {elapsed:.1f}s")
+            continue
+        increase = max(p / r - 1 for p, r in zip(ppl, reference[0]))
+        agreement = (top1 == reference[1])[valid].float().mean().item()
+        limit = args.max_ppl_increase if args.max_ppl_increase is not None else MAX_PPL_INCREASE[mode]
+        ok = increase <= limit
+        failures += not ok
+        print(f"{mode:>5}: ppl {' / '.join(f'{p:.3f}' for p in ppl)} ({increase * 100:+.2f}%, limit {limit * 100:.0f}%), "
+              f"top-1 agreement {agreement * 100:.1f}%, {elapsed:.1f}s {'ok' if ok else 'FAILED'}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Checks of the LM offload planner on synthetic layer profiles (CPU only).
+
+- every plan fits its budget, and more budget never means fewer resident layers
+- an ample budget streams nothing, a budget below the fixed part raises
+- staging slots and prefetch depth follow the copy / compute ratio
+- profile_layers walks a module like OffloadProfiler._offload_layer does
+- the plan's config carries the keys OffloadParamParse reads
+
+Exits non-zero on a failed check.
+
+Usage:
+    python tools/check_offload_planner.py
+"""
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codeclm.utils.offload_planner import LayerProfile, plan_offload, profile_layers
+
+GB = 1024 ** 3
+failures = 0
+
+
+def check(name, ok):
+    global failures
+    failures += not ok
+    print(f"{name}: {'ok' if ok else 'FAILED'}")
+
+
+def synthetic_lm(num_layers=36, layer_params=200_000_000, fixed_params=500_000_000):
+    """Roughly SongGeneration-large sized: 36 decoder layers of ~0.4GB in fp16."""
+    layers = [LayerProfile(f"transformer.model.layers.{i}", layer_params, 0, 2 * 20_000) for i in range(num_layers)]
+    return LayerProfile("fixed", fixed_params), layers
+
+
+class ToyDecoder(torch.nn.Module):
+    def __init__(self, width):
+        super().__init__()
+        self.up = torch.nn.Linear(width, 4 * width)
+        self.down = torch.nn.Linear(4 * width, width)
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self, width=16, depth=3):
+        super().__init__()
+        self.emb = torch.nn.Embedding(100, width)
+        self.transformer = torch.nn.Module()
+        self.transformer.model = torch.nn.Module()
+        self.transformer.model.layers = torch.nn.ModuleList([ToyDecoder(width) for _ in range(depth)])
+        self.transformer.lm_head = torch.nn.Linear(width, 100, bias=False)
+
+
+def main():
+    fixed, layers = synthetic_lm()
+    total = fixed.nbytes('torch.float16') + sum(layer.nbytes('torch.float16') for layer in layers)
+
+    plan = plan_offload(fixed, layers, total + 4 * GB)
+    check("ample budget streams nothing", not plan.streams and plan.memory_bytes <= plan.budget_bytes)
+
+    previous = -1
+    monotonic, within = True, True
+    for budget_gb in range(3, 20):
+        plan = plan_offload(fixed, layers, budget_gb * GB)
+        within &= plan.memory_bytes <= budget_gb * GB
+        monotonic &= len(plan.resident_layer_list) >= previous
+        previous = len(plan.resident_layer_list)
+    check("plans fit their budget", within)
+    check("resident layers grow with the budget", monotonic)
+
+    plan = plan_offload(fixed, layers, 8 * GB)
+    names = [layer.name for layer in layers]
+    check("tight budget splits resident / streamed",
+          plan.streams and plan.resident_layer_list == names[:len(plan.resident_layer_list)]
+          and sorted(plan.resident_layer_list + plan.streamed_layer_list) == sorted(names))
+
+    slow = plan_offload(fixed, layers, 8 * GB, h2d_gbps=2, device_gbps=600, max_pre_copy_step=3)
+    fast = plan_offload(fixed, layers, 8 * GB, h2d_gbps=600, device_gbps=600)
+    check("prefetch depth follows copy / compute", slow.pre_copy_step == 3 and fast.pre_copy_step == 1)
+    check("slower copies mean a slower step", slow.expected_step_ms > fast.expected_step_ms)
+
+    try:
+        plan_offload(fixed, layers, fixed.nbytes('torch.float16') // 2)
+        check("budget below the fixed part raises", False)
+    except ValueError:
+        check("budget below the fixed part raises", True)
+
+    fits_fp32 = plan_offload(fixed, layers, 8 * GB, dtypes=('torch.float32', 'torch.float16'))
+    check("falls back to a dtype that fits", fits_fp32.dtype == 'torch.float16')
+
+    model = ToyModel()
+    toy_fixed, toy_layers = profile_layers(model, {'transformer': 4})
+    expected = ["transformer.model.layers.0", "transformer.model.layers.1", "transformer.model.layers.2", "transformer.lm_head"]
+    all_params = sum(p.numel() for p in model.parameters())
+    check("profile_layers finds the offload units", [layer.name for layer in toy_layers] == expected)
+    check("profile_layers accounts every parameter",
+          toy_fixed.float_params + sum(layer.float_params for layer in toy_layers) == all_params
+          and toy_fixed.float_params == model.emb.weight.numel())
+
+    plan = plan_offload(toy_fixed, toy_layers, 1024 * 1024, offload_layer_dict={'transformer': 4})
+    config = plan.to_config()
+    check("plan config has the offload section layout",
+          config['offload_module'] == "self" and config['dtype'] == 'torch.float16' and config['cpu_mem_gb'] == -1
+          and config['offload_layer_dict'] == {'transformer': 4}
+          and config['resident_layer_list'] == plan.resident_layer_list
+          and config['pre_copy_step'] == plan.pre_copy_step)
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Index parity check of the inference-mode RVQ codebook search.
+
+Runs the tokenizer's quantizers (descript_quantize3 with the 16384-entry codebook used
+by the 1rvq/septoken tokenizers, and the 4-layer variant) in eval mode and compares
+their codes with the full euclidean distance matrix + max they used to compute, layer
+by layer on the same residuals, and times both lookups inside the same residual loop. Also forces the chunked search path with a small
+score budget. Codes must match exactly; exits non-zero otherwise.
+
+Usage:
+    python tools/check_rvq_parity.py
+    python tools/check_rvq_parity.py --frames 6000
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codeclm', 'tokenizer', 'Flow1dVAE'))
+from libs.rvq import nearest
+from libs.rvq.descript_quantize3 import ResidualVectorQuantize
+from libs.rvq.descript_quantize3_4layer_freezelayer1 import ResidualVectorQuantize as ResidualVectorQuantize4
+
+
+def reference_indices(quantizer, latents):
+    """The previous VectorQuantize.decode_latents lookup."""
+    encodings = F.normalize(rearrange(latents, "b d t -> (b t) d"))
+    codebook = F.normalize(quantizer.codebook.weight)
+    dist = (
+        encodings.pow(2).sum(1, keepdim=True)
+        - 2 * encodings @ codebook.t()
+        + codebook.pow(2).sum(1, keepdim=True).t()
+    )
+    return rearrange((-dist).max(1)[1], "(b t) -> b t", b=latents.size(0))
+
+
+def search_indices(quantizer, latents):
+    """The inference-mode VectorQuantize.decode_latents lookup."""
+    return quantizer.decode_latents(latents)[1]
+
+
+def layer_codes(rvq, z, lookup):
+    """Codes of every layer, the residual loop of the RVQ forward with the given lookup."""
+    codes, residual = [], z
+    for quantizer in rvq.quantizers:
+        z_e = quantizer.in_proj(residual)
+        indices = lookup(quantizer, z_e)
+        residual = residual - quantizer.out_proj(quantizer.decode_code(indices))
+        codes.append(indices)
+    return torch.stack(codes, dim=1)
+
+
+def timed(fn, *args):
+    start_time = time.time()
+    result = fn(*args)
+    return result, time.time() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RVQ codebook search parity')
+    parser.add_argument('--frames', type=int, default=1500,
+                        help='Frames per sample (default: 1500, one minute at 25 Hz)')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    failures = 0
+    models = {
+        "descript_quantize3 1x16384": ResidualVectorQuantize(input_dim=1024, n_codebooks=1, codebook_size=16_384, codebook_dim=32),
+        "descript_quantize3_4layer 4x16384": ResidualVectorQuantize4(input_dim=1024, n_codebooks=4, codebook_size=16_384, codebook_dim=32),
+    }
+    z = torch.randn(2, 1024, args.frames)
+    with torch.no_grad():
+        for name, rvq in models.items():
+            rvq.eval()
+            expected, reference_time = timed(layer_codes, rvq, z, reference_indices)
+            default_budget = nearest.MAX_SCORE_BYTES
+            for budget in (default_budget, 1024 * 1024):
+                nearest.MAX_SCORE_BYTES = budget
+                # Same residual loop on both sides, so the times compare the lookups alone
+                codes, elapsed = timed(layer_codes, rvq, z, search_indices)
+                forward_codes = rvq(z)[1]
+                nearest.MAX_SCORE_BYTES = default_budget
+                mismatches = (codes != expected).sum().item() + (forward_codes != expected).sum().item()
+                failures += mismatches > 0
+                print(f"{name} budget={budget >> 20}MB: {mismatches} mismatched codes of {codes.numel()}, "
+                      f"{elapsed:.2f}s vs {reference_time:.2f}s {'ok' if not mismatches else 'MISMATCH'}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,9 @@ from omegaconf import OmegaConf
 
 from codeclm.trainer.codec_song_pl import CodecLM_PL
 from codeclm.models import CodecLM
+from codeclm.utils.offload_profiler import OffloadProfiler, OffloadParamParse
+from codeclm.utils.offload_planner import plan_module_offload, LM_RESERVE_GB
+from codeclm.utils.weight_quant import checkpoint_file
 from separator import Separator
 
 # ============================================================================
@@ -89,10 +92,29 @@ apply_manual_attention_patch()
 # ============================================================================
 
 
+LOAD_STAGES = ['config', 'tokenizer', 'lm', 'checkpoint', 'device', 'separator']
+
+
 class LeVoInference(torch.nn.Module):
-    def __init__(self, ckpt_path):
+    def __init__(self, ckpt_path, progress_callback=None, offload_plan=None, lm_mem_gb=None, lm_quant=None,
+                 decode_precision=None, pipeline_decode=False):
+        """
+        offload_plan (an offload section, see OffloadPlan.to_config) or lm_mem_gb (device
+        memory budget to plan one for) keep part of the LM in host RAM, streamed layer by
+        layer; without either the whole model is loaded onto the device. lm_quant ('int8' /
+        'int4') loads the weight-only quantized checkpoint written by tools/quantize_lm.py.
+        decode_precision picks the precision policy of the diffusion and VAE decode
+        ('auto', 'fp32', 'bf16', 'fp16'), see set_decode_precision. pipeline_decode runs the
+        VAE decode of finished windows alongside the diffusion of the next (CUDA/CPU, more memory).
+        """
         super().__init__()
 
+        def report(stage):
+            print(f"[INFERENCE] Load stage: {stage}", flush=True)
+            if progress_callback is not None:
+                progress_callback('loading', LOAD_STAGES.index(stage), len(LOAD_STAGES))
+        report('config')
+
         # Optimizations
         torch.backends.cudnn.enabled = False 
         
@@ -119,7 +141,7 @@ class LeVoInference(torch.nn.Module):
         # ------------------------------------------------------------------------
 
         cfg_path = os.path.join(ckpt_path, 'config.yaml')
-        pt_path = os.path.join(ckpt_path, 'model.pt')
+        pt_path = checkpoint_file(ckpt_path, lm_quant)
 
         self.cfg = OmegaConf.load(cfg_path)
         self.cfg.mode = 'inference'
@@ -127,15 +149,24 @@ class LeVoInference(torch.nn.Module):
 
         # Load Full Model Once (Faster for high RAM devices)
         print("[INFERENCE] Loading Full Model into Memory...", flush=True)
-        model_light = CodecLM_PL(self.cfg, pt_path)
+        model_light = CodecLM_PL(self.cfg, pt_path, progress_callback=report)
 
         # Move to MPS immediately in FP16
-        model_light = model_light.eval().cuda().to(torch.float16)
+        report('device')
+        self.offload_profiler = None
+        self.offload_plan = None
+        if offload_plan is None and lm_mem_gb is None:
+            model_light = model_light.eval().cuda().to(torch.float16)
+        else:
+            model_light = model_light.eval()
+            self._offload_lm(model_light, offload_plan, lm_mem_gb)
         model_light.audiolm.cfg = self.cfg
 
         self.model_lm = model_light.audiolm
         self.model_audio_tokenizer = model_light.audio_tokenizer
         self.model_seperate_tokenizer = model_light.seperate_tokenizer
+        self.set_decode_precision(decode_precision)
+        self.model_seperate_tokenizer.model.pipeline_decode = pipeline_decode
 
         self.model = CodecLM(name = "tmp",
             lm = self.model_lm,
@@ -143,7 +174,10 @@ class LeVoInference(torch.nn.Module):
             max_duration = self.max_duration,
             seperate_tokenizer = self.model_seperate_tokenizer,
         )
+        report('separator')
         self.separator = Separator()
+        if progress_callback is not None:
+            progress_callback('loading', len(LOAD_STAGES), len(LOAD_STAGES))
 
         self.default_params = dict(
             cfg_coef = 1.5,
@@ -158,6 +192,56 @@ class LeVoInference(torch.nn.Module):
 
         self.model.set_generation_params(**self.default_params)
 
+    def _offload_lm(self, model_light, offload_plan, lm_mem_gb):
+        """Tokenizers go to the device whole; the LM layers the plan streams stay in (pinned) host RAM."""
+        for name, child in model_light.named_children():
+            if name == 'seperate_tokenizer':
+                # the decode path's dtypes are its precision policy's
+                setattr(model_light, name, child.cuda())
+            elif name != 'audiolm':
+                # nn.Module.to like the resident path: the tokenizer wrappers' own to() takes no positional dtype
+                setattr(model_light, name, torch.nn.Module.to(child.cuda(), dtype=torch.float16))
+        if offload_plan is None:
+            plan = plan_module_offload(model_light.audiolm, int(lm_mem_gb * 1024 ** 3),
+                                       reserve_bytes=int(LM_RESERVE_GB * 1024 ** 3))
+            print(f"[INFERENCE] Offload plan: {plan.summary()}", flush=True)
+            offload_plan = plan.to_config()
+        offload_param = OffloadParamParse.parse_config(model_light.audiolm, OmegaConf.create(offload_plan))
+        self.offload_profiler = OffloadProfiler(device_index=0, **offload_param.init_param_dict())
+        self.offload_profiler.offload_layer(**offload_param.offload_layer_param_dict())
+        self.offload_plan = offload_plan
+
+    def offload_stats(self):
+        """LM residency and streaming counters, None when the whole LM is on the device."""
+        if self.offload_profiler is None:
+            return None
+        return dict(self.offload_profiler.stats(),
+                    resident_layers=len(self.offload_plan.get('resident_layer_list', [])))
+
+    def release(self):
+        """Stop the layer streaming thread; call before dropping the model."""
+        if self.offload_profiler is not None:
+            self.offload_profiler.stop()
+            self.offload_profiler = None
+
+    def set_decode_precision(self, decode_precision=None):
+        """Switch the diffusion estimator and VAE decoder to another precision policy (cheap, no reload)."""
+        tango = self.model_seperate_tokenizer.model
+        tango.set_precision(decode_precision)
+        print(f"[INFERENCE] Decode precision: {tango.precision.name}", flush=True)
+
+    @property
+    def decode_precision(self):
+        return self.model_seperate_tokenizer.model.precision.name
+
+    def set_progress_callback(self, progress_callback=None):
+        """Report progress as progress_callback(stage, done, total) for the 'lm', 'diffusion' and 'vae' stages."""
+        if progress_callback is None:
+            self.model.set_custom_progress_callback(None)
+        else:
+            self.model.set_custom_progress_callback(lambda done, total: progress_callback('lm', done, total))
+        self.model_seperate_tokenizer.model.set_progress_callback(progress_callback)
+
     def forward(self, lyric: str, description: str = None, prompt_audio_path: os.PathLike = None, genre: str = None, auto_prompt_path: os.PathLike = None, gen_type: str = "mixed", params = dict()):
         params = {**self.default_params, **params}
         self.model.set_generation_params(**params)
@@ -191,14 +275,27 @@ class LeVoInference(torch.nn.Module):
         with torch.autocast(device_type="cuda", dtype=torch.float16):
             tokens = self.model.generate(**generate_inp, return_tokens=True)
             
+        # Keep what the decoder needs so the same tokens can be re-decoded without the LM
+        crop_prompt = self.model_seperate_tokenizer.model.crop_prompt
+        self.last_decode_inputs = {
+            'tokens': tokens.detach().cpu(),
+            'vocal_prompt': crop_prompt(vocal_wav).cpu() if melody_is_wav and vocal_wav is not None else None,
+            'bgm_prompt': crop_prompt(bgm_wav).cpu() if melody_is_wav and bgm_wav is not None else None,
+        }
+
+        # Clean up before decoding
+        gc.collect()
+        torch.cuda.empty_cache()
+
+        if melody_is_wav:
+            return self.decode(tokens, vocal_wav, bgm_wav, gen_type=gen_type, prompt=pmt_wav)
+        return self.decode(tokens, gen_type=gen_type)
+
+    def decode(self, tokens, vocal_prompt=None, bgm_prompt=None, gen_type: str = "mixed", num_steps: int = 50, prompt=None):
+        """Turn [1, 3, T] LM tokens into audio, a [C, T] tensor or a stem dict for 'separate'."""
         with torch.no_grad():
-            # Clean up before decoding
-            gc.collect()
-            torch.cuda.empty_cache()
-            
-            if melody_is_wav:
-                wav_seperate = self.model.generate_audio(tokens, pmt_wav, vocal_wav, bgm_wav, gen_type=gen_type)
-            else:
-                wav_seperate = self.model.generate_audio(tokens, gen_type=gen_type)
+            wav_seperate = self.model.generate_audio(tokens, prompt, vocal_prompt, bgm_prompt, gen_type=gen_type, num_steps=num_steps)
 
+        if isinstance(wav_seperate, dict):
+            return {stem: wav[0] for stem, wav in wav_seperate.items()}
         return wav_seperate[0]
@@ -232,4 +232,6 @@ class LeVoInference(torch.nn.Module):
         gc.collect()
         torch.cuda.empty_cache()
 
+        if isinstance(wav_seperate, dict):
+            return {stem: wav[0] for stem, wav in wav_seperate.items()}
         return wav_seperate[0]
@@ -41,9 +41,8 @@ class Separator(torch.nn.Module):
         if len(output_paths) == 1:  # 4
             vocal_path = output_paths[0]
         else:
-            drums_path, bass_path, other_path, vocal_path = self.demucs_model.separate(audio_path, output_dir, device=self.device)
-            for path in [drums_path, bass_path, other_path]:
-                os.remove(path)
+            # Only the vocals are needed, the accompaniment is derived below as full minus vocals
+            vocal_path, = self.demucs_model.separate(audio_path, output_dir, stem="vocal", device=self.device, write_rest=False)
         full_audio = self.load_audio(audio_path)
         vocal_audio = self.load_audio(vocal_path)
         bgm_audio = full_audio - vocal_audio
@@ -0,0 +1,61 @@
+"""
+Write the weight-only quantized LM checkpoint of a model directory.
+
+Reads <ckpt_path>/model.pt and writes <ckpt_path>/model_<mode>.pt with the Llama
+linears of both LM transformers stored as int8 (per output row) or int4 (per 128
+input columns); everything else is copied unchanged. Calibration-free, runs on CPU
+without building the model. Load the result with --lm_quant / SONGGEN_LM_QUANT.
+
+Usage:
+    python tools/quantize_lm.py ckpt/songgeneration_base --mode int8
+    python tools/quantize_lm.py ckpt/songgeneration_base --mode int4 --group_size 64
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from codeclm.utils.weight_quant import QUANT_KEY, QUANT_MODES, quantize_state_dict
+
+GB = 1024 ** 3
+
+
+def tensor_bytes(state_dict, keys):
+    return sum(state_dict[k].numel() * state_dict[k].element_size() for k in keys)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Weight-only LM quantization')
+    parser.add_argument('ckpt_path', type=str, help='Checkpoint directory containing model.pt')
+    parser.add_argument('--mode', type=str, default='int8', choices=list(QUANT_MODES))
+    parser.add_argument('--group_size', type=int, default=None,
+                        help='Input columns per scale (default: whole rows for int8, 128 for int4)')
+    args = parser.parse_args()
+
+    bits, group_size = QUANT_MODES[args.mode]
+    group_size = args.group_size or group_size
+    src = os.path.join(args.ckpt_path, 'model.pt')
+    dst = os.path.join(args.ckpt_path, f'model_{args.mode}.pt')
+
+    start_time = time.time()
+    state_dict = torch.load(src, map_location='cpu')
+    converted = quantize_state_dict(state_dict, bits, group_size)
+    layers = converted[QUANT_KEY]['layers']
+    if not layers:
+        print(f"No Llama linears found in {src}")
+        sys.exit(1)
+    before = tensor_bytes(state_dict, [f"{name}.weight" for name in layers])
+    after = tensor_bytes(converted, [f"{name}.{leaf}" for name in layers for leaf in ('qweight', 'scale')])
+    torch.save(converted, dst)
+
+    print(f"{len(layers)} linears -> {args.mode} (group_size {group_size or 'row'}): "
+          f"{before / GB:.2f}GB -> {after / GB:.2f}GB")
+    print(f"{dst}: {os.path.getsize(dst) / GB:.2f}GB (model.pt {os.path.getsize(src) / GB:.2f}GB), "
+          f"{time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+SongGeneration Studio - Audio Transcoding
+On-demand Opus/MP3 versions of output tracks for playback over slow links.
+
+- Encoded with soundfile (libsndfile), no external tools or services
+- Cached under transcodes/, keyed by track, source mtime, format and bitrate, so a
+  re-decoded track gets fresh transcodes and old ones are never served
+- At most TRANSCODE_WORKERS encodes run at once; concurrent requests for the same
+  transcode share one job
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import Dict
+
+from config import TRANSCODE_DIR
+
+TRANSCODE_WORKERS = 2
+
+# format -> soundfile format, subtype, extension, media type, (min, max) kbps libsndfile maps
+# compression_level onto, allowed bitrates
+TRANSCODE_FORMATS = {
+    "opus": ("OGG", "OPUS", "opus", "audio/ogg", (6, 256), (64, 96, 128, 160)),
+    "mp3": ("MP3", "MPEG_LAYER_III", "mp3", "audio/mpeg", (32, 320), (128, 192, 256, 320)),
+}
+DEFAULT_BITRATES = {"opus": 96, "mp3": 192}
+
+_pool = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix="transcode")
+_jobs: Dict[Path, Future] = {}
+# Re-entrant: a job that is already done runs its done callback inside get_transcode
+_jobs_lock = threading.RLock()
+
+
+def transcode_path(gen_id: str, source: Path, fmt: str, bitrate: int) -> Path:
+    ext = TRANSCODE_FORMATS[fmt][2]
+    return TRANSCODE_DIR / gen_id / f"{source.stem}.{source.stat().st_mtime_ns}.{bitrate}k.{ext}"
+
+
+def _encode(source: Path, target: Path, fmt: str, bitrate: int) -> Path:
+    import soundfile as sf
+    file_format, subtype, _, _, (min_kbps, max_kbps), _ = TRANSCODE_FORMATS[fmt]
+    audio, sample_rate = sf.read(str(source), dtype="float32", always_2d=True)
+    if fmt == "opus" and sample_rate != 48000:
+        # Opus only runs at 48 kHz
+        import torch
+        import torchaudio
+        audio = torchaudio.functional.resample(torch.from_numpy(audio.T), sample_rate, 48000).T.numpy()
+        sample_rate = 48000
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Older transcodes of this track were made from a previous version of the source
+    for stale in target.parent.glob(f"{source.stem}.*"):
+        if stale.suffix == target.suffix and not stale.name.startswith(f"{source.stem}.{source.stat().st_mtime_ns}."):
+            stale.unlink(missing_ok=True)
+    partial = target.with_name(target.name + ".part")
+    if fmt == "opus":
+        # libsndfile's Opus range is per channel and has no constant bitrate mode
+        kbps, extra = bitrate / audio.shape[1], {}
+    else:
+        kbps, extra = bitrate, {"bitrate_mode": "CONSTANT"}
+    level = min(max((max_kbps - kbps) / (max_kbps - min_kbps), 0.0), 1.0)
+    sf.write(str(partial), audio, sample_rate, format=file_format, subtype=subtype, compression_level=level, **extra)
+    os.replace(partial, target)
+    print(f"[TRANSCODE] {source.name} -> {target.name}", flush=True)
+    return target
+
+
+def get_transcode(gen_id: str, source: Path, fmt: str, bitrate: int) -> Future:
+    """Future of the cached transcode of source, starting the encode if it isn't cached or running."""
+    target = transcode_path(gen_id, source, fmt, bitrate)
+    with _jobs_lock:
+        future = _jobs.get(target)
+        if future is None:
+            if target.exists():
+                future = Future()
+                future.set_result(target)
+                return future
+            future = _pool.submit(_encode, source, target, fmt, bitrate)
+            _jobs[target] = future
+            future.add_done_callback(lambda _: _forget(target))
+    return future
+
+
+def _forget(target: Path):
+    with _jobs_lock:
+        _jobs.pop(target, None)
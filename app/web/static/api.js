@@ -30,11 +30,32 @@ var deleteGeneration = async (id) => {
 };
 
 // ============ Library API ============
-var fetchLibrary = async () => {
-    const r = await fetch('/api/generations');
+var LIBRARY_PAGE_SIZE = 50;
+
+// One page of the library, newest first ({ items, next_cursor }); running generations lead the first page.
+// With `since` (a created_at), only the running generations and those created at or after it.
+var fetchLibraryPage = async ({ cursor = null, since = null } = {}) => {
+    const params = new URLSearchParams({ limit: LIBRARY_PAGE_SIZE });
+    if (cursor) params.set('cursor', cursor);
+    if (since) params.set('since', since);
+    const r = await fetch(`/api/generations?${params}`);
     if (!r.ok) throw new Error(`Failed to load library: ${r.status}`);
-    const data = await r.json();
-    return data.sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
+    return r.json();
+};
+
+var fetchLibrary = async () => (await fetchLibraryPage()).items;
+
+// Fresh items replace the held ones with the same id, newest first
+var mergeLibrary = (held, fresh) => {
+    const byId = new Map(held.map(item => [item.id, item]));
+    fresh.forEach(item => byId.set(item.id, item));
+    return [...byId.values()].sort((a, b) => new Date(b.created_at) - new Date(a.created_at));
+};
+
+var fetchTrackPeaks = async (genId, trackIdx, width) => {
+    const r = await fetch(`/api/audio/${genId}/${trackIdx}/peaks` + (width ? `?width=${width}` : ''));
+    if (!r.ok) return null;
+    return r.json();
 };
 
 // ============ Queue API ============
@@ -32,6 +32,7 @@ var App = () => {
     const [estimatedTime, setEstimatedTime] = useState(null);
 
     const [library, setLibrary] = useState([]);
+    const [libraryCursor, setLibraryCursor] = useState(null);
     const [queue, setQueue] = useState([]);
     const [gpuInfo, setGpuInfo] = useState(null);
     const [timingStats, setTimingStats] = useState(null);
@@ -53,6 +54,7 @@ var App = () => {
     const queueRef = useRef(queue);
     const cleanupRef = useRef(null);
     const transitionLockRef = useRef(false);
+    const loadingMoreRef = useRef(false);
 
     const modelState = useModels();
     const audioPlayer = useAudioPlayer(library);
@@ -62,7 +64,16 @@ var App = () => {
     const [rightHover, rightHoverHandlers] = useHover();
     const [libraryHover, libraryHoverHandlers] = useHover();
 
-    const loadLibrary = async () => { try { setLibrary(await fetchLibrary()); } catch (e) { console.error(e); } };
+    const loadLibrary = async () => { try { const page = await fetchLibraryPage(); setLibrary(page.items); setLibraryCursor(page.next_cursor); } catch (e) { console.error(e); } };
+    const loadMoreLibrary = async () => {
+        if (!libraryCursor || loadingMoreRef.current) return;
+        loadingMoreRef.current = true;
+        try { const page = await fetchLibraryPage({ cursor: libraryCursor }); setLibrary(prev => mergeLibrary(prev, page.items)); setLibraryCursor(page.next_cursor); }
+        catch (e) { console.error(e); }
+        finally { loadingMoreRef.current = false; }
+    };
+    // Next page once a song list is scrolled close to its end
+    const onLibraryScroll = (e) => { const el = e.currentTarget; if (el.scrollHeight - el.scrollTop - el.clientHeight < 400) loadMoreLibrary(); };
     const loadQueue = async () => { try { setQueue(await fetchQueue()); } catch (e) { console.error(e); } };
     const loadGpuInfo = async () => { try { setGpuInfo(await fetchGpuInfo()); } catch (e) { console.error(e); } };
     const loadTimingStats = async () => { try { setTimingStats(await fetchTimingStats()); } catch (e) { console.error(e); } };
@@ -88,7 +99,12 @@ var App = () => {
         const bgSync = async () => {
             if (generating && currentGenId) return;
             try {
-                const lib = await fetchLibrary();
+                // Only what can have changed: the running generations and anything created since the newest song held
+                const active = ['generating', 'processing', 'pending'];
+                const since = [library.find(l => l.status === 'completed'), ...library.filter(l => active.includes(l.status))].filter(Boolean).map(l => l.created_at).sort()[0];
+                const { items } = await fetchLibraryPage({ since });
+                const freshIds = new Set(items.map(item => item.id));
+                const lib = mergeLibrary(library.filter(l => !active.includes(l.status) || freshIds.has(l.id)), items);
                 const runningGen = lib.find(item => ['generating', 'processing'].includes(item.status));
                 if (runningGen && !generating && !currentGenId) setLibrary(lib);
                 else if (!runningGen && library.some(l => ['generating', 'processing'].includes(l.status))) setLibrary(lib);
@@ -139,7 +155,7 @@ var App = () => {
 
         const [freshQueue, freshTimingStats] = await Promise.all([fetchQueue(), fetchTimingStats()]);
         setTimingStats(freshTimingStats);
-        setLibrary(freshLibrary);
+        setLibrary(prev => mergeLibrary(prev, freshLibrary));
         setQueue(freshQueue);
         setCurrentGenId(gen.id);
         setCurrentGenPayload(payload);
@@ -183,19 +199,19 @@ var App = () => {
             transitionLockRef.current = false;
         } else {
             const freshQueue = await fetchQueue();
-            setLibrary(freshLib); setQueue(freshQueue);
+            setLibrary(prev => mergeLibrary(prev, freshLib)); setQueue(freshQueue);
             pollRef.current = setInterval(async () => {
                 const lib = await fetchLibrary();
                 const running = lib.find(item => ['generating', 'processing', 'pending'].includes(item.status));
                 if (running) {
                     clearInterval(pollRef.current); pollRef.current = null;
-                    try { await setupGenerationTracking(running, lib); } catch (e) { setGenerating(false); setLibrary(lib); await loadQueue(); }
+                    try { await setupGenerationTracking(running, lib); } catch (e) { setGenerating(false); setLibrary(prev => mergeLibrary(prev, lib)); await loadQueue(); }
                     transitionLockRef.current = false;
                 } else {
                     const q = await fetchQueue();
                     if (q.length === 0) {
                         clearInterval(pollRef.current); pollRef.current = null;
-                        setGenerating(false); setLibrary(lib); setQueue(q);
+                        setGenerating(false); setLibrary(prev => mergeLibrary(prev, lib)); setQueue(q);
                         transitionLockRef.current = false;
                     }
                 }
@@ -443,7 +459,7 @@ var App = () => {
                         <aside style={{ width: '280px', flexShrink: 0, display: 'flex', flexDirection: 'column', overflow: 'hidden', paddingBottom: '100px' }}>
                             <div style={{ backgroundColor: '#282828', borderRadius: '12px', padding: '16px', border: '1px solid #333', display: 'flex', flexDirection: 'column', flex: 1, overflow: 'hidden' }}>
                                 <div style={{ fontSize: '14px', fontWeight: '600', color: '#999', marginBottom: '12px', flexShrink: 0 }}>Songs</div>
-                                <div {...rightHoverHandlers} style={{ flex: 1, overflowY: 'auto', paddingRight: '8px', ...getScrollStyle(rightHover) }}>
+                                <div {...rightHoverHandlers} onScroll={onLibraryScroll} style={{ flex: 1, overflowY: 'auto', paddingRight: '8px', ...getScrollStyle(rightHover) }}>
                                     {!currentGenPayload && queue.length === 0 && library.length === 0 ? (<div style={{ color: '#555', fontSize: '12px', textAlign: 'center', padding: '20px 0' }}>No activity yet</div>) : (
                                         <div style={{ display: 'flex', flexDirection: 'column', gap: '10px', paddingBottom: '80px' }}>
                                             {(() => {
@@ -474,7 +490,7 @@ var App = () => {
                 </div>
 
                 <div style={{ display: activeTab === 'library' ? 'flex' : 'none', flex: 1, overflow: 'hidden' }}>
-                    <div {...libraryHoverHandlers} style={{ maxWidth: '900px', margin: '0 auto', padding: '0 24px 100px 24px', flex: 1, overflowY: 'auto', ...getScrollStyle(libraryHover) }}>
+                    <div {...libraryHoverHandlers} onScroll={onLibraryScroll} style={{ maxWidth: '900px', margin: '0 auto', padding: '0 24px 100px 24px', flex: 1, overflowY: 'auto', ...getScrollStyle(libraryHover) }}>
                         <h2 style={{ fontSize: '20px', fontWeight: '600', marginBottom: '20px', color: '#e0e0e0' }}>Your Songs ({library.filter(l => l.status === 'completed').length}){(currentGenPayload || queue.length > 0) && <span style={{ color: '#6366F1', fontWeight: '400', fontSize: '14px', marginLeft: '12px' }}>+ {(currentGenPayload ? 1 : 0) + queue.length} pending</span>}</h2>
                         {library.length === 0 && queue.length === 0 && !currentGenPayload ? (<div style={{ textAlign: 'center', padding: '60px', color: '#666' }}>No songs generated yet. Start creating!</div>) : (
                             <div style={{ display: 'flex', flexDirection: 'column', gap: '12px' }}>
@@ -502,7 +518,7 @@ var App = () => {
                         <button onClick={() => audioPlayer.playingItem && audioPlayer.play(audioPlayer.playingItem)} disabled={!audioPlayer.playingItem} style={{ background: audioPlayer.playingItem ? '#fff' : '#555', border: 'none', borderRadius: '50%', width: '36px', height: '36px', display: 'flex', alignItems: 'center', justifyContent: 'center', cursor: audioPlayer.playingItem ? 'pointer' : 'not-allowed' }}>{audioPlayer.isPlaying ? <PauseLargeIcon size={16} color={audioPlayer.playingItem ? '#000' : '#333'} /> : <PlayLargeIcon size={16} color={audioPlayer.playingItem ? '#000' : '#333'} style={{ marginLeft: '2px' }} />}</button>
                         <button onClick={audioPlayer.playNext} disabled={!audioPlayer.playingItem} style={{ background: 'none', border: 'none', color: audioPlayer.playingItem ? '#888' : '#444', cursor: audioPlayer.playingItem ? 'pointer' : 'not-allowed' }}><SkipForwardIcon /></button>
                     </div>
-                    <div style={{ display: 'flex', alignItems: 'center', gap: '10px', width: '100%', maxWidth: '600px' }}><span style={{ fontSize: '11px', color: '#888', minWidth: '35px', textAlign: 'right' }}>{formatTime(audioPlayer.progress)}</span><div style={{ flex: 1, height: '4px', backgroundColor: '#3a3a3a', borderRadius: '2px', cursor: audioPlayer.playingItem ? 'pointer' : 'default', position: 'relative' }} onClick={(e) => { if (!audioPlayer.playingItem) return; const rect = e.currentTarget.getBoundingClientRect(); audioPlayer.seek((e.clientX - rect.left) / rect.width * audioPlayer.duration); }}><div style={{ position: 'absolute', left: 0, top: 0, height: '100%', width: `${audioPlayer.duration ? (audioPlayer.progress / audioPlayer.duration) * 100 : 0}%`, backgroundColor: '#10B981', borderRadius: '2px' }} /></div><span style={{ fontSize: '11px', color: '#888', minWidth: '35px' }}>{formatTime(audioPlayer.duration)}</span></div>
+                    <div style={{ display: 'flex', alignItems: 'center', gap: '10px', width: '100%', maxWidth: '600px' }}><span style={{ fontSize: '11px', color: '#888', minWidth: '35px', textAlign: 'right' }}>{formatTime(audioPlayer.progress)}</span><TrackWaveform genId={audioPlayer.playingItem?.id} trackIdx={audioPlayer.playingTrackIdx} progress={audioPlayer.progress} duration={audioPlayer.duration} onSeek={audioPlayer.seek} /><span style={{ fontSize: '11px', color: '#888', minWidth: '35px' }}>{formatTime(audioPlayer.duration)}</span></div>
                 </div>
                 <div style={{ display: 'flex', alignItems: 'center', gap: '8px', minWidth: '120px' }}><button onClick={() => audioPlayer.setVolume(audioPlayer.volume > 0 ? 0 : 1)} style={{ background: 'none', border: 'none', color: '#888', cursor: 'pointer' }}>{audioPlayer.volume === 0 ? <VolumeMuteIcon /> : <VolumeFullIcon />}</button><input type="range" min="0" max="1" step="0.01" value={audioPlayer.volume} onChange={(e) => audioPlayer.setVolume(parseFloat(e.target.value))} style={{ width: '80px', accentColor: '#10B981' }} /></div>
             </footer>
@@ -138,6 +138,67 @@ var DarkAudioPlayer = ({ src }) => {
     );
 };
 
+// Seekable waveform of an output track, drawn from the server-side peaks at the element's pixel width
+var TrackWaveform = ({ genId, trackIdx, progress, duration, onSeek, height = 28 }) => {
+    const containerRef = useRef(null);
+    const canvasRef = useRef(null);
+    const [width, setWidth] = useState(0);
+    const [peaks, setPeaks] = useState(null);
+
+    useEffect(() => {
+        if (!containerRef.current) return;
+        const observer = new ResizeObserver(entries => setWidth(Math.round(entries[0].contentRect.width)));
+        observer.observe(containerRef.current);
+        return () => observer.disconnect();
+    }, []);
+
+    useEffect(() => {
+        setPeaks(null);
+        if (!genId || trackIdx == null || width <= 0) return;
+        let cancelled = false;
+        fetchTrackPeaks(genId, trackIdx, width).then(data => { if (!cancelled) setPeaks(data); }).catch(() => {});
+        return () => { cancelled = true; };
+    }, [genId, trackIdx, width]);
+
+    useEffect(() => {
+        const canvas = canvasRef.current;
+        if (!canvas || !peaks || width <= 0) return;
+        const ratio = window.devicePixelRatio || 1;
+        canvas.width = width * ratio;
+        canvas.height = height * ratio;
+        const ctx = canvas.getContext('2d');
+        ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
+        ctx.clearRect(0, 0, width, height);
+        const count = peaks.max.length;
+        const played = duration > 0 ? progress / duration : 0;
+        const barWidth = Math.max(1, width / count - 1);
+        const middle = height / 2;
+        for (let i = 0; i < count; i++) {
+            const x = i * width / count;
+            const top = middle - peaks.max[i] * middle;
+            const bottom = middle - peaks.min[i] * middle;
+            ctx.fillStyle = x / width < played ? '#10B981' : '#4a4a4a';
+            ctx.fillRect(x, top, barWidth, Math.max(1, bottom - top));
+        }
+    }, [peaks, width, height, progress, duration]);
+
+    const handleSeek = (e) => {
+        if (!genId || !duration) return;
+        const rect = e.currentTarget.getBoundingClientRect();
+        onSeek((e.clientX - rect.left) / rect.width * duration);
+    };
+
+    return (
+        <div ref={containerRef} onClick={handleSeek} style={{ flex: 1, height: peaks ? `${height}px` : '4px', backgroundColor: peaks ? 'transparent' : '#3a3a3a', borderRadius: '2px', cursor: genId ? 'pointer' : 'default', position: 'relative' }}>
+            {peaks ? (
+                <canvas ref={canvasRef} style={{ width: '100%', height: '100%', display: 'block' }} />
+            ) : (
+                <div style={{ position: 'absolute', left: 0, top: 0, height: '100%', width: `${duration ? (progress / duration) * 100 : 0}%`, backgroundColor: '#10B981', borderRadius: '2px' }} />
+            )}
+        </div>
+    );
+};
+
 // Audio Trimmer Component with Waveform Visualization
 var AudioTrimmer = ({ onAccept, onClear, onFileLoad }) => {
     const [file, setFile] = useState(null);